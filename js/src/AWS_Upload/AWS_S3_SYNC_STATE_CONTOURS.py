@@ -1,31 +1,20 @@
-import os
-import shutil
-import time
-from multiprocessing.dummy import Pool as ThreadPool
-
-def copyFolder(sourceFolder):
-    folder = sourceFolder.split(':')[-1]
-
-    folderName = folder.split('\\')[-1]
-    state = folder.split('\\')[-2]
-    destFolder = f"data/Contour_Lines/{state.lower()}/{folderName.lower().replace('_county_contours', '')}/GIS1"
+"""
+Syncs the index, Dwg_Files and Shapefiles of every county of a state to s3://storage.data.gis1.net in the GLACIER_IR
+storage class. The upload is done by python/Transfer_State_Contours_To_AWS.py (with the shared transfer engine), see
+that script for the options. A state folder path (e.g. W:\\SOUTH_CAROLINA) can be given instead of the state name.
+"""
 
-    os.system(f"aws s3 cp {sourceFolder}\\{folderName}_Index.geojson s3://storage.data.gis1.net/{destFolder}/index.json --storage-class GLACIER_IR")
-    os.system(f"aws s3 sync {sourceFolder}\\Dwg_Files s3://storage.data.gis1.net/{destFolder} --storage-class GLACIER_IR")
-    os.system(f"aws s3 sync {sourceFolder}\\Shapefiles s3://storage.data.gis1.net/{destFolder} --storage-class GLACIER_IR")
-
-
-def main():
-    sourceStateFolder = input("Enter the path to the state folder, including drive letter (e.g. W:\\SOUTH_CAROLINA): ")
+import os
+import sys
 
-    state = sourceStateFolder.split('\\')[-1]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'python'))
 
-    countyFolders = [ f.path for f in os.scandir(sourceStateFolder) if (f.is_dir() and 'County_Contours' in f.path and not 'Empty' in f.path ) ]
+import Transfer_State_Contours_To_AWS as transfer
 
-    pool = ThreadPool(len(countyFolders))
-    pool.map(copyFolder, countyFolders)
-    pool.close()
-    pool.join()
+transfer.STORAGE_CLASS = 'GLACIER_IR'
 
 if __name__ == '__main__':
-	main()
+	sourceStateFolder = sys.argv[1] if len(sys.argv) > 1 else input("Enter the path to the state folder, including drive letter (e.g. W:\\SOUTH_CAROLINA): ")
+	state = os.path.basename(os.path.normpath(sourceStateFolder))
+	sys.argv[1:] = [state, '--source-dir', sourceStateFolder, *sys.argv[2:]]
+	transfer.main()
@@ -1,76 +1,18 @@
-import os
-import shutil
-import time
-from multiprocessing.dummy import Pool as ThreadPool
-
-STATE_FOLDER = ''
-DEST_DRIVE = ''
-
-def log(message):
-    global STATE_FOLDER
-    
-    with open(f"{STATE_FOLDER}\\copy.log", "a") as f:
-        f.write(f"{message}\n")
-
-
-def copyFolder(sourceFolder):
-    folder = sourceFolder.split(':')[-1]
-    destFolder = f"{DEST_DRIVE}:{folder}"
-
-    folderName = sourceFolder.split('\\')[-1]
-    print(f"COPYING {sourceFolder}\\Shapefiles -> {destFolder}\\Shapefiles")
-    shutil.copytree(f"{sourceFolder}\\Shapefiles", f"{destFolder}\\Shapefiles")
-    print(f"FINISHED COPYING {sourceFolder}\\Shapefiles -> {destFolder}\\Shapefiles")
-
-    print(f"COPYING {sourceFolder}\\Dwg_Files -> {destFolder}\\Dwg_Files")
-    shutil.copytree(f"{sourceFolder}\\Dwg_Files", f"{destFolder}\\Dwg_Files")
-    print(f"FINISHED COPYING {sourceFolder}\\Dwg_Files -> {destFolder}\\Dwg_Files")
-
-    print(f"COPYING {sourceFolder}\\{folderName}_Index.geojson -> {destFolder}\\{folderName}_Index.geojson")
-    shutil.copy(f"{sourceFolder}\\{folderName}_Index.geojson", f"{destFolder}\\{folderName}_Index.geojson")
-    print(f"FINISHED COPYING {sourceFolder}\\{folderName}_Index.geojson -> {destFolder}\\{folderName}_Index.geojson")
+"""
+Copies the Shapefiles, Dwg_Files and index GeoJSON of every county of a state to an external hard drive. The copy is
+done by python/Transfer_State_Contours_To_External_HD.py (with the shared transfer engine), which resumes from its
+journal on the drive and adopts the counties listed in copy.log by earlier versions, see that script for the options.
+"""
 
-    log(sourceFolder)
-
-
-def main():
-    global STATE_FOLDER
-    global DEST_DRIVE
-
-    STATE_FOLDER = input("Enter the path to the state folder, including drive letter (e.g. W:\\SOUTH_CAROLINA): ")
-    DEST_DRIVE = input("Enter the drive letter to copy to (e.g. E): ")
-
-    freeSpace = shutil.disk_usage(DEST_DRIVE).free
-
-    completed = []
-
-    if os.path.exists(f"{STATE_FOLDER}\\copy.log"):
-        with open(f"{STATE_FOLDER}\\copy.log", "r") as f:
-            for line in f.readlines():
-                completed.append(line.strip())
+import os
+import sys
 
-    state = STATE_FOLDER.split('\\')[-1]
-    countyFolders = [ f.path for f in os.scandir(STATE_FOLDER) if (f.is_dir() and 'County_Contours' in f.path and not 'Empty' in f.path) ]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'python'))
 
-    copyFolders = []
-    copySpace = 0
-    
-    for folder in countyFolders:
-        if folder in completed:
-            print(f"Skipping {folder} (already copied)")
-            continue
-        else:
-            folderSize = shutil.disk_usage(folder).used
-            if (folderSize + copySpace) < freeSpace:
-                copySpace += folderSize
-                copyFolders.append(folder)
-            else:
-                print(f"Will skip {folder} (not enough space)")
+import Transfer_State_Contours_To_External_HD as transfer
 
-    pool = ThreadPool(len(copyFolders))
-    pool.map(copyFolder, copyFolders)
-    pool.close()
-    pool.join()
+transfer.COPY_LOG = 'copy.log'
+transfer.COPY_ARTIFACTS = ['Shapefiles', 'Dwg_Files', '{county}_Index.geojson']
 
 if __name__ == '__main__':
-	main()
+	transfer.main()
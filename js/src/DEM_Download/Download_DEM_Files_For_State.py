@@ -1,34 +1,593 @@
+"""
+Downloads the 1m DEM tiles of every QL 0-2 lidar project of a state from the USGS (rockyweb / prd-tnm).
+
+Tiles are downloaded by a pool of worker threads over keep-alive connections: every host has a pool of idle HTTP
+connections that are reused for the next tile instead of opening a new TCP/TLS connection per tile, and at most
+MAX_CONNECTIONS_PER_HOST requests are sent to a host at the same time. Failed requests are retried up to MAX_RETRIES
+times with exponential backoff (with jitter, at most BACKOFF_MAX seconds), except for errors that will not go away
+(e.g. 404). The number of tiles and the aggregate throughput are printed every PROGRESS_INTERVAL seconds.
+
+Tiles are streamed in BUFFER_SIZE chunks to a .part file next to the tile, and the ETag, Last-Modified and length of
+the tile are saved next to it (.part.json). A download that fails midway (in this run or an interrupted one) resumes
+where it stopped with an HTTP Range request; If-Range makes the server send the whole tile again if it changed in the
+meantime, and the Content-Range of the response is checked against the saved length and the size of the .part file.
+The .part file is renamed into place only once its size matches the length of the tile, so a .tif is never truncated.
+
+The download lists of the projects are fetched LIST_WORKERS at a time and cached in LIST_CACHE_FOLDER in the
+destination folder with their ETag and Last-Modified, so on the next run the server only has to confirm that a list
+has not changed (304 Not Modified). If a list cannot be fetched, its cached copy is used. Tiles are queued for
+download as soon as the list of their project arrives, so downloading starts while the other lists are still fetched.
+
+Only the tiles that will be used are downloaded: the extent of a tile is read from its name (USGS_1M_{zone}_x##y###,
+the UTM zone and the upper left corner in 10km units, as in List_Available_DEMs.js), and the tile is only queued if
+its extent intersects the bounding box (in the tile's UTM zone, buffered by TILE_FILTER_BUFFER meters as in
+DEM_Sort.js) of a county that the DEM allocation of the state (DEM_ALLOCATION_FILE) assigns its project to. County
+boundaries are read from COUNTY_BOUNDARIES_FILE and projected from WGS84 to UTM. Tiles whose name has no extent are
+always downloaded, and without the allocation or the boundaries every tile of the state's projects is downloaded.
+
+Before a tile is queued, it is checked in the destination folder, the tiles of a list in parallel (PRESCAN_WORKERS
+threads): a tile is only downloaded again if it is missing, does not start with a valid TIFF/BigTIFF header (with its
+first IFD inside the file), or its size differs from the Content-Length the server reports for it (HEAD request).
+The result of every check is cached in PRESCAN_CACHE in the destination folder with the size and modification time
+of the tile, so unchanged tiles are not read or checked with the server again on the next run.
+
+The run can be interrupted with Ctrl+C at any time: the queued tiles are dropped, the pre-scan results so far are saved,
+and the tiles being downloaded resume from their .part files on the next run.
+
+DOWNLOAD_LIST_URL can be pointed at a local HTTP server (http:// URLs are supported) to test the downloader.
+"""
+
+import re
+import csv
 import json
-import urllib.request
+import math
 import os
+import time
+import queue
+import random
+import threading
+import http.client
+import urllib.parse
 from multiprocessing.dummy import Pool as ThreadPool
 
 DESTINATION_FOLDER = ''
 URLS = []
 
+# Download list of a project ({project} is replaced with the project's work unit)
+DOWNLOAD_LIST_URL = 'https://rockyweb.usgs.gov/vdelivery/Datasets/Staged/Elevation/1m/Projects/{project}/0_file_download_links.txt'
+# Maximum number of requests sent to one host at the same time
+MAX_CONNECTIONS_PER_HOST = 16
+# Size of the chunks a response is read and written in
+BUFFER_SIZE = 1024 * 1024
+# Number of times a failed download is retried, waiting BACKOFF_BASE * 2^attempt seconds (at most BACKOFF_MAX)
+MAX_RETRIES = 8
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Seconds without data after which a connection is considered dead
+TIMEOUT = 60
+MAX_REDIRECTS = 5
+# Suffix of the file a tile is downloaded to before it is complete
+PART_SUFFIX = '.part'
+PROGRESS_INTERVAL = 10
+# Download lists and their ETag and Last-Modified, in the destination folder
+LIST_CACHE_FOLDER = '.download_lists'
+# Number of download lists fetched at the same time
+LIST_WORKERS = 8
+# Only download the tiles near the counties that the DEM allocation assigns their project to
+FILTER_TILES_BY_COUNTY = True
+DEM_ALLOCATION_FILE = '../../data/DEM_Allocation/{state}.csv'
+COUNTY_BOUNDARIES_FILE = '../../data/US_County_Details_And_Boundaries.geojson'
+# Distance in meters around a county within which tiles are downloaded
+TILE_FILTER_BUFFER = 300
+# UTM zone, and easting and northing of the upper left corner in 10km units, of a tile (e.g. USGS_1M_17_x45y376_...)
+TILE_NAME_PATTERN = re.compile(r'_(\d{1,2})_x(\d{2})y(\d{3})')
+TILE_SIZE = 10000
+# Results of the checks of the tiles already downloaded, in the destination folder
+PRESCAN_CACHE = '.dem_prescan_cache.json'
+PRESCAN_WORKERS = 32
+# First 4 bytes of little and big endian TIFF and BigTIFF files
+TIFF_SIGNATURES = [b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+']
+
+IDLE_CONNECTIONS = {}
+HOST_SLOTS = {}
+POOL_LOCK = threading.Lock()
+
+STATS = {'tiles': 0, 'queued': 0, 'bytes': 0, 'failed': [], 'start': None}
+STATS_LOCK = threading.Lock()
+
+class HttpError(Exception):
+  def __init__(self, url, status, reason):
+    super().__init__(f"HTTP {status} {reason} for {url}")
+    self.status = status
+
+def isPermanent(error):
+  """Errors that retrying will not fix (any 4xx status other than 408 and 429)"""
+
+  return isinstance(error, HttpError) and 400 <= error.status < 500 and error.status not in (408, 429)
+
+def hostSlot(host):
+  with POOL_LOCK:
+    if host not in HOST_SLOTS:
+      HOST_SLOTS[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+    return HOST_SLOTS[host]
+
+def newConnection(scheme, host):
+  if scheme == 'https':
+    return http.client.HTTPSConnection(host, timeout=TIMEOUT)
+  return http.client.HTTPConnection(host, timeout=TIMEOUT)
+
+def takeConnection(scheme, host):
+  """Returns an idle keep-alive connection to a host, or a new one, and whether it was reused"""
+
+  with POOL_LOCK:
+    idle = IDLE_CONNECTIONS.get((scheme, host))
+    if idle:
+      return idle.pop(), True
+
+  return newConnection(scheme, host), False
+
+def returnConnection(scheme, host, connection, response):
+  """Puts a connection back into the pool once its response has been read, unless the server is closing it"""
+
+  if response.will_close:
+    connection.close()
+    return
+
+  with POOL_LOCK:
+    IDLE_CONNECTIONS.setdefault((scheme, host), []).append(connection)
+
+def httpGet(url, handleResponse, headers=None, method='GET'):
+  """
+  Sends a GET (or HEAD) request over a pooled connection, following redirects, and returns handleResponse(response)
+  handleResponse is only called for 2xx and 304 (Not Modified) responses, other responses raise an HttpError
+  A pooled connection the server closed while it was idle is replaced by a new one at once
+  """
+
+  headers = headers or {}
+
+  for _ in range(MAX_REDIRECTS + 1):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else '')
+
+    with hostSlot(parts.netloc):
+      connection, reused = takeConnection(parts.scheme, parts.netloc)
+
+      try:
+        try:
+          connection.request(method, path, headers=headers)
+          response = connection.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+          if not reused:
+            raise
+
+          # No response was received, so the request is sent again without counting as a retry
+          connection.close()
+          connection = newConnection(parts.scheme, parts.netloc)
+          connection.request(method, path, headers=headers)
+          response = connection.getresponse()
+
+        if response.status in (301, 302, 303, 307, 308):
+          response.read()
+          returnConnection(parts.scheme, parts.netloc, connection, response)
+          url = urllib.parse.urljoin(url, response.getheader('Location'))
+          continue
+
+        if response.status >= 300 and response.status != 304:
+          raise HttpError(url, response.status, response.reason)
+
+        result = handleResponse(response)
+        response.read()
+        returnConnection(parts.scheme, parts.netloc, connection, response)
+        return result
+      except:
+        connection.close()
+        raise
+
+  raise Exception(f"Too many redirects for {url}")
+
+def withRetries(description, action, retries=MAX_RETRIES):
+  """Calls action() until it succeeds, waiting longer after every failure, and raises the last error after `retries` retries"""
+
+  for attempt in range(retries + 1):
+    try:
+      return action()
+    except Exception as e:
+      if attempt == retries or isPermanent(e):
+        raise
+
+      delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+      print(f"{description} failed ({e}), retrying in {delay:.0f}s ({retries - attempt} more attempts)...")
+      time.sleep(delay)
+
+def readPartState(partPath):
+  """Returns the validators and length saved for a .part file, or None if there is no usable .part file"""
+
+  try:
+    with open(f"{partPath}.json") as file:
+      state = json.load(file)
+    state['offset'] = os.path.getsize(partPath)
+    return state
+  except (OSError, ValueError):
+    return None
+
+def removePart(partPath):
+  for path in [partPath, f"{partPath}.json"]:
+    if os.path.exists(path):
+      os.remove(path)
+
+def parseContentRange(header):
+  """Returns (first byte, total length) of a 'bytes first-last/total' Content-Range header"""
+
+  byteRange, total = header.split(' ')[-1].split('/')
+
+  return int(byteRange.split('-')[0]), None if total == '*' else int(total)
+
+def downloadFile(url, path):
+  """
+  Downloads url to path through a .part file, resuming a previous partial download with a Range request
+  Returns the number of bytes received
+  """
+
+  partPath = f"{path}{PART_SUFFIX}"
+  state = readPartState(partPath)
+  headers = {}
+
+  if state and state['length'] is not None and state['offset'] == state['length']:
+    os.replace(partPath, path)
+    os.remove(f"{partPath}.json")
+    return 0
+
+  if state and state['offset']:
+    headers['Range'] = f"bytes={state['offset']}-"
+    validator = state['etag'] or state['last_modified']
+    if validator:
+      headers['If-Range'] = validator
+    print(f"Resuming {url} at {state['offset'] / 1024 ** 2:.1f} MB")
+
+  def handleResponse(response):
+    if response.status == 206:
+      start, length = parseContentRange(response.getheader('Content-Range', ''))
+      etag = response.getheader('ETag')
+
+      if not state or start != state['offset'] or length != state['length'] or (etag and state['etag'] and etag != state['etag']):
+        removePart(partPath)
+        raise Exception(f"Range response for {url} does not match the partial download, restarting it")
+
+      mode = 'ab'
+    else:
+      contentLength = response.getheader('Content-Length')
+      length = int(contentLength) if contentLength else None
+      mode = 'wb'
+
+      with open(f"{partPath}.json", 'w') as file:
+        json.dump({'etag': response.getheader('ETag'), 'last_modified': response.getheader('Last-Modified'), 'length': length}, file)
+
+    received = 0
+
+    with open(partPath, mode) as file:
+      while chunk := response.read(BUFFER_SIZE):
+        file.write(chunk)
+        received += len(chunk)
+
+    size = os.path.getsize(partPath)
+    if length is not None and size != length:
+      raise Exception(f"Download for {url} stopped at {size} of {length} bytes")
+
+    os.replace(partPath, path)
+    os.remove(f"{partPath}.json")
+
+    return received
+
+  try:
+    return httpGet(url, handleResponse, headers)
+  except HttpError as e:
+    # The saved length no longer matches the tile on the server, start again from scratch
+    if e.status == 416:
+      removePart(partPath)
+      raise Exception(f"Partial download of {url} is not valid anymore, restarting it")
+    raise
+
+def tilePath(url):
+  """Tiles are saved in a folder named after their project: {DESTINATION_FOLDER}/{project}/{tile}"""
+
+  parts = url.split('/')
+
+  return os.path.join(DESTINATION_FOLDER, parts[-3], parts[-1])
+
+def isTiff(path, size):
+  """Cheap GeoTIFF header check: a TIFF or BigTIFF signature and a first IFD offset inside the file"""
+
+  with open(path, 'rb') as file:
+    header = file.read(16)
+
+  if header[:4] not in TIFF_SIGNATURES:
+    return False
+
+  byteOrder = 'little' if header[:2] == b'II' else 'big'
+  bigTiff = header[2:4] in [b'+\x00', b'\x00+']
+  offset = int.from_bytes(header[8:16] if bigTiff else header[4:8], byteOrder)
+
+  return 8 <= offset < size
+
+def expectedSize(url):
+  """Returns the Content-Length the server reports for a tile, or None if it cannot be determined"""
+
+  try:
+    length = withRetries(f"HEAD request for {url}", lambda: httpGet(url, lambda response: response.getheader('Content-Length'), method='HEAD'), 2)
+  except Exception:
+    return None
+
+  return int(length) if length else None
+
+def loadPrescanCache():
+  try:
+    with open(os.path.join(DESTINATION_FOLDER, PRESCAN_CACHE)) as file:
+      return json.load(file)
+  except (OSError, ValueError):
+    return {}
+
+def savePrescanCache(cache):
+  path = os.path.join(DESTINATION_FOLDER, PRESCAN_CACHE)
+  os.makedirs(DESTINATION_FOLDER, exist_ok=True)
+
+  # Downloaded tiles are added to the cache under STATS_LOCK
+  with STATS_LOCK:
+    contents = dict(cache)
+
+  with open(f"{path}.tmp", 'w') as file:
+    json.dump(contents, file)
+  os.replace(f"{path}.tmp", path)
+
+def cacheTile(cache, url):
+  """Records a tile as valid in the pre-scan cache, with its size and modification time"""
+
+  path = tilePath(url)
+  stat = os.stat(path)
+  cache[os.path.relpath(path, DESTINATION_FOLDER)] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'valid': True}
+
+def checkTile(url, cache):
+  """Returns whether a tile has already been downloaded and is valid, using the cached result if the tile is unchanged"""
+
+  path = tilePath(url)
+  key = os.path.relpath(path, DESTINATION_FOLDER)
+
+  try:
+    stat = os.stat(path)
+  except FileNotFoundError:
+    return False
+
+  cached = cache.get(key)
+  if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+    return cached['valid']
+
+  if not isTiff(path, stat.st_size):
+    print(f"{path} is not a valid GeoTIFF, downloading it again")
+    cache[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'valid': False}
+    return False
+
+  expected = expectedSize(url)
+
+  if expected is not None and expected != stat.st_size:
+    print(f"{path} is {stat.st_size} bytes instead of {expected}, downloading it again")
+    cache[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'valid': False}
+    return False
+
+  # Only cached once the server confirmed the size, so the check is done again if the HEAD request failed
+  if expected is not None:
+    cache[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'valid': True}
+
+  return True
+
+def prescanTiles(urls, cache):
+  """Returns the tiles that are missing or invalid in the destination folder"""
+
+  pool = ThreadPool(PRESCAN_WORKERS)
+  results = pool.map(lambda url: checkTile(url, cache), urls)
+  pool.close()
+  pool.join()
+
+  return [url for url, valid in zip(urls, results) if not valid]
+
+def fetchDownloadList(project):
+  """
+  Returns the tile URLs of a project, revalidating the cached download list with the server (If-None-Match /
+  If-Modified-Since) and falling back to the cached list if the server cannot be reached
+  """
+
+  listPath = os.path.join(DESTINATION_FOLDER, LIST_CACHE_FOLDER, f"{project}.txt")
+  headers = {}
+
+  try:
+    with open(f"{listPath}.json") as file:
+      validators = json.load(file)
+    if os.path.isfile(listPath):
+      if validators['etag']:
+        headers['If-None-Match'] = validators['etag']
+      if validators['last_modified']:
+        headers['If-Modified-Since'] = validators['last_modified']
+  except (OSError, ValueError):
+    pass
+
+  def handleResponse(response):
+    if response.status == 304:
+      return False
+
+    contents = response.read()
+    os.makedirs(os.path.dirname(listPath), exist_ok=True)
+
+    with open(f"{listPath}.tmp", 'wb') as file:
+      file.write(contents)
+    os.replace(f"{listPath}.tmp", listPath)
+
+    with open(f"{listPath}.json", 'w') as file:
+      json.dump({'etag': response.getheader('ETag'), 'last_modified': response.getheader('Last-Modified')}, file)
+
+    return True
+
+  try:
+    fetched = withRetries(f"Download list for {project}", lambda: httpGet(DOWNLOAD_LIST_URL.format(project=project), handleResponse, headers), 3)
+    print(f"{'Fetched' if fetched else 'Using unchanged cached'} download list for {project}")
+  except Exception as e:
+    if not os.path.isfile(listPath):
+      print(f"Download list for {project} failed: {e}")
+      return project, []
+    print(f"Download list for {project} failed ({e}), using the cached list")
+
+  with open(listPath, 'rb') as file:
+    return project, [line.strip().decode("utf-8") for line in file if line.strip()]
+
+def utmCoordinates(lon, lat, zone):
+  """Projects WGS84 coordinates to a UTM zone (transverse Mercator, Snyder's series, accurate to the millimeter)"""
+
+  a = 6378137
+  f = 1 / 298.257223563
+  k0 = 0.9996
+  e2 = f * (2 - f)
+  ep2 = e2 / (1 - e2)
+
+  phi = math.radians(lat)
+  sinPhi = math.sin(phi)
+  cosPhi = math.cos(phi)
+  n = a / math.sqrt(1 - e2 * sinPhi ** 2)
+  t = math.tan(phi) ** 2
+  c = ep2 * cosPhi ** 2
+  A = cosPhi * math.radians(lon - (zone * 6 - 183))
+  m = a * (
+    (1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256) * phi
+    - (3 * e2 / 8 + 3 * e2 ** 2 / 32 + 45 * e2 ** 3 / 1024) * math.sin(2 * phi)
+    + (15 * e2 ** 2 / 256 + 45 * e2 ** 3 / 1024) * math.sin(4 * phi)
+    - (35 * e2 ** 3 / 3072) * math.sin(6 * phi)
+  )
+
+  easting = 500000 + k0 * n * (A + (1 - t + c) * A ** 3 / 6 + (5 - 18 * t + t ** 2 + 72 * c - 58 * ep2) * A ** 5 / 120)
+  northing = k0 * (m + n * math.tan(phi) * (
+    A ** 2 / 2 + (5 - t + 9 * c + 4 * c ** 2) * A ** 4 / 24 + (61 - 58 * t + t ** 2 + 600 * c - 330 * ep2) * A ** 6 / 720
+  ))
+
+  return easting, northing + (10000000 if lat < 0 else 0)
+
+def geometryPositions(geometry):
+  polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+
+  return [position for polygon in polygons for ring in polygon for position in ring]
+
+def loadProjectCounties(state):
+  """
+  Returns {project: [county boundary positions]} for the counties that the DEM allocation of a state assigns each
+  project to, or None if the allocation or the county boundaries are not available
+  """
+
+  allocationFile = DEM_ALLOCATION_FILE.format(state=state.replace(' ', '_'))
+
+  if not os.path.isfile(allocationFile) or not os.path.isfile(COUNTY_BOUNDARIES_FILE):
+    print(f"{allocationFile} or {COUNTY_BOUNDARIES_FILE} not found, downloading every tile of the projects")
+    return None
+
+  with open(COUNTY_BOUNDARIES_FILE) as file:
+    boundaries = {
+      (county['properties']['NAME'], county['properties']['LSAD'], county['properties']['STATE']): county['geometry']
+      for county in json.load(file)['features']
+    }
+
+  projectCounties = {}
+
+  with open(allocationFile, newline='') as file:
+    for county in csv.DictReader(file):
+      # Counties split into several groups of projects have the group number appended to their name
+      geometry = boundaries.get((re.sub(r'\d', '', county['name']), county['lsad'], county['state']))
+
+      if geometry is None:
+        print(f"No boundary found for {county['name']} {county['lsad']}, downloading every tile of its projects")
+
+      for project in county['projects'].split('|'):
+        projectCounties.setdefault(project, []).append(None if geometry is None else geometryPositions(geometry))
+
+  return projectCounties
+
+def countyExtent(positions, zone, extents):
+  """Returns the bounding box of a county in a UTM zone, buffered by TILE_FILTER_BUFFER meters"""
+
+  key = (id(positions), zone)
+
+  if key not in extents:
+    points = [utmCoordinates(lon, lat, zone) for lon, lat, *_ in positions]
+    extents[key] = (
+      min(x for x, y in points) - TILE_FILTER_BUFFER,
+      min(y for x, y in points) - TILE_FILTER_BUFFER,
+      max(x for x, y in points) + TILE_FILTER_BUFFER,
+      max(y for x, y in points) + TILE_FILTER_BUFFER,
+    )
+
+  return extents[key]
+
+def isTileNeeded(url, counties, extents):
+  """Whether the extent of a tile (from its name) intersects the buffered bounding box of one of the counties"""
+
+  match = TILE_NAME_PATTERN.search(url.split('/')[-1])
+  if not match or None in counties:
+    return True
+
+  zone = int(match.group(1))
+  left = int(match.group(2)) * TILE_SIZE
+  top = int(match.group(3)) * TILE_SIZE
+
+  for positions in counties:
+    minX, minY, maxX, maxY = countyExtent(positions, zone, extents)
+    if left <= maxX and left + TILE_SIZE >= minX and top - TILE_SIZE <= maxY and top >= minY:
+      return True
+
+  return False
+
+def formatRate(seconds):
+  with STATS_LOCK:
+    return f"{STATS['tiles']}/{STATS['queued']} tiles, {STATS['bytes'] / 1024 ** 3:.2f} GB in {seconds:.0f}s ({STATS['bytes'] / 1024 ** 2 / max(seconds, 1e-6):.1f} MB/s)"
+
+def reportProgress(done):
+  while not done.wait(PROGRESS_INTERVAL):
+    print(f"Downloaded {formatRate(time.time() - STATS['start'])}")
+
 def downloadTile(args):
   global DESTINATION_FOLDER
-  global URLS
 
-  (i, url) = args
+  (i, url, cache) = args
 
-  parts = url.split('/')
+  path = tilePath(url)
 
-  folder = os.path.join(DESTINATION_FOLDER, parts[-3])
+  folder = os.path.dirname(path)
   if not os.path.isdir(folder):
-    os.mkdir(folder)
-    print(f"Created {parts[-3]} folder")
+    os.makedirs(folder, exist_ok=True)
+    print(f"Created {os.path.basename(folder)} folder")
+
+  print(f"({i}/{STATS['queued']}) Downloading {url}...")
+
+  try:
+    size = withRetries(f"Download for {url}", lambda: downloadFile(url, path))
+  except Exception as e:
+    print(f"Download for {url} failed: {e}")
+    with STATS_LOCK:
+      STATS['failed'].append(url)
+    return
+
+  with STATS_LOCK:
+    STATS['tiles'] += 1
+    STATS['bytes'] += size
+    cacheTile(cache, url)
 
-  print(f"({i}/{len(URLS)}) Downloading {url}...")
+def downloadWorker(tiles):
+  while (args := tiles.get()) is not None:
+    downloadTile(args)
 
-  retry = True
+def stopWorkers(tiles, workers):
+  """Drops the tiles still queued, and tells every worker to stop once its current tile is done"""
 
-  while retry:
-    try: 
-      urllib.request.urlretrieve(url, os.path.join(folder, parts[-1]))
-      retry = False
-    except:
-      print(f"Download for {url} failed, retrying ({retry} more attempts)...")
+  while True:
+    try:
+      tiles.get_nowait()
+    except queue.Empty:
+      break
+
+  for worker in workers:
+    tiles.put(None)
 
 def main():
   global DESTINATION_FOLDER
@@ -55,37 +614,68 @@ def main():
 
   print(f"Found {len(stateProjects)} projects to download")
 
+  projectCounties = loadProjectCounties(state) if FILTER_TILES_BY_COUNTY else None
+  extents = {}
+
   URLS = set([])
+  cache = loadPrescanCache()
+  tiles = queue.Queue()
 
-  for i, p in enumerate(stateProjects):
-    print(f"({i + 1}/{len(stateProjects)}) Fetching download list for {p}...")
+  STATS['start'] = time.time()
+  done = threading.Event()
+  threading.Thread(target=reportProgress, args=(done,), daemon=True).start()
 
-    retry = 3
+  # Daemon threads, so that an interrupted run does not wait for the tiles being downloaded
+  workers = [threading.Thread(target=downloadWorker, args=(tiles,), daemon=True) for _ in range(threadCount)]
+  for worker in workers:
+    worker.start()
 
-    while retry > 0:
-      try: 
-        downloadLinksFileUrl = f"https://rockyweb.usgs.gov/vdelivery/Datasets/Staged/Elevation/1m/Projects/{p}/0_file_download_links.txt"
-        file = urllib.request.urlopen(downloadLinksFileUrl)
-        contents = file.readlines()
+  # Tiles of a project are checked and queued as soon as its download list arrives
+  listPool = ThreadPool(LIST_WORKERS)
 
-        print(f"Found {len(contents)} tiles to download")
+  try:
+    for i, (p, urls) in enumerate(listPool.imap_unordered(fetchDownloadList, stateProjects)):
+      neededUrls = urls
 
-        for j, line in enumerate(contents):
-          url = line.strip().decode("utf-8")
-          URLS.add(url)
+      # Projects missing from the allocation are not used by any county of the state
+      if projectCounties is not None:
+        neededUrls = [url for url in urls if isTileNeeded(url, projectCounties.get(p, []), extents)]
 
-        retry = 0
+      newUrls = sorted(set(neededUrls) - URLS)
+      URLS.update(newUrls)
+      missing = prescanTiles(newUrls, cache)
 
-      except:
-        retry -= 1
-        print(f"Download failed, retrying ({retry} more attempts)...")
+      print(f"({i + 1}/{len(stateProjects)}) Found {len(urls)} tiles in {p}, {len(urls) - len(neededUrls)} outside the counties, {len(missing)} to download ({len(newUrls) - len(missing)} already downloaded)")
 
-  print(f"Downloading {len(URLS)} tiles...")
+      for url in missing:
+        with STATS_LOCK:
+          STATS['queued'] += 1
+          tiles.put((STATS['queued'], url, cache))
 
-  pool = ThreadPool(threadCount)
-  pool.map(downloadTile, enumerate(URLS))
-  pool.close()
-  pool.join()
+    listPool.close()
+    savePrescanCache(cache)
+
+    for worker in workers:
+      tiles.put(None)
+    # Joined with a timeout, so that Ctrl+C is handled while waiting (on Windows too)
+    for worker in workers:
+      while worker.is_alive():
+        worker.join(1)
+  except KeyboardInterrupt:
+    print("Interrupted, the tiles being downloaded will resume on the next run")
+    listPool.terminate()
+    stopWorkers(tiles, workers)
+    raise
+  finally:
+    done.set()
+    savePrescanCache(cache)
+
+  print(f"Downloaded {formatRate(time.time() - STATS['start'])}")
+
+  if STATS['failed']:
+    print(f"{len(STATS['failed'])} tiles failed to download:")
+    for url in STATS['failed']:
+      print(url)
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main()
@@ -0,0 +1,232 @@
+"""
+Script Name: Action Locks
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Cross-process "action locks" used to limit how many Contouring.py processes may execute a step at the same time.
+Each action is a named counting semaphore: AddRastersToMosaicDataset fails when executed in parallel and has a
+capacity of 1, while heavy steps that merely contend for disk bandwidth (contouring, CAD export) may allow a few
+concurrent holders. Locks live in a shared folder (e.g. Z:\\Clearinghouse_Support\\python\\locks) so that every
+process on every machine using the share sees the same locks.
+
+Capacities are configured per action in Action_Locks.json (next to this script), e.g.:
+    {"AddRastersToMosaicDataset": 1, "Contour": 4, "ExportTiles": 3}
+A capacity of null disables the limit for that action, other capacities must be integers of at least 1. Actions
+missing from the file default to DEFAULT_CAPACITY.
+The file is re-read every time a lock is requested, so capacities can be tuned while a batch is running.
+
+How it works:
+- Every process that wants an action takes a numbered ticket. Ticket numbers are handed out under a short-lived
+  OS-level lock on `{action}.guard`, so tickets are strictly ordered (first come, first served).
+- Each ticket is a file in the `{action}` folder that its owner keeps locked with an OS-level advisory lock
+  (`msvcrt` on Windows, `fcntl` elsewhere) for as long as it waits for or holds the action.
+- The owners of the N oldest live tickets (N being the action's capacity) hold the action. Waiters check the queue every LOCK_POLL_INTERVAL seconds,
+  so the next process in line starts within a fraction of a second of the previous one releasing.
+- The OS releases a process's locks when it exits or is killed, so a ticket whose lock can be taken by someone else
+  belongs to a dead process. Such stale tickets are removed automatically instead of blocking the queue forever.
+"""
+
+import os
+import json
+import time
+import socket
+
+CAPACITIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Action_Locks.json')
+DEFAULT_CAPACITY = 1
+LOCK_POLL_INTERVAL = 0.2
+LOCK_STATUS_INTERVAL = 60
+# Byte offset that is locked in guard and ticket files. It lies past the file contents so that other processes can
+# still read the owner information (Windows byte-range locks also block reads of the locked range)
+LOCK_OFFSET = 1 << 20
+
+if os.name == 'nt':
+    import msvcrt
+
+    def try_lock_file(file):
+        """Attempts to take an exclusive lock on an open file without blocking, returns True on success"""
+
+        file.seek(LOCK_OFFSET)
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def unlock_file(file):
+        file.seek(LOCK_OFFSET)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def try_lock_file(file):
+        """Attempts to take an exclusive lock on an open file without blocking, returns True on success"""
+
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def unlock_file(file):
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+def lock_file(file):
+    """Takes an exclusive lock on an open file, waiting for as long as necessary"""
+
+    while not try_lock_file(file):
+        time.sleep(LOCK_POLL_INTERVAL / 10)
+
+def load_capacity(action, path=CAPACITIES_FILE):
+    """Returns the configured capacity of an action (None means unlimited)"""
+
+    if not os.path.isfile(path):
+        return DEFAULT_CAPACITY
+
+    with open(path) as file:
+        capacities = json.load(file)
+
+    capacity = capacities.get(action, DEFAULT_CAPACITY)
+
+    # A capacity of 0 would make every process wait in line forever
+    if capacity is not None and (not isinstance(capacity, int) or isinstance(capacity, bool) or capacity < 1):
+        raise ValueError(f'Invalid capacity {capacity!r} for action {action} in {path}, expected an integer of at least 1 or null')
+
+    return capacity
+
+def owner_description(owner):
+    return f"{owner} (host {socket.gethostname()}, pid {os.getpid()})"
+
+def read_ticket(path):
+    """Returns the owner information stored in a ticket file, or None if it can no longer be read"""
+
+    try:
+        with open(path) as file:
+            return json.loads(file.read() or 'null')
+    except (OSError, ValueError):
+        return None
+
+def take_ticket(locks_dir, action, owner):
+    """Hands out the next ticket for an action and returns the locked, open ticket file and its path"""
+
+    queue_dir = os.path.join(locks_dir, action)
+    os.makedirs(queue_dir, exist_ok=True)
+
+    with open(os.path.join(locks_dir, f'{action}.guard'), 'a+') as guard:
+        lock_file(guard)
+
+        try:
+            guard.seek(0)
+            number = int(guard.read().strip() or 0) + 1
+            guard.seek(0)
+            guard.truncate()
+            guard.write(str(number))
+            guard.flush()
+
+            path = os.path.join(queue_dir, f'{number:012d}.ticket')
+            ticket = open(path, 'w+')
+            ticket.write(json.dumps({'owner': owner, 'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}))
+            ticket.flush()
+
+            if not try_lock_file(ticket):
+                ticket.close()
+                raise Exception(f'Could not lock new ticket {path} for action {action}')
+        finally:
+            unlock_file(guard)
+
+    return ticket, path
+
+def is_stale(path):
+    """A ticket is stale if its lock can be taken, meaning the process that created it is gone"""
+
+    try:
+        with open(path, 'r+') as file:
+            if try_lock_file(file):
+                unlock_file(file)
+                return True
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # The file is open and locked by its (live) owner
+        return False
+
+    return False
+
+def tickets_ahead(queue_dir, ticket_path, log):
+    """Returns the live tickets ahead of the given ticket, removing any stale tickets found along the way"""
+
+    name = os.path.basename(ticket_path)
+    ahead = []
+
+    for other in sorted(os.listdir(queue_dir)):
+        if not other.endswith('.ticket') or other >= name:
+            continue
+
+        path = os.path.join(queue_dir, other)
+
+        if is_stale(path):
+            log(f'Removing stale lock ticket {path} ({read_ticket(path)})')
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        else:
+            ahead.append(path)
+
+    return ahead
+
+def acquire(locks_dir, action, owner, capacity=1, timeout=None, log=print):
+    """
+    Waits (first come, first served) until fewer than `capacity` processes hold the given action, and returns a lock
+    handle to pass to release()
+    Raises an exception if `timeout` seconds pass before the action becomes available
+    The number of seconds spent waiting is available as handle['wait']
+    """
+
+    start = time.time()
+    ticket, path = take_ticket(locks_dir, action, owner)
+    queue_dir = os.path.dirname(path)
+    last_status = None
+
+    try:
+        while True:
+            ahead = tickets_ahead(queue_dir, path, log)
+
+            if len(ahead) < capacity:
+                break
+
+            now = time.time()
+            holders = [read_ticket(p) for p in ahead[:capacity]]
+
+            if timeout is not None and now - start > timeout:
+                raise Exception(f'Could not acquire lock for action {action} within {timeout}s ({len(ahead)} ahead, held by {holders})')
+
+            if last_status is None or now - last_status >= LOCK_STATUS_INTERVAL:
+                log(f'Action {action} is currently locked by {holders} (capacity {capacity}), {len(ahead) - capacity + 1} ahead in queue. Waiting...')
+                last_status = now
+
+            time.sleep(LOCK_POLL_INTERVAL)
+    except BaseException:
+        release({'action': action, 'path': path, 'file': ticket})
+        raise
+
+    return {'action': action, 'path': path, 'file': ticket, 'owner': owner_description(owner), 'wait': time.time() - start}
+
+def release(handle):
+    """Releases a lock handle returned by acquire()"""
+
+    ticket = handle['file']
+
+    if not ticket.closed:
+        unlock_file(ticket)
+        ticket.close()
+
+    # On Windows the ticket cannot be deleted while a waiter briefly has it open to check for staleness. If it still
+    # cannot be deleted after a few attempts it is left behind unlocked, and the next waiter removes it as stale
+    for _ in range(10):
+        try:
+            os.remove(handle['path'])
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(LOCK_POLL_INTERVAL / 10)
@@ -0,0 +1,230 @@
+"""
+Script Name: Batch Queue
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Shared county job queue used by Contouring_Batch.py to distribute a batch over several workstations. The queue is a
+folder on a share every worker can reach (e.g. Z:\\Clearinghouse_Support\\queue), with one JSON file per county:
+
+    pending\\   counties waiting to be processed
+    claimed\\   counties currently being processed by a worker
+    done\\      counties that completed successfully
+    failed\\    counties that failed on every attempt
+
+Claim protocol:
+- A worker claims a county by renaming its file from pending\\ to claimed\\, adding its owner token to the name
+  (`{rank}__{STATE}__{COUNTY}__{CRS}~{token}.json`). Renames within a share are atomic, so when several workers try
+  to claim the same county, exactly one succeeds and the others move on to the next file. Every later operation of
+  the owner (heartbeat, completion) uses the name with its token, so it can never act on a claim another worker holds.
+- While a worker processes a county it refreshes the modification time of the claimed file every HEARTBEAT_SECONDS.
+- A claimed file that has not been refreshed for LEASE_SECONDS belongs to a worker that died (or whose machine went
+  down). Any worker reclaims it: the file is first renamed to a name private to the reclaiming worker, its
+  modification time is checked again (a heartbeat may have landed between the first check and the rename), and only
+  then is it renamed back to pending\\, where it is claimed again and resumed. If it was renewed, it is renamed back
+  to its claimed name. A heartbeat that finds its file missing retries for a moment to ride out that window.
+- A worker whose claimed file is gone for good (because its lease expired) has lost the county: it stops processing
+  it and never records an outcome for it.
+- Completing a county renames the owner's claimed file to done\\ or failed\\ first, so a lost claim cannot be completed.
+
+Pending files are named `{rank}__{STATE}__{COUNTY}__{CRS}.json`, where rank is the position of the county in the
+batch (largest first), so workers claim counties in batch order by taking the first file in name order.
+"""
+
+import os
+import json
+import time
+import socket
+
+HEARTBEAT_SECONDS = 60
+LEASE_SECONDS = 10 * 60
+# Number of times (one second apart) a heartbeat looks for a claimed file that is missing, e.g. while a reclaiming worker
+# checks it again
+HEARTBEAT_RETRIES = 5
+QUEUE_STATES = ['pending', 'claimed', 'done', 'failed']
+# Separates the pending file name from the owner token in claimed file names
+OWNER_SEPARATOR = '~'
+# Suffix of a claimed file while a worker is reclaiming it
+RECLAIMING_SUFFIX = '.reclaiming'
+
+def queue_path(queue_dir, state, name=''):
+    return os.path.join(queue_dir, state, name)
+
+def job_file_name(rank, job):
+    return f"{rank:05d}__{job['state']}__{job['county']}__{job['crs']}.json"
+
+def read_job_file(path):
+    with open(path) as file:
+        return json.load(file)
+
+def write_job_file(path, data):
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2)
+
+def owner_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+OWNER_TOKEN = f"{socket.gethostname()}-{os.getpid()}-{os.urandom(4).hex()}".replace(OWNER_SEPARATOR, '-')
+
+def claimed_name(name, token=OWNER_TOKEN):
+    """Name of a pending file once it has been claimed by the owner of token"""
+
+    return f"{name[:-len('.json')]}{OWNER_SEPARATOR}{token}.json"
+
+def pending_name(claim_name):
+    """Name of the pending file a claimed (or reclaiming) file came from"""
+
+    stem = claim_name.split(RECLAIMING_SUFFIX)[0][:-len('.json')]
+
+    return stem.split(OWNER_SEPARATOR)[0] + '.json'
+
+def enqueue(queue_dir, jobs):
+    """
+    Adds the given jobs (in order) to the pending queue
+    Counties that are already in the queue (in any state) are skipped. Returns the number of counties added
+    """
+
+    for state in QUEUE_STATES:
+        os.makedirs(queue_path(queue_dir, state), exist_ok=True)
+
+    existing = set()
+    ranks = [0]
+    for state in QUEUE_STATES:
+        for name in os.listdir(queue_path(queue_dir, state)):
+            # Claimed files carry the owner token of the worker that claimed them
+            rank, _, key = (pending_name(name) if OWNER_SEPARATOR in name else name).partition('__')
+            existing.add(key)
+            ranks.append(int(rank) if rank.isdigit() else 0)
+
+    added = 0
+    rank = max(ranks) + 1
+
+    for job in jobs:
+        name = job_file_name(rank, job)
+        key = name.partition('__')[2]
+
+        if key in existing:
+            continue
+
+        data = {'state': job['state'], 'county': job['county'], 'crs': job['crs'], 'heavy': job.get('heavy', False), 'claims': 0, 'history': []}
+        write_job_file(queue_path(queue_dir, 'pending', f'{name}.tmp'), data)
+        os.replace(queue_path(queue_dir, 'pending', f'{name}.tmp'), queue_path(queue_dir, 'pending', name))
+
+        existing.add(key)
+        added += 1
+        rank += 1
+
+    return added
+
+def claim(queue_dir, accept=None):
+    """
+    Claims the first pending county, returning (claimed file name, job data), or (None, None) if nothing is pending
+    accept(data), if given, decides whether a pending county may be claimed (e.g. not another memory heavy county)
+    Expired claims of dead workers are returned to the pending queue first
+    """
+
+    reclaim_expired(queue_dir)
+
+    for name in sorted(os.listdir(queue_path(queue_dir, 'pending'))):
+        if not name.endswith('.json'):
+            continue
+
+        if accept:
+            try:
+                if not accept(read_job_file(queue_path(queue_dir, 'pending', name))):
+                    continue
+            except (OSError, ValueError):
+                # Claimed by another worker (or still being written)
+                continue
+
+        claim_name = claimed_name(name)
+        claimed_path = queue_path(queue_dir, 'claimed', claim_name)
+
+        try:
+            os.rename(queue_path(queue_dir, 'pending', name), claimed_path)
+        except OSError:
+            # Another worker claimed it first
+            continue
+
+        try:
+            # Start the lease right away, the renamed file keeps the modification time of the pending file
+            os.utime(claimed_path)
+            data = read_job_file(claimed_path)
+            data['claims'] += 1
+            data['owner'] = owner_name()
+            data['history'].append({'event': 'claimed', 'owner': data['owner'], 'time': time.time()})
+            write_job_file(claimed_path, data)
+        except FileNotFoundError:
+            # The claim expired before it was confirmed (only possible if the pending file was very old)
+            continue
+
+        return claim_name, data
+
+    return None, None
+
+def heartbeat(queue_dir, claim_name):
+    """Renews the lease on a county claimed by this worker, returns False if the claim has been lost"""
+
+    for attempt in range(HEARTBEAT_RETRIES):
+        try:
+            os.utime(queue_path(queue_dir, 'claimed', claim_name))
+            return True
+        except FileNotFoundError:
+            # Another worker may be checking the claim again before reclaiming it, and put it back in a moment
+            time.sleep(1)
+
+    return False
+
+def reclaim_expired(queue_dir, lease_seconds=LEASE_SECONDS):
+    """Returns claimed counties whose lease has expired to the pending queue, returning their pending file names"""
+
+    reclaimed = []
+
+    for name in os.listdir(queue_path(queue_dir, 'claimed')):
+        path = queue_path(queue_dir, 'claimed', name)
+        # A reclaiming worker that died between its two renames leaves its private file behind
+        lease = 2 * lease_seconds if RECLAIMING_SUFFIX in name else lease_seconds
+
+        try:
+            if time.time() - os.stat(path).st_mtime < lease:
+                continue
+
+            private_path = path if RECLAIMING_SUFFIX in name else f"{path}{RECLAIMING_SUFFIX}-{OWNER_TOKEN}"
+            os.rename(path, private_path)
+        except OSError:
+            # Renewed, completed, or reclaimed by another worker in the meantime
+            continue
+
+        # A heartbeat may have renewed the claim between the check and the rename, the owner is still alive then
+        if time.time() - os.stat(private_path).st_mtime < lease:
+            os.rename(private_path, path)
+            continue
+
+        os.rename(private_path, queue_path(queue_dir, 'pending', pending_name(name)))
+        reclaimed.append(pending_name(name))
+
+    return reclaimed
+
+def complete(queue_dir, claim_name, state, **details):
+    """
+    Moves a county claimed by this worker to the done or failed folder, recording the outcome
+    Returns False (and changes nothing) if the claim has been lost
+    """
+
+    path = queue_path(queue_dir, state, pending_name(claim_name))
+
+    try:
+        # Moving the claimed file first makes sure it still belongs to this worker
+        os.rename(queue_path(queue_dir, 'claimed', claim_name), path)
+    except FileNotFoundError:
+        return False
+
+    data = read_job_file(path)
+    data['history'].append({'event': state, 'owner': owner_name(), 'time': time.time(), **details})
+    write_job_file(path, data)
+
+    return True
+
+def counts(queue_dir):
+    """Returns the number of counties in each queue state"""
+
+    return {state: len([n for n in os.listdir(queue_path(queue_dir, state)) if '.json' in n]) for state in QUEUE_STATES}
@@ -25,12 +25,25 @@ Usage:
     Example:
     python Z:\Clearinghouse_Support\python\Contouring.py.py SOUTH_CAROLINA Abbeville_County 6570
 
+   Add --stage to process the county on the local scratch disk (see Local Staging below):
+    python Z:\Clearinghouse_Support\python\Contouring.py SOUTH_CAROLINA Abbeville_County 6570 --stage
+
 2. Without Command-Line Arguments:
     Run the script directly. It will prompt for the state and county names:
     - Enter the state name (e.g., "SOUTH_CAROLINA").
     - Enter the county name (e.g., "Abbeville_Couty").
     - Enter the ID # of the target output state plane coordinate system (e.g. 6570 for South Carolina SP).
 
+Local Staging:
+With --stage (or STAGING_ENABLED), the county's Tif_Files_UTM folder is copied to STAGING_DIR on a local disk with
+parallel, checksummed copies, and every step reads and writes the local copy instead of the network share. Once all
+steps have completed, only the final outputs (PUBLISHED_OUTPUTS: shapefiles, DWG files, output geodatabase and index
+GeoJSON) are copied back to the county folder on the share. Each output is copied next to its destination first and
+then renamed into place, so the share never holds a partially published output. The log and progress files are
+always written to the county folder on the share. Resuming a staged county (--step) requires the staged working
+folder from the interrupted execution; if it does not exist on this machine, the county starts over from the first
+step.
+
 Notes:
 - This script overwrites existing output files if they already exist.
 - Modify the coordinate system or other parameters as needed for specific datasets.
@@ -46,11 +59,24 @@ import argparse
 import time
 import re
 import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import Action_Locks
+import County_Inputs
+import GeoJSON_Index_Writer
+import Transfer_Engine
 
 #region Config Vars
 DATA_DRIVE = 'Z'
 LOG_FILE = 'contouring.log'
+# Current and last completed step of the county, read by Contouring_Batch.py to resume interrupted counties
+PROGRESS_FILE = 'contouring_progress.json'
 LOCKS_DIR = 'Clearinghouse_Support/python/locks'
+# Shared history of step durations, used by Contouring_Batch.py to estimate the processing time of counties
+TIMINGS_FILE = 'Clearinghouse_Support/python/history/step_timings.jsonl'
+# Maximum number of seconds to wait in line for an action lock (None waits indefinitely, stale owners are detected automatically)
+ACTION_LOCK_TIMEOUT = None
 Z_FACTOR_METERS = 3.280839895
 Z_FACTOR_FEET = 1
 CONTOUR_INTERVAL = 1
@@ -85,10 +111,25 @@ DATA_LIMITS_FEATURE_CLASS = "Data_Limits"
 DATA_LIMITS_SP_FEATURE_CLASS = "Data_Limits_SP"
 
 CONTOURS_INDEX_JSON = "Contours_Index.geojson"
+# Write the index GeoJSON with the native streaming writer (projects to WGS84 and serializes in one pass)
+# instead of Project + FeaturesToJSON
+INDEX_NATIVE_WRITER = True
+INDEX_COORDINATE_PRECISION = 7
+# Pre-compressed siblings written alongside the index GeoJSON (allowed: 'gzip', 'br')
+INDEX_PRECOMPRESS = ['gzip']
 
 SHAPEFILE_OUTPUT_FOLDER = 'Shapefiles'
 DWG_OUTPUT_FOLDER = 'Dwg_Files'
 #endregion
+
+# region Local Staging
+# Process the county on a local disk instead of the network share (also enabled with --stage)
+STAGING_ENABLED = False
+STAGING_DIR = 'C:\\Contouring_Staging'
+STAGING_COPY_WORKERS = 8
+# Delete the local working folder once its outputs have been published
+STAGING_CLEANUP = True
+#endregion
 #endregion
 
 #region Global Input Vars
@@ -98,13 +139,18 @@ STATE = None
 LOCALITY = None
 TARGET_SP_COORDINATE_SYSTEM = None
 REPAIR_GEOMETRY = None
+# County folder on the share (inputs, log, progress and published outputs)
+COUNTY_DIR = None
+# Folder all steps work in: the county folder, or its local copy in staging mode
 BASE_DIR = None
 OUTPUT_GEODATABASE = None
 COORDINATE_SYSTEM_IS_METERS = None
 Z_FACTOR = None
 #endregion
 
-ACTION_LOCKS = []
+ACTION_LOCKS = {}
+CURRENT_STEP = None
+TIF_STATS = None
 
 STEPS = [
     'contouring_remove_legacy_files',
@@ -145,8 +191,8 @@ def clear_screen():
        
 def clear_log():
     """Clear messages from log file, if any"""
-    os.makedirs(BASE_DIR, exist_ok=True)  # Ensure the directory exists
-    log_file = os.path.join(BASE_DIR, LOG_FILE)
+    os.makedirs(COUNTY_DIR, exist_ok=True)  # Ensure the directory exists
+    log_file = os.path.join(COUNTY_DIR, LOG_FILE)
     if os.path.exists(log_file):
         os.remove(log_file)
     with open(log_file, "w") as f:
@@ -155,10 +201,10 @@ def clear_log():
 def log(message):
     """Print a log message to the console and to a log file"""
 
-    if not BASE_DIR:
+    if not COUNTY_DIR:
         raise ValueError("State and County names must be defined before logging.")
 
-    log_file = os.path.join(BASE_DIR, LOG_FILE)
+    log_file = os.path.join(COUNTY_DIR, LOG_FILE)
     
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     formatted_message = f"[{timestamp}] {message}"
@@ -168,7 +214,7 @@ def log(message):
 
     # Write to log file
     try:
-        os.makedirs(BASE_DIR, exist_ok=True)  # Ensure directory exists
+        os.makedirs(COUNTY_DIR, exist_ok=True)  # Ensure directory exists
         with open(log_file, "a") as file:  # Append mode
             file.write(formatted_message + "\n")
             file.flush()
@@ -185,6 +231,76 @@ def log_time(start_time, end_time):
     log(f"End Time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
     log(f"Total processing time: {int(hours)}h {int(minutes)}m {int(seconds)}s")
 
+def write_progress(current_step, last_completed_step):
+    """Atomically writes the county's progress file"""
+
+    progress_file = os.path.join(COUNTY_DIR, PROGRESS_FILE)
+    next_index = STEPS.index(last_completed_step) + 1 if last_completed_step else 0
+
+    progress = {
+        'state': STATE,
+        'locality': LOCALITY,
+        'crs': TARGET_SP_COORDINATE_SYSTEM,
+        'pid': os.getpid(),
+        'current_step': current_step,
+        'current_step_start': datetime.datetime.now().isoformat(timespec='seconds') if current_step else None,
+        'last_completed_step': last_completed_step,
+        'next_step': STEPS[next_index] if next_index < len(STEPS) else None,
+    }
+
+    try:
+        with open(f'{progress_file}.tmp', 'w') as file:
+            json.dump(progress, file, indent=2)
+        os.replace(f'{progress_file}.tmp', progress_file)
+    except Exception as e:
+        log(f"Failed to write progress to {progress_file}: {e}")
+
+def log_step(step):
+    """Logs the start of a processing step, and records the duration of the previous step"""
+
+    global CURRENT_STEP
+
+    finish_step()
+    log(f"STEP {STEPS.index(step)}. {step}")
+    CURRENT_STEP = (step, datetime.datetime.now())
+
+    # Steps are executed in order, so every step before this one is either completed or was skipped
+    write_progress(step, STEPS[STEPS.index(step) - 1] if STEPS.index(step) > 0 else None)
+
+def finish_step():
+    """Appends the duration of the current step (if any) to the shared step timings history"""
+
+    global CURRENT_STEP, TIF_STATS
+
+    if not CURRENT_STEP:
+        return
+
+    step, start_time = CURRENT_STEP
+    end_time = datetime.datetime.now()
+    CURRENT_STEP = None
+
+    if TIF_STATS is None:
+        TIF_STATS = County_Inputs.read_tif_stats(COUNTY_DIR)
+
+    record = {
+        'time': end_time.isoformat(timespec='seconds'),
+        'state': STATE,
+        'locality': LOCALITY,
+        'crs': TARGET_SP_COORDINATE_SYSTEM,
+        'step': step,
+        'seconds': round((end_time - start_time).total_seconds(), 1),
+        **TIF_STATS,
+    }
+
+    timings_file = os.path.join(f'{DATA_DRIVE}:\\', TIMINGS_FILE)
+
+    try:
+        os.makedirs(os.path.dirname(timings_file), exist_ok=True)
+        with open(timings_file, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+    except Exception as e:
+        log(f"Failed to record step timing to {timings_file}: {e}")
+
 def clear_folder_contents(path):
     """
     Deletes all files and subdirectories in the given folder.
@@ -264,7 +380,7 @@ def intro_message():
 def get_inputs():
     """Parses command line arguments and if necessary ask questions and collect inputs from the CLI"""
 
-    global MODE, STEP, STATE, LOCALITY, TARGET_SP_COORDINATE_SYSTEM, BASE_DIR, OUTPUT_GEODATABASE, SHAPEFILE_OUTPUT_FOLDER, DWG_OUTPUT_FOLDER
+    global MODE, STEP, STATE, LOCALITY, TARGET_SP_COORDINATE_SYSTEM, COUNTY_DIR, BASE_DIR, OUTPUT_GEODATABASE, SHAPEFILE_OUTPUT_FOLDER, DWG_OUTPUT_FOLDER, STAGING_ENABLED
 
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument(
@@ -297,6 +413,11 @@ def get_inputs():
         action='store_true',
         help="Run the repair geometry step"
     )
+    parser.add_argument(
+        '--stage',
+        action='store_true',
+        help=f"Process the county on the local disk ({STAGING_DIR}) and publish the final outputs to the share"
+    )
     parser.add_argument(
         '--dry-run',
         action='store_true',
@@ -325,7 +446,9 @@ def get_inputs():
         LOCALITY = input("Enter the Locality Folder Name: ").strip()
         TARGET_SP_COORDINATE_SYSTEM = input("Enter the ID # of the target output state plane coordinate system (e.g. 6570 for South Carolina SP): ")
     
-    BASE_DIR = os.path.join(f'{DATA_DRIVE}:\\', STATE, f'{LOCALITY}_Contours')
+    STAGING_ENABLED = STAGING_ENABLED or args.stage
+    COUNTY_DIR = os.path.join(f'{DATA_DRIVE}:\\', STATE, f'{LOCALITY}_Contours')
+    BASE_DIR = os.path.join(STAGING_DIR, STATE, f'{LOCALITY}_Contours') if STAGING_ENABLED else COUNTY_DIR
     OUTPUT_GEODATABASE = f'{LOCALITY}_Contours.gdb'
 
     clear_log()
@@ -336,7 +459,9 @@ def get_inputs():
     log(f'Mode: {MODE}')
     log(f'State: {STATE}')
     log(f'Locality: {LOCALITY}')
-    log(f'Folder Location: {BASE_DIR}')
+    log(f'Folder Location: {COUNTY_DIR}')
+    if STAGING_ENABLED:
+        log(f'Staging Location: {BASE_DIR}')
     log(f'SPCS: {TARGET_SP_COORDINATE_SYSTEM}')
     log(f'Tile Index Location: {locate_spcs_grid()}')
     print()
@@ -345,55 +470,169 @@ def get_inputs():
     if args.dry_run:
         sys.exit(0)
 
-def acquire_action_lock(action):
-    log(f'Attempting to acquire lock for action {action}')
+    write_progress(None, STEPS[STEP - 1] if STEP > 0 else None)
 
-    os.makedirs(os.path.join(f'{DATA_DRIVE}:\\', LOCKS_DIR), exist_ok=True)
-
-    lock_file = os.path.join(f'{DATA_DRIVE}:\\', LOCKS_DIR, f'{action}.lock')
+def acquire_action_lock(action):
+    """
+    Waits in line for the given action, shared with all other Contouring.py processes
+    The number of processes allowed to hold an action at the same time is configured in Action_Locks.json
+    Returns False without taking a lock if the action has no concurrency limit (nothing to release then)
+    """
 
-    retries = 4 * 15 # Wait for up to 15 minutes
+    capacity = Action_Locks.load_capacity(action)
 
-    while os.path.isfile(lock_file):
-        with open(lock_file) as f: content = f.read()
-        
-        if retries == 0:
-            raise Exception(f'Could not acquire lock for action {action} ({content})')
+    if capacity is None:
+        log(f'Action {action} has no concurrency limit, skipping lock')
+        return False
 
-        retries -= 1
-        log(f"Action {action} is currently locked ({content}). Retrying in 15 seconds...")
-        time.sleep(15)
+    log(f'Attempting to acquire lock for action {action} (capacity {capacity})')
 
-    with open(lock_file, "w+") as file:
-        file.write(f"{STATE} {LOCALITY} {TARGET_SP_COORDINATE_SYSTEM}")
-        file.flush()
-        log(f'Acquired lock for action {action}')
+    handle = Action_Locks.acquire(
+        locks_dir=os.path.join(f'{DATA_DRIVE}:\\', LOCKS_DIR),
+        action=action,
+        owner=f"{STATE} {LOCALITY} {TARGET_SP_COORDINATE_SYSTEM}",
+        capacity=capacity,
+        timeout=ACTION_LOCK_TIMEOUT,
+        log=log
+    )
 
-    ACTION_LOCKS.append(action)
+    ACTION_LOCKS[action] = handle
+    log(f"Acquired lock for action {action} after waiting {handle['wait']:.1f}s")
 
     return True
 
 def release_action_lock(action, fail_on_miss = True):
-    lock_file = os.path.join(f'{DATA_DRIVE}:\\', LOCKS_DIR, f'{action}.lock')
-
-    if not os.path.isfile(lock_file):
+    if action not in ACTION_LOCKS:
         if fail_on_miss:
-            raise Exception(f'Could not find lock file for action {action}')
+            raise Exception(f'Lock for action {action} is not held by this process, could not release')
         else:
             return False
 
-    with open(lock_file) as f: content = f.read()
-        
-    if content == f"{STATE} {LOCALITY} {TARGET_SP_COORDINATE_SYSTEM}":
-        os.remove(lock_file)
-        ACTION_LOCKS.remove(action)
-        log(f'Releasing lock for action {action}')
-        return True
-    else:
-        raise Exception(f'Lock file for action {action} is owned by another process ({content}), could not release')
+    Action_Locks.release(ACTION_LOCKS.pop(action))
+    log(f'Releasing lock for action {action}')
+
+    return True
 
 #endregion
 
+#region Local Staging
+def copy_file_verified(source, destination):
+    """
+    Copies a file with the verified copy of the transfer engine: the data is hashed as it is read, and the checksum of
+    the copy is verified before it is renamed into place. Returns the number of bytes copied
+    """
+
+    size, digest = Transfer_Engine.copy_file_verified(source, destination, verify=True)
+
+    return size
+
+def copy_tree_verified(source_dir, destination_dir, skip_unchanged=False):
+    """
+    Copies a folder with STAGING_COPY_WORKERS parallel, checksummed file copies
+    With skip_unchanged, files whose copy already has the same size and modification time are not copied again
+    Returns the number of files and bytes copied
+    """
+
+    copies = []
+
+    for root, dirs, files in os.walk(source_dir):
+        target_root = os.path.join(destination_dir, os.path.relpath(root, source_dir))
+        os.makedirs(target_root, exist_ok=True)
+
+        for file in files:
+            source = os.path.join(root, file)
+            destination = os.path.join(target_root, file)
+
+            if skip_unchanged and os.path.isfile(destination):
+                source_stat = os.stat(source)
+                destination_stat = os.stat(destination)
+                if source_stat.st_size == destination_stat.st_size and int(source_stat.st_mtime) == int(destination_stat.st_mtime):
+                    continue
+
+            copies.append((source, destination))
+
+    with ThreadPoolExecutor(max_workers=STAGING_COPY_WORKERS) as executor:
+        sizes = list(executor.map(lambda copy: copy_file_verified(*copy), copies))
+
+    return len(copies), sum(sizes)
+
+def stage_inputs():
+    """Copies the county's input DEMs to the local staging folder"""
+
+    global STEP
+
+    # The intermediate data of an interrupted execution only exists in the staging folder of the machine it ran on
+    if STEP > 0 and not os.path.isdir(os.path.join(BASE_DIR, CONTOURS_WIP_GEODATABASE)):
+        log(f'Staged working folder {BASE_DIR} from a previous execution not found, starting over from Step 0. {STEPS[0]}')
+        STEP = 0
+
+    source = os.path.join(COUNTY_DIR, TIF_FILES)
+    destination = os.path.join(BASE_DIR, TIF_FILES)
+
+    log(f'Staging {source} to {destination}')
+    start_time = time.time()
+    count, size = copy_tree_verified(source, destination, skip_unchanged=True)
+    seconds = max(time.time() - start_time, 0.001)
+    log(f'Staged {count} files ({size / 1024 ** 3:.2f} GB) in {seconds:.1f}s ({size / 1024 ** 2 / seconds:.1f} MB/s)')
+
+def published_outputs():
+    """Returns the names of the outputs that are copied back to the share after a staged execution"""
+
+    index_geojson = f"{LOCALITY}_{CONTOURS_INDEX_JSON}"
+
+    return [
+        SHAPEFILE_OUTPUT_FOLDER,
+        DWG_OUTPUT_FOLDER,
+        OUTPUT_GEODATABASE,
+        index_geojson,
+    ] + [index_geojson + extension for extension in GeoJSON_Index_Writer.COMPRESSION_EXTENSIONS.values()]
+
+def publish_outputs():
+    """
+    Copies the final outputs from the staging folder to the county folder on the share
+    Each output is copied next to its destination and then renamed into place, replacing the output of a previous
+    execution, so readers of the share never see a partially published output
+    """
+
+    log(f'Publishing outputs from {BASE_DIR} to {COUNTY_DIR}')
+
+    for name in published_outputs():
+        source = os.path.join(BASE_DIR, name)
+        destination = os.path.join(COUNTY_DIR, name)
+        temp_path = f'{destination}.publishing'
+        old_path = f'{destination}.old'
+
+        if not os.path.exists(source):
+            continue
+
+        for path in [temp_path, old_path]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+        start_time = time.time()
+        if os.path.isdir(source):
+            count, size = copy_tree_verified(source, temp_path)
+        else:
+            count, size = 1, copy_file_verified(source, temp_path)
+
+        if os.path.exists(destination):
+            os.rename(destination, old_path)
+        os.rename(temp_path, destination)
+
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path)
+        elif os.path.exists(old_path):
+            os.remove(old_path)
+
+        log(f'Published {name} ({count} files, {size / 1024 ** 2:.1f} MB) in {time.time() - start_time:.1f}s')
+
+    if STAGING_CLEANUP:
+        log(f'Removing staging folder {BASE_DIR}')
+        shutil.rmtree(BASE_DIR, ignore_errors=True)
+#endregion
+
 #region ArcPy Helper Functions
 def setup_arcpy():
     """Set environment variables and check out necessary licenses for ArcPy"""
@@ -496,7 +735,7 @@ def contouring_remove_legacy_files():
     Delete all previous Legacy, Work-In-Progress, and Output files related to contour lines from previous executions
     """
 
-    log(f"STEP {STEPS.index('contouring_remove_legacy_files')}. contouring_remove_legacy_files")
+    log_step('contouring_remove_legacy_files')
 
     # Delete legacy Geodatabases if any
     work_in_progress_geodatabase = os.path.join(BASE_DIR, "Contours_Work_In_Progress.gdb")
@@ -514,7 +753,7 @@ def contouring_remove_legacy_files():
 def contouring_create_wip_geodatabase():
     """Create Contours WIP Geodatabase"""
 
-    log(f"STEP {STEPS.index('contouring_create_wip_geodatabase')}. contouring_create_wip_geodatabase")
+    log_step('contouring_create_wip_geodatabase')
 
     contours_wip_geodatabase = os.path.join(BASE_DIR, CONTOURS_WIP_GEODATABASE)
 
@@ -529,7 +768,7 @@ def contouring_create_wip_geodatabase():
 def contouring_set_tif_nodata_values():
     """Set standard NoData value for all .tif files"""
 
-    log(f"STEP {STEPS.index('contouring_set_tif_nodata_values')}. contouring_set_tif_nodata_values")
+    log_step('contouring_set_tif_nodata_values')
 
     tif_files_dir = os.path.join(BASE_DIR, TIF_FILES)
     tif_files = os.listdir(tif_files_dir)
@@ -543,7 +782,7 @@ def contouring_set_tif_nodata_values():
 def contouring_create_mosaic_dataset(mosaic_dataset):
     """Create mosaic dataset from Tif Files"""
     
-    log(f"STEP {STEPS.index('contouring_create_mosaic_dataset')}. contouring_create_mosaic_dataset")
+    log_step('contouring_create_mosaic_dataset')
 
     # Delete old mosaic dataset, if exists
     if arcpy_delete(mosaic_dataset):
@@ -562,9 +801,9 @@ def contouring_create_mosaic_dataset(mosaic_dataset):
     )
 
 def contouring_add_rasters_to_mosaic_dataset(mosaic_dataset):
-    log(f"STEP {STEPS.index('contouring_add_rasters_to_mosaic_dataset')}. contouring_add_rasters_to_mosaic_dataset")
+    log_step('contouring_add_rasters_to_mosaic_dataset')
 
-    acquire_action_lock('AddRastersToMosaicDataset')
+    locked = acquire_action_lock('AddRastersToMosaicDataset')
 
     tif_files_dir = os.path.join(BASE_DIR, TIF_FILES)
 
@@ -577,10 +816,11 @@ def contouring_add_rasters_to_mosaic_dataset(mosaic_dataset):
         input_path=tif_files_dir
     )
 
-    release_action_lock('AddRastersToMosaicDataset')
+    if locked:
+        release_action_lock('AddRastersToMosaicDataset')
 
 def contouring_define_nodata(input_path):
-    log(f"STEP {STEPS.index('contouring_define_nodata')}. contouring_define_nodata")
+    log_step('contouring_define_nodata')
 
     log("Defining mosaic dataset NoData values")
     md_nodata = arcpy.management.DefineMosaicDatasetNoData(
@@ -594,7 +834,7 @@ def contouring_define_nodata(input_path):
 def contouring_calculate_raster_statistics(input_path):
     """Calculate raster statistics on mosaic dataset"""
 
-    log(f"STEP {STEPS.index('contouring_calculate_raster_statistics')}. contouring_calculate_raster_statistics")
+    log_step('contouring_calculate_raster_statistics')
 
     # Set this to ZERO so LocalWorker.exe doesn't go crazy
     arcpy.env.parallelProcessingFactor = 0
@@ -611,11 +851,13 @@ def contouring_calculate_raster_statistics(input_path):
 def contouring_generate(input_path, output_path):
     """Generate contour lines from mosaic dataset"""
 
-    log(f"STEP {STEPS.index('contouring_generate')}. contouring_generate")
+    log_step('contouring_generate')
 
     if arcpy_delete(output_path):
         compact_geodatabase(os.path.join(BASE_DIR, CONTOURS_WIP_GEODATABASE))
 
+    locked = acquire_action_lock('Contour')
+
     log("Starting Contour process.")
     arcpy.ddd.Contour(
         in_raster=input_path,
@@ -626,10 +868,13 @@ def contouring_generate(input_path, output_path):
     )
     log(f"Contour process completed. Output: {output_path}")
 
+    if locked:
+        release_action_lock('Contour')
+
 def contouring_filter(input_path):
     """"""
     
-    log(f"STEP {STEPS.index('contouring_filter')}. contouring_filter")
+    log_step('contouring_filter')
 
     # Select Layer By Attribute
     min_length = MIN_ATTRIBUTE_LENGTH * (Z_FACTOR_METERS / Z_FACTOR)
@@ -647,7 +892,7 @@ def contouring_filter(input_path):
     log("Selected features deleted.")
 
 def contouring_create_wip_sp_geodatabase():
-    log(f"STEP {STEPS.index('contouring_create_wip_sp_geodatabase')}. contouring_create_wip_sp_geodatabase")
+    log_step('contouring_create_wip_sp_geodatabase')
 
     contours_wip_sp_geodatabase = os.path.join(BASE_DIR, CONTOURS_WIP_SP_GEODATABASE)
     if arcpy.Exists(contours_wip_sp_geodatabase):
@@ -667,7 +912,7 @@ def contouring_create_wip_sp_geodatabase():
     )
 
 def contouring_project(input_path, output_path):
-    log(f"STEP {STEPS.index('contouring_project')}. contouring_project")
+    log_step('contouring_project')
 
     log("Projecting contour lines.")
     arcpy.management.Project(
@@ -686,6 +931,8 @@ def contouring_project(input_path, output_path):
     log(f"Recalculation of Feature Class Extent completed. Output: {output_path}")
  
 def contouring_repair_geometry(input_path):
+    log_step('contouring_repair_geometry')
+
     log("Repairing Geometry.")
     arcpy.management.RepairGeometry(
         in_features=input_path
@@ -693,7 +940,7 @@ def contouring_repair_geometry(input_path):
     log(f"Repairing of Geometry completed. Output: {input_path}")
 
 def contouring_add_data_fields(input_path):
-    log(f"STEP {STEPS.index('contouring_add_data_fields')}. contouring_add_data_fields")
+    log_step('contouring_add_data_fields')
 
     log("Adding and calculating Elevation field.")
     arcpy.management.AddField(
@@ -740,7 +987,7 @@ def contouring_add_data_fields(input_path):
     log("Line_Type field reclassified.")
 
 def contouring_cleanup_data_fields(input_path):
-    log(f"STEP {STEPS.index('contouring_cleanup_data_fields')}. contouring_cleanup_data_fields")
+    log_step('contouring_cleanup_data_fields')
 
     log("Deleting unnecessary fields.")
     arcpy.management.DeleteField(
@@ -750,7 +997,7 @@ def contouring_cleanup_data_fields(input_path):
     log("Fields deleted.")
 
 def contouring_create_output_geodatabase():
-    log(f"STEP {STEPS.index('contouring_create_output_geodatabase')}. contouring_create_output_geodatabase")
+    log_step('contouring_create_output_geodatabase')
 
     output_geodatabase = os.path.join(BASE_DIR, OUTPUT_GEODATABASE)
     if arcpy.Exists(output_geodatabase):
@@ -796,7 +1043,7 @@ def contouring_create_output_geodatabase():
     )
     
 def contouring_split(input_path, output_path, split_path, split_field):
-    log(f"STEP {STEPS.index('contouring_split')}. contouring_split")
+    log_step('contouring_split')
 
     log("Splitting contour lines.")
     arcpy.analysis.Split(
@@ -810,7 +1057,7 @@ def contouring_split(input_path, output_path, split_path, split_field):
     return output_path
 
 def contouring_export_tiles(input_path):
-    log(f"STEP {STEPS.index('contouring_export_tiles')}. contouring_export_tiles")
+    log_step('contouring_export_tiles')
 
     log("Iterating through all line feature classes in the specified dataset.")
         
@@ -823,6 +1070,9 @@ def contouring_export_tiles(input_path):
     orig_fid_deleted_count = 0
     geometry_recalculated_count = 0
         
+    # Exporting hundreds of shapefiles and DWGs is disk bound, limit how many counties do it at the same time
+    locked = acquire_action_lock('ExportTiles')
+
     log("Starting export and processing of shapefiles and DWGs...")
 
     shapefile_output_folder = os.path.join(BASE_DIR, SHAPEFILE_OUTPUT_FOLDER)
@@ -897,6 +1147,9 @@ def contouring_export_tiles(input_path):
     log(f"Exported {dwg_1ft_count} DWG files (1Ft)")
     log(f"Exported {dwg_2ft_count} DWG files (2Ft)")
 
+    if locked:
+        release_action_lock('ExportTiles')
+
 def contouring_cleanup_auxiliary_files(path, extensions):
     log(f"Cleaning up auxiliary files ({', '.join(extensions)}) in the output path {path}")
 
@@ -920,7 +1173,7 @@ def contouring_cleanup_auxiliary_files(path, extensions):
 def index_remove_legacy_files():
     """Delete all previous Work-In-Progress and Output files related to the contour tile index from previous executions"""
 
-    log(f"STEP {STEPS.index('index_remove_legacy_files')}. index_remove_legacy_files")
+    log_step('index_remove_legacy_files')
 
     # Delete all mosaic boundary files, if any present
     mosaic_boundary = os.path.join(BASE_DIR, OUTPUT_GEODATABASE, MOSAIC_BOUNDARY_FEATURE_CLASS)
@@ -949,9 +1202,10 @@ def index_remove_legacy_files():
     # Delete geojson index if present
     boundary_geojson = os.path.join(BASE_DIR, f"{LOCALITY}_{CONTOURS_INDEX_JSON}")
     arcpy_delete(boundary_geojson)
+    GeoJSON_Index_Writer.remove_precompressed_siblings(boundary_geojson)
 
 def index_build_footprints(input_path):
-    log(f"STEP {STEPS.index('index_build_footprints')}. index_build_footprints")
+    log_step('index_build_footprints')
 
     log("Building mosaic dataset footprints")
     arcpy.management.BuildFootprints(
@@ -971,37 +1225,37 @@ def index_build_footprints(input_path):
     )[0]
 
 def index_export_boundary(input_path, output_path):
-    log(f"STEP {STEPS.index('index_export_boundary')}. index_export_boundary")
+    log_step('index_export_boundary')
 
     log("Exporting mosaic boundary geometry")
     arcpy.management.ExportMosaicDatasetGeometry(input_path, output_path)
 
 def index_project_sp(input_path, output_path, spatial_reference):
-    log(f"STEP {STEPS.index('index_project_sp')}. index_project_sp")
+    log_step('index_project_sp')
 
     log(f"Projecting to {spatial_reference}")
     arcpy.management.Project(input_path, output_path, spatial_reference)
 
 def index_intersect(input_path, index_path, output_path):
-    log(f"STEP {STEPS.index('index_intersect')}. index_intersect")
+    log_step('index_intersect')
 
     log("Intersecting boundaries with index")
     arcpy.analysis.Intersect([[input_path, ""], [index_path, ""]], output_path)
 
 def index_dissolve(input_path, output_path):
-    log(f"STEP {STEPS.index('index_dissolve')}. index_dissolve")
+    log_step('index_dissolve')
 
     log("Dissolving data limits")
     arcpy.management.Dissolve(input_path, output_path)
 
 def index_clip(input_path, clip_path, output_path):
-    log(f"STEP {STEPS.index('index_clip')}. index_clip")
+    log_step('index_clip')
 
     log("Clipping index features")
     arcpy.analysis.Clip(input_path, clip_path, output_path)
 
 def index_remove_empty_tiles():
-    log(f"STEP {STEPS.index('index_remove_empty_tiles')}. index_remove_empty_tiles")
+    log_step('index_remove_empty_tiles')
 
     log(f'Selecting non-intersecting features between {TILE_INDEX_W_LIMITS_FEATURE_CLASS} and {CONTOURS_SP_FEATURE_DATASET}')
     empty_tiles = arcpy.management.SelectLayerByLocation(
@@ -1019,20 +1273,32 @@ def index_remove_empty_tiles():
     log(f'{count} Empty tiles deleted')
 
 def index_cleanup_data_fields(input_path):
-    log(f"STEP {STEPS.index('index_cleanup_data_fields')}. index_cleanup_data_fields")
+    log_step('index_cleanup_data_fields')
 
     log("Cleaning up fields")
     fields_to_delete = ["LABEL_X", "LABEL_Y", "NAME_X", "NAME_Y"]
     arcpy.management.DeleteField(input_path, fields_to_delete)[0]
 
 def index_project_wgs84(input_path, output_path):
-    log(f"STEP {STEPS.index('index_project_wgs84')}. index_project_wgs84")
+    log_step('index_project_wgs84')
 
     log("Projecting to WGS84")
     arcpy.management.Project(input_path, output_path, 4326)  # WGS84
 
 def index_export_geojson(input_path, output_path):
-    log(f"STEP {STEPS.index('index_export_geojson')}. index_export_geojson")
+    log_step('index_export_geojson')
+
+    if INDEX_NATIVE_WRITER:
+        log(f"Generating final GeoJSON (WGS84, {INDEX_COORDINATE_PRECISION} decimals, pre-compressed: {', '.join(INDEX_PRECOMPRESS) or 'none'})")
+        count = GeoJSON_Index_Writer.export_feature_class(
+            input_path,
+            output_path,
+            precision=INDEX_COORDINATE_PRECISION,
+            compress=INDEX_PRECOMPRESS,
+            log=log
+        )
+        log(f"Wrote {count} index features to {output_path}")
+        return
 
     log("Generating final GeoJSON")
     arcpy.conversion.FeaturesToJSON(
@@ -1124,7 +1390,7 @@ def process_contour_lines():
         contouring_export_tiles(input_path=contour_tiles_feature_dataset)
 
     if STEP <= STEPS.index('contouring_cleanup_auxiliary_files'):
-        log(f"STEP {STEPS.index('contouring_cleanup_auxiliary_files')}. contouring_cleanup_auxiliary_files")
+        log_step('contouring_cleanup_auxiliary_files')
         contouring_cleanup_auxiliary_files(os.path.join(BASE_DIR, SHAPEFILE_OUTPUT_FOLDER), SHAPEFILE_AUX_EXTENSIONS)
         contouring_cleanup_auxiliary_files(os.path.join(BASE_DIR, DWG_OUTPUT_FOLDER), DWG_AUX_EXTENSIONS)
 
@@ -1173,12 +1439,16 @@ def process_boundary_index():
     index_wgs = os.path.join(BASE_DIR, OUTPUT_GEODATABASE, TILE_INDEX_WGS_FEATURE_CLASS)
     
     if STEP <= STEPS.index('index_project_wgs84'):
-        index_project_wgs84(input_path=clipped, output_path=index_wgs)
+        if INDEX_NATIVE_WRITER:
+            # The native writer projects to WGS84 while writing the GeoJSON
+            log(f"SKIPPING STEP {STEPS.index('index_project_wgs84')}. index_project_wgs84")
+        else:
+            index_project_wgs84(input_path=clipped, output_path=index_wgs)
 
     boundary_geojson = os.path.join(BASE_DIR, f"{LOCALITY}_{CONTOURS_INDEX_JSON}")
     
     if STEP <= STEPS.index('index_export_geojson'):
-        index_export_geojson(input_path=index_wgs, output_path=boundary_geojson)
+        index_export_geojson(input_path=clipped if INDEX_NATIVE_WRITER else index_wgs, output_path=boundary_geojson)
 #endregion
 
 #region Main
@@ -1191,13 +1461,23 @@ def main():
     try:
         intro_message()
         setup_arcpy()
+
+        if STAGING_ENABLED:
+            stage_inputs()
+
         process_contour_lines()
         process_boundary_index()
+        finish_step()
+
+        if STAGING_ENABLED:
+            publish_outputs()
+
+        write_progress(None, STEPS[-1])
     except Exception as e:
         log(f"An error occurred: {str(e)}")
         raise e
     finally:
-        for step in ACTION_LOCKS:
+        for step in list(ACTION_LOCKS):
             release_action_lock(step, fail_on_miss=False)
 
         cleanup_arcpy()
@@ -26,6 +26,8 @@ Syntax Example:
 		.\Contouring_Batch.ps1 .\ALABAMA.csv
 		
 Notes:
+		Superseded by Contouring_Batch.py, which starts counties based on free memory/CPU/disk, records exit codes
+		and retries failed counties. This script is kept for reference.
 		The script will open 4 minimized windows doing the contouring process for counties.
 		The main dashboard screen will show current processing counties until it finishes.
 
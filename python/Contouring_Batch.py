@@ -0,0 +1,1022 @@
+"""
+Script Name: Contouring Batch Scheduler
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Runs Contouring.py for every county listed in a batch CSV file, replacing Contouring_Batch.ps1. Instead of a fixed
+number of parallel processes checked once a minute, a new county is started whenever the machine has room for it
+(free memory, CPU load and free disk space on the data drive), and finished processes are handled the moment they
+exit. The exit code of every run is recorded, and failed counties are retried with an exponential backoff.
+
+Counties are started largest first: before the batch starts, the processing time of every county is estimated from
+the shared step timings history recorded by Contouring.py. Steps the county itself has been through before (e.g. an
+earlier attempt) are estimated with their recorded durations. The other steps use a cost model per step, fitted over
+the history of all counties: a fixed overhead, plus a time per input DEM tile (Tif_Files_UTM) and a time per GB of
+DEMs, so that counties with many small tiles and counties with few large ones are both ranked correctly. Starting the
+longest counties first keeps one huge county from finishing hours after everything else. Memory heavy counties (more
+than HEAVY_COUNTY_GB of DEMs) are kept from running at the same time as each other.
+
+Dependencies:
+- Uses `psutil` (included with ArcGIS Pro) to measure free memory and CPU load. If it is not available, the scheduler
+  falls back to a fixed limit of FALLBACK_MAX_PROCESSES parallel counties.
+
+Usage:
+    cd Z:\\Clearinghouse_Support\\python
+    python Contouring_Batch.py .\\ALABAMA.csv
+
+    Use `--order csv` to process counties in the order of the CSV file instead.
+
+    The CSV file has the same format as for Contouring_Batch.ps1 (no header, columns State,County,CRS), e.g.:
+        ALABAMA,Autauga,9749
+        ALABAMA,Baldwin,9749
+
+Resuming:
+Every start and exit of a county (with its exit code, duration and last completed step) is appended to a journal
+next to the CSV file (e.g. ALABAMA.journal.jsonl), and flushed to disk before the scheduler continues. If the batch
+is interrupted (e.g. the machine reboots), running the same command again skips the counties that already completed
+and resumes interrupted or failed counties from the step after their last completed step, using Contouring.py's
+--step option. Use --fresh to ignore the journal and start the whole batch over.
+
+Distributed mode:
+Several workstations can share one batch through a queue folder on the Z: share (see Batch_Queue.py). Enqueue the
+batch once (largest counties first), then start a worker on every workstation:
+    python Contouring_Batch.py .\\ALABAMA.csv --queue-dir Z:\\Clearinghouse_Support\\queue --enqueue-only
+    python Contouring_Batch.py --queue-dir Z:\\Clearinghouse_Support\\queue
+
+Passing both the CSV file and --queue-dir (without --enqueue-only) enqueues the batch and starts a worker. Each
+worker claims counties as its own resources allow and keeps its claims alive with a heartbeat. The counties of a
+worker that stops sending heartbeats (e.g. its machine went down) are returned to the queue automatically and
+resumed by another worker; the worker that lost the claim stops its Contouring.py process (or drops the pending
+retry) and does not record an outcome for the county. Memory heavy counties are only claimed while this worker runs
+fewer than MAX_HEAVY_PROCESSES of them. Each worker journals its own starts and exits in the queue's journal folder.
+For a local test, run several workers against a temporary queue folder with --contouring-script pointing at a
+stand-in script and --data-dir pointing at a temporary data folder.
+
+Scratch cleanup:
+As soon as a county completes, a background thread verifies its outputs and deletes or compacts its intermediate
+data as configured in Scratch_Retention.py (e.g. the WIP geodatabases), recording the size of every artifact in the
+shared scratch usage history. The same thread measures the free space on the data drive every RETENTION_INTERVAL
+seconds, and no county is started while it is below MIN_FREE_DISK_GB. Use --keep-scratch to keep intermediate data.
+
+Dashboard:
+Use --dashboard to replace the scrolling console log with a live status view, redrawn every DASHBOARD_INTERVAL
+seconds. For every running county it shows the current Contouring.py step, the time spent in it and the expected
+duration of that step (from the county's history or the step's cost model), the county's elapsed and estimated time, and the overall
+ETA, together with the batch throughput (counties, DEM tiles and GB of DEMs per hour) and the latest log messages.
+Use --dashboard-port 8765 to also serve the same status as JSON at http://localhost:8765/ (e.g. for a browser or
+a monitoring script on the same machine).
+
+Logging:
+- Starts, exits (with exit code and duration) and retries are logged to Contouring_Batch.log.
+- The console output of each Contouring.py run is written to Contouring_Batch_Logs\\{STATE}_{COUNTY}.log. The
+  detailed processing log of each county is still written to its contouring.log by Contouring.py.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import shutil
+import datetime
+import argparse
+import collections
+import statistics
+import socket
+import threading
+import subprocess
+import http.server
+
+import Batch_Queue
+import County_Inputs
+import Scratch_Retention
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+#region Config Vars
+# Root of the data drive, with the state folders and the shared history (--data-dir)
+DATA_DIR = 'Z:\\'
+LOG_FILE = 'Contouring_Batch.log'
+JOURNAL_SUFFIX = '.journal.jsonl'
+PROGRESS_FILE = 'contouring_progress.json'
+SCRATCH_USAGE_FILE = 'Clearinghouse_Support/python/history/scratch_usage.jsonl'
+TIMINGS_FILE = 'Clearinghouse_Support/python/history/step_timings.jsonl'
+CONSOLE_LOGS_DIR = 'Contouring_Batch_Logs'
+CONTOURING_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Contouring.py')
+PYTHON_EXE = sys.executable
+# Run every county on the local scratch disk and publish its outputs to the share (Contouring.py --stage)
+STAGE_COUNTIES = False
+
+# Hard ceiling on the number of parallel counties, regardless of available resources
+MAX_PROCESSES = 10
+# Parallel counties when psutil is not available to measure free resources
+FALLBACK_MAX_PROCESSES = 5
+# Expected peak memory use of a single Contouring.py process
+PROCESS_MEMORY_GB = 6
+# Memory that is kept free for the operating system and other programs
+RESERVED_MEMORY_GB = 4
+# New counties are not started while the CPU load is above this percentage
+MAX_CPU_PERCENT = 85
+# New counties are not started while the data drive has less free space than this
+MIN_FREE_DISK_GB = 100
+# A process that started less than this many seconds ago may not have reached its peak memory use yet, so its
+# expected memory use is reserved in addition to the memory that is currently in use
+RAMP_UP_SECONDS = 180
+# Number of seconds between admission checks while no process exits
+ADMISSION_INTERVAL = 5
+
+# Seconds of processing per GB of input DEMs assumed when there is no step timing history yet
+DEFAULT_SECONDS_PER_GB = 900
+# Number of counties in the history of a step needed to fit its cost model, below that its median seconds per GB is used
+MIN_MODEL_SAMPLES = 5
+# Counties with more input DEM data than this need a lot of memory, and at most MAX_HEAVY_PROCESSES of them run at once
+HEAVY_COUNTY_GB = 40
+MAX_HEAVY_PROCESSES = 1
+
+# Delete or compact the intermediate data of completed counties (see Scratch_Retention.py), and the number of seconds
+# between free disk space measurements of the cleanup thread
+RETENTION_ENABLED = True
+RETENTION_INTERVAL = 30
+
+# Seconds between redraws of the terminal dashboard, and number of recent log messages shown below it
+DASHBOARD_INTERVAL = 5
+DASHBOARD_LOG_LINES = 10
+
+# Number of times a failed county is retried, and the delay before the first retry (doubled for every further retry)
+MAX_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 60
+#endregion
+
+#region Utility Functions
+# While the terminal dashboard is shown, log messages are only shown in its recent messages section
+DASHBOARD_ACTIVE = False
+RECENT_MESSAGES = collections.deque(maxlen=DASHBOARD_LOG_LINES)
+
+def log(message):
+    """Print a log message to the console and to the batch log file"""
+
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    formatted_message = f"[{timestamp}] {message}"
+
+    RECENT_MESSAGES.append(formatted_message)
+    if not DASHBOARD_ACTIVE:
+        print(formatted_message)
+
+    try:
+        with open(LOG_FILE, "a") as file:
+            file.write(formatted_message + "\n")
+    except Exception as e:
+        print(f"Failed to write log to {LOG_FILE}: {e}")
+
+def format_duration(seconds):
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}h {minutes}m {seconds}s"
+
+def read_jobs(csv_file):
+    """Reads the State,County,CRS rows of a batch CSV file"""
+
+    jobs = []
+
+    with open(csv_file, newline='') as file:
+        for row in csv.reader(file):
+            if len(row) < 3 or not row[0].strip():
+                continue
+
+            jobs.append(read_job_row(row))
+
+    return jobs
+
+def read_job_row(row):
+    """Creates a job from a State,County,CRS row"""
+
+    return {
+        'state': row[0].strip(),
+        'county': row[1].strip(),
+        'crs': row[2].strip(),
+        'attempts': 0,
+        'not_before': 0,
+        'status': 'pending',
+        'exit_code': None,
+        'process': None,
+        'start': None,
+        'end': None,
+        'tif_count': 0,
+        'tif_bytes': 0,
+        'estimate': 0,
+        'heavy': False,
+        'resume': False,
+    }
+
+def job_name(job):
+    return f"{job['state']} {job['county']} {job['crs']}"
+#endregion
+
+def county_dir(job):
+    return os.path.join(DATA_DIR, job['state'], f"{job['county']}_Contours")
+
+#region Journal
+JOURNAL_FILE = None
+QUEUE_DIR = None
+
+def write_journal(job, event, **details):
+    """Appends an event to the batch journal and forces it to disk"""
+
+    record = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'event': event,
+        'state': job['state'],
+        'county': job['county'],
+        'crs': job['crs'],
+        'attempt': job['attempts'],
+        **details,
+    }
+
+    with open(JOURNAL_FILE, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+def replay_journal(jobs):
+    """Restores the status of every county from the journal of a previous execution of the batch"""
+
+    last_records = {}
+
+    with open(JOURNAL_FILE) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if the machine went down while writing it
+                continue
+
+            last_records[(record['state'], record['county'], record['crs'])] = record
+
+    for job in jobs:
+        record = last_records.get((job['state'], job['county'], job['crs']))
+
+        if not record:
+            continue
+
+        if record['event'] == 'exited' and record.get('exit_code') == 0:
+            job['status'] = 'completed'
+            job['exit_code'] = 0
+            log(f"Already completed: {job_name(job)}")
+        else:
+            job['resume'] = True
+            log(f"Will resume: {job_name(job)} (last {record['event']} {record['time']}, exit code {record.get('exit_code')})")
+
+def read_progress(job):
+    """Reads the progress file written by Contouring.py for a county, if any"""
+
+    progress_file = os.path.join(county_dir(job), PROGRESS_FILE)
+
+    try:
+        with open(progress_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+#endregion
+
+#region Cost Estimation
+def read_step_history():
+    """Reads the step timing records written by Contouring.py"""
+
+    timings_file = os.path.join(DATA_DIR, TIMINGS_FILE)
+    records = []
+
+    if not os.path.isfile(timings_file):
+        return records
+
+    with open(timings_file) as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return records
+
+def solve(matrix, vector):
+    """Solves a small linear system by Gaussian elimination, returning None if it is singular"""
+
+    n = len(vector)
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-9:
+            return None
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+
+        for row in range(n):
+            if row != column:
+                factor = rows[row][column] / rows[column][column]
+                rows[row] = [a - factor * b for a, b in zip(rows[row], rows[column])]
+
+    return [rows[i][n] / rows[i][i] for i in range(n)]
+
+def least_squares(samples, terms):
+    """Fits seconds = sum(coefficient * term) over the samples, returning None unless every coefficient is positive"""
+
+    matrix = [[sum(a[i] * a[j] for a, y in samples) for j in range(terms)] for i in range(terms)]
+    vector = [sum(a[i] * y for a, y in samples) for i in range(terms)]
+    coefficients = solve(matrix, vector)
+
+    if coefficients is None or any(c < 0 for c in coefficients):
+        return None
+
+    return coefficients
+
+def fit_step_model(records):
+    """
+    Fits the cost model of a step, seconds = base + per_tif * tifs + per_gb * GB, to its timing records
+    Tile count and size are usually correlated, so when the full fit is degenerate (or gives a negative coefficient) the
+    tile count is dropped, and with fewer than MIN_MODEL_SAMPLES counties the median seconds per GB is used.
+    Returns (base, per_tif, per_gb)
+    """
+
+    # Latest record of every county, so counties processed several times do not outweigh the others
+    latest = {(record['state'], record['locality'], str(record['crs'])): record for record in records}
+    samples = [(record.get('tif_count', 0), record.get('tif_bytes', 0) / 1024 ** 3, record['seconds']) for record in latest.values()]
+
+    if len(samples) >= MIN_MODEL_SAMPLES:
+        full = least_squares([((1, tifs, gb), seconds) for tifs, gb, seconds in samples], 3)
+        if full:
+            return tuple(full)
+
+        by_size = least_squares([((1, gb), seconds) for tifs, gb, seconds in samples], 2)
+        if by_size:
+            return by_size[0], 0, by_size[1]
+
+    # Counties smaller than 1 GB are counted as 1 GB, so that fixed per-step overhead does not inflate the rate
+    return 0, 0, statistics.median(seconds / max(gb, 1) for tifs, gb, seconds in samples)
+
+def predict_step(job, step):
+    """Expected duration of a step for a county: its own recorded duration if it ran the step before, else the step's model"""
+
+    past = COUNTY_HISTORY.get((job['state'], job['county'], job['crs']), {})
+    if step in past:
+        return past[step]
+
+    if step not in STEP_MODELS:
+        return None
+
+    base, per_tif, per_gb = STEP_MODELS[step]
+    return base + per_tif * job['tif_count'] + per_gb * job['tif_bytes'] / 1024 ** 3
+
+# Cost model of every step, and recorded step durations of every county, from the step timings history
+STEP_MODELS = {}
+COUNTY_HISTORY = {}
+
+def load_history():
+    """Fits the step cost models and collects the step durations of every county from the step timings history"""
+
+    global STEP_MODELS, COUNTY_HISTORY
+
+    records = {}
+    COUNTY_HISTORY = {}
+
+    for record in read_step_history():
+        records.setdefault(record['step'], []).append(record)
+        COUNTY_HISTORY.setdefault((record['state'], record['locality'], str(record['crs'])), {})[record['step']] = record['seconds']
+
+    STEP_MODELS = {step: fit_step_model(step_records) for step, step_records in records.items()}
+
+    log(f"Estimating county processing times ({len(STEP_MODELS)} steps with history, {len(COUNTY_HISTORY)} counties processed before)")
+
+def estimate_job(job):
+    """Estimates the processing time (in seconds) of a county and flags it if it is memory heavy"""
+
+    job.update(County_Inputs.read_tif_stats(county_dir(job)))
+    gb = job['tif_bytes'] / 1024 ** 3
+    steps = set(STEP_MODELS) | set(COUNTY_HISTORY.get((job['state'], job['county'], job['crs']), {}))
+
+    if steps:
+        job['estimate'] = sum(predict_step(job, step) for step in steps)
+    else:
+        job['estimate'] = DEFAULT_SECONDS_PER_GB * max(gb, 1)
+
+    job['heavy'] = gb > HEAVY_COUNTY_GB
+
+def estimate_jobs(jobs):
+    load_history()
+
+    for job in jobs:
+        estimate_job(job)
+
+def order_jobs(jobs, order):
+    """Sorts the jobs in place, longest estimated processing time first unless the CSV order is requested"""
+
+    if order == 'largest-first':
+        jobs.sort(key=lambda job: job['estimate'], reverse=True)
+
+    for i, job in enumerate(jobs):
+        log(f"{i + 1}. {job_name(job)}: {job['tif_count']} tifs, {job['tif_bytes'] / 1024 ** 3:.1f} GB, estimated {format_duration(job['estimate'])}{' (memory heavy)' if job['heavy'] else ''}")
+#endregion
+
+#region Resource Checks
+# Free space on the data drive as last measured by the scratch cleanup thread (None while it is not running)
+REPORTED_FREE_DISK_GB = None
+RETENTION_QUEUE = queue.Queue()
+
+def free_disk_gb():
+    return shutil.disk_usage(DATA_DIR).free / 1024 ** 3
+
+def run_retention():
+    """Cleans up the scratch data of completed counties and measures the free disk space, in a background thread"""
+
+    global REPORTED_FREE_DISK_GB
+
+    while True:
+        try:
+            job = RETENTION_QUEUE.get(timeout=RETENTION_INTERVAL)
+        except queue.Empty:
+            job = None
+
+        if job:
+            try:
+                records = Scratch_Retention.apply_policy(county_dir(job), job['county'], log=log)
+                if records:
+                    Scratch_Retention.record_usage(os.path.join(DATA_DIR, SCRATCH_USAGE_FILE), job['state'], job['county'], records)
+                    freed = sum(record['bytes'] - record['bytes_after'] for record in records)
+                    log(f"Cleaned up scratch data of {job_name(job)}: {freed / 1024 ** 3:.1f} GB freed")
+            except Exception as e:
+                log(f"Failed to clean up scratch data of {job_name(job)}: {e}")
+            finally:
+                RETENTION_QUEUE.task_done()
+
+        REPORTED_FREE_DISK_GB = free_disk_gb()
+
+def can_admit(active):
+    """
+    Decides whether another county can be started right now
+    Returns (True, None) or (False, reason)
+    """
+
+    if len(active) >= MAX_PROCESSES:
+        return False, f'{len(active)} processes running (maximum {MAX_PROCESSES})'
+
+    disk_gb = REPORTED_FREE_DISK_GB if REPORTED_FREE_DISK_GB is not None else free_disk_gb()
+    if disk_gb < MIN_FREE_DISK_GB:
+        cleanups = RETENTION_QUEUE.qsize()
+        return False, f"{disk_gb:.0f} GB free on {DATA_DIR} (minimum {MIN_FREE_DISK_GB} GB){f', {cleanups} scratch cleanups pending' if cleanups else ''}"
+
+    # Always allow a single county, otherwise a busy machine would never start anything
+    if not active:
+        return True, None
+
+    if psutil is None:
+        if len(active) >= FALLBACK_MAX_PROCESSES:
+            return False, f'{len(active)} processes running (psutil unavailable, maximum {FALLBACK_MAX_PROCESSES})'
+        return True, None
+
+    ramping_up = [job for job in active if time.time() - job['start'] < RAMP_UP_SECONDS]
+    memory_gb = psutil.virtual_memory().available / 1024 ** 3 - len(ramping_up) * PROCESS_MEMORY_GB
+    if memory_gb - PROCESS_MEMORY_GB < RESERVED_MEMORY_GB:
+        return False, f'{memory_gb:.1f} GB memory available after {len(ramping_up)} starting processes (need {PROCESS_MEMORY_GB + RESERVED_MEMORY_GB} GB)'
+
+    # cpu_percent(None) reports the load since the previous call, so it never blocks the scheduler
+    cpu_percent = psutil.cpu_percent(None)
+    if cpu_percent > MAX_CPU_PERCENT:
+        return False, f'CPU load {cpu_percent:.0f}% (maximum {MAX_CPU_PERCENT}%)'
+
+    return True, None
+#endregion
+
+#region Processes
+def start_job(job, events):
+    """Starts Contouring.py for a county and a thread that reports its exit on the events queue"""
+
+    os.makedirs(CONSOLE_LOGS_DIR, exist_ok=True)
+    console_log = open(os.path.join(CONSOLE_LOGS_DIR, f"{job['state']}_{job['county']}.log"), 'a')
+
+    command = [PYTHON_EXE, CONTOURING_SCRIPT, job['state'], job['county'], job['crs']]
+
+    if STAGE_COUNTIES:
+        command.append('--stage')
+
+    # Interrupted and failed counties pick up where the previous execution ended
+    step = None
+    if job['resume']:
+        progress = read_progress(job)
+        if progress and progress.get('last_completed_step'):
+            step = progress.get('next_step') or progress['last_completed_step']
+            command += ['--step', step]
+
+    job['attempts'] += 1
+    job['status'] = 'running'
+    job['start'] = time.time()
+    job['end'] = None
+    job['process'] = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=console_log, stderr=subprocess.STDOUT)
+
+    process = job['process']
+    log(f"Starting task: {job_name(job)} (attempt {job['attempts']}, pid {process.pid}{f', resuming at step {step}' if step else ''})")
+    write_journal(job, 'started', step=step, pid=process.pid)
+
+    def wait():
+        exit_code = process.wait()
+        console_log.close()
+        events.put((job, exit_code))
+
+    threading.Thread(target=wait, daemon=True).start()
+
+def finish_job(job, exit_code):
+    """Records the exit of a county's process and schedules a retry if it failed"""
+
+    job['end'] = time.time()
+    job['exit_code'] = exit_code
+    job['process'] = None
+    duration = format_duration(job['end'] - job['start'])
+
+    progress = read_progress(job)
+    write_journal(
+        job,
+        'exited',
+        exit_code=exit_code,
+        seconds=round(job['end'] - job['start'], 1),
+        last_completed_step=progress.get('last_completed_step') if progress else None
+    )
+
+    # Another worker has claimed the county since, its outcome is recorded by that worker
+    if job.get('claim_lost'):
+        job['status'] = 'abandoned'
+        log(f"Task abandoned: {job_name(job)} (exit code {exit_code}, {duration}), its claim was lost")
+        return
+
+    if exit_code == 0:
+        job['status'] = 'completed'
+        log(f"Task completed: {job_name(job)} (exit code 0, {duration})")
+
+        if job.get('queue_name') and not Batch_Queue.complete(QUEUE_DIR, job['queue_name'], 'done', exit_code=exit_code, attempts=job['attempts']):
+            log(f"Claim on {job_name(job)} was lost, its completion is not recorded in {QUEUE_DIR}")
+
+        if RETENTION_ENABLED:
+            RETENTION_QUEUE.put(job)
+    elif job['attempts'] <= MAX_RETRIES:
+        delay = RETRY_BACKOFF_SECONDS * 2 ** (job['attempts'] - 1)
+        job['status'] = 'pending'
+        job['resume'] = True
+        job['not_before'] = time.time() + delay
+        log(f"Task failed: {job_name(job)} (exit code {exit_code}, {duration}), retrying in {delay}s")
+    else:
+        job['status'] = 'failed'
+        log(f"Task failed: {job_name(job)} (exit code {exit_code}, {duration}), giving up after {job['attempts']} attempts")
+
+        if job.get('queue_name') and not Batch_Queue.complete(QUEUE_DIR, job['queue_name'], 'failed', exit_code=exit_code, attempts=job['attempts']):
+            log(f"Claim on {job_name(job)} was lost, its failure is not recorded in {QUEUE_DIR}")
+
+def heavy_running(jobs):
+    return len([job for job in jobs if job['status'] == 'running' and job['heavy']])
+
+def next_job(jobs):
+    """
+    Returns the next pending county that is ready to start, if any
+    Memory heavy counties are skipped while MAX_HEAVY_PROCESSES of them are already running
+    """
+
+    now = time.time()
+    heavy = heavy_running(jobs)
+
+    for job in jobs:
+        if job['status'] != 'pending' or job['not_before'] > now or job.get('claim_lost'):
+            continue
+
+        if job['heavy'] and heavy >= MAX_HEAVY_PROCESSES:
+            continue
+
+        return job
+
+    return None
+#endregion
+
+#region Distributed Mode
+def claim_job(jobs):
+    """
+    Claims the next county from the shared queue, returning it as a job (or None if nothing can be claimed)
+    Memory heavy counties are left in the queue while MAX_HEAVY_PROCESSES of them are running on this worker
+    """
+
+    heavy_full = heavy_running(jobs) >= MAX_HEAVY_PROCESSES
+    name, data = Batch_Queue.claim(QUEUE_DIR, accept=lambda data: not (heavy_full and data.get('heavy')))
+
+    if not name:
+        return None
+
+    job = read_job_row([data['state'], data['county'], data['crs']])
+    job['queue_name'] = name
+    # A county claimed before was interrupted on another worker (or on this one before a restart)
+    job['resume'] = data['claims'] > 1
+    estimate_job(job)
+
+    log(f"Claimed {job_name(job)} from {QUEUE_DIR} (claim {data['claims']}, estimated {format_duration(job['estimate'])})")
+
+    return job
+
+def send_heartbeats(jobs):
+    """Keeps the claims of this worker's counties alive for as long as they are running or waiting for a retry"""
+
+    while True:
+        time.sleep(Batch_Queue.HEARTBEAT_SECONDS)
+
+        for job in list(jobs):
+            if job.get('queue_name') and job['status'] in ['running', 'pending'] and not job.get('claim_lost'):
+                if not Batch_Queue.heartbeat(QUEUE_DIR, job['queue_name']):
+                    # Acted upon by the scheduler loop (see abandon_lost_claims)
+                    job['claim_lost'] = True
+                    log(f"Lost claim on {job_name(job)}, it was returned to the queue after its lease expired")
+
+def abandon_lost_claims(jobs):
+    """Stops the process of every county whose claim was lost, and drops its pending retry"""
+
+    for job in jobs:
+        if not job.get('claim_lost'):
+            continue
+
+        if job['status'] == 'pending':
+            job['status'] = 'abandoned'
+            log(f"Task abandoned: {job_name(job)}, its claim was lost before it was retried")
+        elif job['status'] == 'running' and job['process'] and not job.get('terminated'):
+            job['terminated'] = True
+            log(f"Stopping {job_name(job)} (pid {job['process'].pid}), its claim was lost")
+            job['process'].terminate()
+
+def queue_busy():
+    """Returns True while any county in the shared queue is pending or claimed by a worker"""
+
+    counts = Batch_Queue.counts(QUEUE_DIR)
+    return counts['pending'] > 0 or counts['claimed'] > 0
+#endregion
+
+#region Dashboard
+def running_step(job):
+    """Returns the current step of a running county and the time it started, from the county's progress file"""
+
+    progress = read_progress(job)
+    process = job['process']
+
+    # A progress file left behind by a previous execution does not describe the running process
+    if not progress or not process or progress.get('pid') != process.pid or not progress.get('current_step'):
+        return None, None
+
+    try:
+        step_start = datetime.datetime.fromisoformat(progress['current_step_start']).timestamp()
+    except (TypeError, ValueError):
+        step_start = None
+
+    return progress['current_step'], step_start
+
+def dashboard_status(jobs, start_time):
+    """Collects the status of the batch: running counties, throughput and ETA"""
+
+    now = time.time()
+    running = [job for job in jobs if job['status'] == 'running']
+    pending = [job for job in jobs if job['status'] == 'pending']
+    # Counties completed by a previous execution of a resumed batch do not count towards this execution's throughput
+    completed = [job for job in jobs if job['status'] == 'completed' and job['end'] and job['end'] >= start_time]
+    hours = max(now - start_time, 1) / 3600
+
+    active = []
+    remaining = sum(job['estimate'] for job in pending)
+
+    for job in sorted(running, key=lambda job: job['start']):
+        step, step_start = running_step(job)
+        elapsed = now - job['start']
+        step_expected = predict_step(job, step) if step else None
+        remaining += max(job['estimate'] - elapsed, 0)
+
+        active.append({
+            'county': job_name(job),
+            'pid': job['process'].pid if job['process'] else None,
+            'attempt': job['attempts'],
+            'step': step,
+            'step_elapsed': now - step_start if step_start else None,
+            'step_expected': step_expected,
+            'elapsed': elapsed,
+            'estimate': job['estimate'],
+        })
+
+    return {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'elapsed': now - start_time,
+        'counts': {status: len([job for job in jobs if job['status'] == status]) for status in ['pending', 'running', 'completed', 'failed']},
+        'active': active,
+        'throughput': {
+            'counties_per_hour': len(completed) / hours,
+            'tiles_per_hour': sum(job['tif_count'] for job in completed) / hours,
+            'gb_per_hour': sum(job['tif_bytes'] for job in completed) / 1024 ** 3 / hours,
+        },
+        # Remaining estimated work spread over the counties currently running in parallel
+        'eta': remaining / max(len(running), 1) if running or pending else 0,
+    }
+
+def render_dashboard(status):
+    """Formats the batch status for the terminal"""
+
+    def duration(seconds):
+        return format_duration(seconds) if seconds is not None else '-'
+
+    counts = status['counts']
+    throughput = status['throughput']
+    lines = [
+        f"=== Contouring Batch ({status['time']}, running for {duration(status['elapsed'])}) ===",
+        f"Pending: {counts['pending']}  Running: {counts['running']}  Completed: {counts['completed']}  Failed: {counts['failed']}  ETA: {duration(status['eta'])}",
+        f"Throughput: {throughput['counties_per_hour']:.2f} counties/h, {throughput['tiles_per_hour']:.0f} tiles/h, {throughput['gb_per_hour']:.1f} GB/h",
+        "",
+        "=== Active Tasks ===",
+    ]
+
+    for county in status['active']:
+        lines.append(
+            f"{county['county']} (pid {county['pid']}, attempt {county['attempt']}): step {county['step'] or 'starting'} "
+            f"{duration(county['step_elapsed'])} (expected {duration(county['step_expected'])}), "
+            f"total {duration(county['elapsed'])} of ~{duration(county['estimate'])}"
+        )
+
+    lines += ["", "=== Recent Messages ==="] + list(RECENT_MESSAGES)
+
+    return '\n'.join(lines)
+
+def start_dashboard(jobs, start_time, terminal, port):
+    """
+    Starts the terminal dashboard and/or the JSON status server in background threads
+    Returns a function that stops the terminal dashboard
+    """
+
+    global DASHBOARD_ACTIVE
+    stop = threading.Event()
+
+    if port:
+        class StatusHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(dashboard_status(jobs, start_time), indent=2).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log(f"Serving batch status at http://localhost:{port}/")
+
+    if terminal:
+        DASHBOARD_ACTIVE = True
+
+        def draw():
+            while not stop.wait(DASHBOARD_INTERVAL):
+                os.system('cls' if os.name == 'nt' else 'clear')
+                print(render_dashboard(dashboard_status(jobs, start_time)), flush=True)
+
+        thread = threading.Thread(target=draw, daemon=True)
+        thread.start()
+
+        def stop_dashboard():
+            global DASHBOARD_ACTIVE
+            stop.set()
+            thread.join()
+            DASHBOARD_ACTIVE = False
+
+        return stop_dashboard
+
+    return lambda: None
+#endregion
+
+#region Main
+def run_batch(jobs):
+    """
+    Processes the given counties, starting as many at a time as the available resources allow
+    In distributed mode, further counties are claimed from the shared queue whenever there is room for them
+    """
+
+    events = queue.Queue()
+    last_reason = None
+
+    if psutil:
+        psutil.cpu_percent(None)
+
+    if QUEUE_DIR:
+        threading.Thread(target=send_heartbeats, args=(jobs,), daemon=True).start()
+
+    if RETENTION_ENABLED:
+        threading.Thread(target=run_retention, daemon=True).start()
+
+    while True:
+        if QUEUE_DIR:
+            abandon_lost_claims(jobs)
+
+        active = [job for job in jobs if job['status'] == 'running']
+
+        # Start as many counties as the available resources allow
+        while True:
+            job = next_job(jobs)
+            if not job and not QUEUE_DIR:
+                break
+
+            admit, reason = can_admit(active)
+            if not admit:
+                if reason != last_reason:
+                    log(f"Waiting to start {job_name(job) if job else 'next task'}: {reason}")
+                    last_reason = reason
+                break
+
+            if not job:
+                job = claim_job(jobs)
+                if not job:
+                    break
+                jobs.append(job)
+
+                # The county turned out to be memory heavy (e.g. enqueued by an older version), it waits for its turn
+                if job is not next_job(jobs):
+                    break
+
+            last_reason = None
+            start_job(job, events)
+            active.append(job)
+
+        pending = [job for job in jobs if job['status'] == 'pending']
+
+        if not active and not pending and not (QUEUE_DIR and queue_busy()):
+            break
+
+        # Wake up as soon as a process exits, or re-check resources after ADMISSION_INTERVAL seconds
+        try:
+            job, exit_code = events.get(timeout=ADMISSION_INTERVAL)
+            finish_job(job, exit_code)
+
+            while not events.empty():
+                finish_job(*events.get_nowait())
+        except queue.Empty:
+            pass
+
+    # Let the cleanup thread finish with the last counties before exiting
+    RETENTION_QUEUE.join()
+
+def main():
+    global CONTOURING_SCRIPT, STAGE_COUNTIES, RETENTION_ENABLED, DATA_DIR
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        'csv_file',
+        nargs='?',
+        help="Batch CSV file with State,County,CRS rows (e.g. .\\ALABAMA.csv), optional for distributed workers"
+    )
+    parser.add_argument(
+        '--order',
+        choices=['largest-first', 'csv'],
+        default='largest-first',
+        help="Order in which counties are started (default: largest-first)"
+    )
+    parser.add_argument(
+        '--fresh',
+        action='store_true',
+        help="Ignore the journal of a previous execution and process every county from the beginning"
+    )
+    parser.add_argument(
+        '--queue-dir',
+        help="Shared queue folder for distributing the batch over several workstations (see Batch_Queue.py)"
+    )
+    parser.add_argument(
+        '--enqueue-only',
+        action='store_true',
+        help="Add the counties of the CSV file to the shared queue and exit without starting a worker"
+    )
+    parser.add_argument(
+        '--stage',
+        action='store_true',
+        help="Process every county on the local scratch disk and publish its outputs to the share (Contouring.py --stage)"
+    )
+    parser.add_argument(
+        '--keep-scratch',
+        action='store_true',
+        help="Keep the intermediate data of completed counties instead of cleaning it up"
+    )
+    parser.add_argument(
+        '--dashboard',
+        action='store_true',
+        help="Show a live status view instead of the scrolling console log"
+    )
+    parser.add_argument(
+        '--dashboard-port',
+        type=int,
+        help="Serve the batch status as JSON at http://localhost:PORT/"
+    )
+    parser.add_argument(
+        '--data-dir',
+        default=DATA_DIR,
+        help=f"Root of the data drive with the state folders and the shared history (default: {DATA_DIR})"
+    )
+    parser.add_argument(
+        '--contouring-script',
+        default=CONTOURING_SCRIPT,
+        help="Script executed for each county (default: Contouring.py next to this script)"
+    )
+    args = parser.parse_args()
+
+    if args.csv_file and not os.path.isfile(args.csv_file):
+        print(f"Error: File '{args.csv_file}' does not exist. Exiting.")
+        sys.exit(1)
+
+    if not args.csv_file and not args.queue_dir:
+        print("Error: A CSV file is required unless --queue-dir is given. Exiting.")
+        sys.exit(1)
+
+    if args.enqueue_only and not (args.csv_file and args.queue_dir):
+        print("Error: --enqueue-only requires a CSV file and --queue-dir. Exiting.")
+        sys.exit(1)
+
+    CONTOURING_SCRIPT = args.contouring_script
+    DATA_DIR = args.data_dir
+    STAGE_COUNTIES = STAGE_COUNTIES or args.stage
+    RETENTION_ENABLED = RETENTION_ENABLED and not args.keep_scratch
+
+    if args.queue_dir:
+        run_worker(args)
+        return
+
+    global JOURNAL_FILE
+    JOURNAL_FILE = os.path.splitext(args.csv_file)[0] + JOURNAL_SUFFIX
+    resuming = os.path.isfile(JOURNAL_FILE) and not args.fresh
+
+    if not resuming:
+        for path in [LOG_FILE, JOURNAL_FILE]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    jobs = read_jobs(args.csv_file)
+    log(f"Loaded {len(jobs)} tasks from {args.csv_file}")
+
+    if resuming:
+        log(f"Resuming batch from journal {JOURNAL_FILE}")
+        replay_journal(jobs)
+
+    estimate_jobs(jobs)
+    order_jobs(jobs, args.order)
+
+    start_time = time.time()
+    stop_dashboard = start_dashboard(jobs, start_time, args.dashboard, args.dashboard_port)
+    run_batch(jobs)
+    stop_dashboard()
+
+    completed = [job for job in jobs if job['status'] == 'completed']
+    failed = [job for job in jobs if job['status'] == 'failed']
+
+    log(f"All tasks completed in {format_duration(time.time() - start_time)}: {len(completed)} succeeded, {len(failed)} failed.")
+    for job in failed:
+        log(f"Failed: {job_name(job)} (exit code {job['exit_code']}, {job['attempts']} attempts)")
+
+    sys.exit(1 if failed else 0)
+
+def run_worker(args):
+    """Enqueues the counties of the CSV file (if given) and processes counties from the shared queue until it is empty"""
+
+    global QUEUE_DIR, JOURNAL_FILE
+    QUEUE_DIR = args.queue_dir
+    JOURNAL_FILE = os.path.join(QUEUE_DIR, 'journal', f'{socket.gethostname()}.jsonl')
+    os.makedirs(os.path.dirname(JOURNAL_FILE), exist_ok=True)
+
+    if args.csv_file:
+        jobs = read_jobs(args.csv_file)
+        estimate_jobs(jobs)
+        order_jobs(jobs, args.order)
+
+        added = Batch_Queue.enqueue(QUEUE_DIR, jobs)
+        log(f"Added {added} of {len(jobs)} tasks from {args.csv_file} to {QUEUE_DIR}")
+
+        if args.enqueue_only:
+            return
+
+    if not os.path.isdir(Batch_Queue.queue_path(QUEUE_DIR, 'pending')):
+        print(f"Error: '{QUEUE_DIR}' is not a batch queue, enqueue a CSV file first. Exiting.")
+        sys.exit(1)
+
+    log(f"Worker {Batch_Queue.owner_name()} started on queue {QUEUE_DIR}")
+
+    jobs = []
+    start_time = time.time()
+    load_history()
+    stop_dashboard = start_dashboard(jobs, start_time, args.dashboard, args.dashboard_port)
+    run_batch(jobs)
+    stop_dashboard()
+
+    completed = [job for job in jobs if job['status'] == 'completed']
+    failed = [job for job in jobs if job['status'] == 'failed']
+    counts = Batch_Queue.counts(QUEUE_DIR)
+
+    log(f"Worker finished in {format_duration(time.time() - start_time)}: {len(completed)} succeeded, {len(failed)} failed on this worker.")
+    log(f"Queue {QUEUE_DIR}: {counts['done']} done, {counts['failed']} failed.")
+    for job in failed:
+        log(f"Failed: {job_name(job)} (exit code {job['exit_code']}, {job['attempts']} attempts)")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
+#endregion
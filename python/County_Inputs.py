@@ -0,0 +1,32 @@
+"""
+Script Name: County Inputs
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Measures the input DEMs of a county. Contouring.py records these measurements with its step timings, and
+Contouring_Batch.py uses them to estimate the processing time of the counties it schedules.
+
+Usage:
+    import County_Inputs
+    County_Inputs.read_tif_stats('Z:\\ALABAMA\\Autauga_Contours')
+"""
+
+import os
+
+# Input DEMs of a county
+TIF_FILES_FOLDER = 'Tif_Files_UTM'
+
+def read_tif_stats(county_dir):
+    """Returns the number and total size in bytes of the input .tif files of a county"""
+
+    tif_files_dir = os.path.join(county_dir, TIF_FILES_FOLDER)
+    count = 0
+    size = 0
+
+    if os.path.isdir(tif_files_dir):
+        for entry in os.scandir(tif_files_dir):
+            if entry.is_file() and entry.name.endswith('.tif'):
+                count += 1
+                size += entry.stat().st_size
+
+    return {'tif_count': count, 'tif_bytes': size}
@@ -0,0 +1,173 @@
+"""
+Script Name: GeoJSON Index Writer
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Writes the contour tile index of a county as GeoJSON in a single streaming pass. Features are read from the clipped
+tile index feature class with a search cursor that projects each geometry to WGS84 on the fly, coordinates are
+rounded to a configurable number of decimals, and each feature is written to the output file (and, optionally, to
+gzip/brotli pre-compressed siblings) as soon as it is read. This replaces the Project + FeaturesToJSON combination,
+which writes an intermediate WGS84 feature class and full precision coordinates.
+
+Dependencies:
+- Requires ArcGIS Pro (arcpy) to read features from a geodatabase.
+- Brotli output requires the optional `brotli` package. If it is not installed, brotli siblings are skipped.
+
+Usage:
+    import GeoJSON_Index_Writer
+    GeoJSON_Index_Writer.export_feature_class(input_path, output_path, precision=7, compress=['gzip'])
+"""
+
+import os
+import json
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+WGS84_WKID = 4326
+DEFAULT_COORDINATE_PRECISION = 7
+GZIP_COMPRESSION_LEVEL = 9
+BROTLI_COMPRESSION_QUALITY = 11
+
+# Extension appended to the output path for each supported pre-compressed sibling
+COMPRESSION_EXTENSIONS = {
+    'gzip': '.gz',
+    'br': '.br',
+}
+
+def round_coordinates(coordinates, precision):
+    """Recursively rounds a (possibly nested) GeoJSON coordinate array to the given number of decimals"""
+
+    if isinstance(coordinates, (int, float)):
+        return round(coordinates, precision)
+
+    return [round_coordinates(c, precision) for c in coordinates]
+
+def read_features(input_path, wkid=WGS84_WKID):
+    """
+    Yields GeoJSON features from a feature class, projecting each geometry to the given spatial reference as it is read
+    All non-geometry fields are written as feature properties
+    """
+
+    import arcpy
+
+    fields = [f.name for f in arcpy.ListFields(input_path) if f.type != 'Geometry']
+
+    with arcpy.da.SearchCursor(input_path, ['SHAPE@'] + fields, spatial_reference=arcpy.SpatialReference(wkid)) as cursor:
+        for row in cursor:
+            geometry = row[0]
+
+            yield {
+                'type': 'Feature',
+                'geometry': geometry.__geo_interface__ if geometry else None,
+                'properties': dict(zip(fields, row[1:])),
+            }
+
+def discard_sinks(sinks):
+    """Closes sinks and deletes their temporary files"""
+
+    for _, temp_path, sink in sinks:
+        try:
+            sink.close()
+        except Exception:
+            pass
+
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def open_sinks(output_path, compress, log=print):
+    """
+    Opens the output file and any requested pre-compressed siblings, returning a list of (path, temp path, writer) tuples
+    If a sink cannot be opened, the sinks already opened are closed and their temporary files deleted
+    """
+
+    for method in compress or []:
+        if method not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f'Unsupported compression method {method} (allowed: {", ".join(COMPRESSION_EXTENSIONS)})')
+
+    sinks = []
+
+    try:
+        sinks.append((output_path, f'{output_path}.tmp', open(f'{output_path}.tmp', 'wb')))
+
+        for method in compress or []:
+            path = output_path + COMPRESSION_EXTENSIONS[method]
+
+            if method == 'gzip':
+                sinks.append((path, f'{path}.tmp', gzip.open(f'{path}.tmp', 'wb', compresslevel=GZIP_COMPRESSION_LEVEL)))
+            elif brotli is None:
+                log(f'Brotli is not installed, skipping {path}')
+            else:
+                sinks.append((path, f'{path}.tmp', BrotliWriter(f'{path}.tmp')))
+    except BaseException:
+        discard_sinks(sinks)
+        raise
+
+    return sinks
+
+class BrotliWriter:
+    """Minimal file-like wrapper that streams bytes through a brotli compressor"""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.compressor = brotli.Compressor(quality=BROTLI_COMPRESSION_QUALITY)
+
+    def write(self, data):
+        self.file.write(self.compressor.process(data))
+
+    def close(self):
+        self.file.write(self.compressor.finish())
+        self.file.close()
+
+def write_feature_collection(features, output_path, precision=DEFAULT_COORDINATE_PRECISION, compress=None, log=print):
+    """
+    Streams GeoJSON features to output_path as a FeatureCollection, rounding coordinates to the given precision
+    Each sibling in `compress` (e.g. ['gzip', 'br']) is written in the same pass. All files are written to temporary
+    paths and renamed into place once complete, so a failed export never leaves a truncated index behind.
+    Returns the number of features written
+    """
+
+    sinks = open_sinks(output_path, compress, log)
+    count = 0
+
+    def write(data):
+        for _, _, sink in sinks:
+            sink.write(data)
+
+    try:
+        write(b'{"type":"FeatureCollection","features":[')
+
+        for feature in features:
+            if feature['geometry']:
+                feature['geometry']['coordinates'] = round_coordinates(feature['geometry']['coordinates'], precision)
+
+            write((b',' if count else b'') + json.dumps(feature, separators=(',', ':'), default=str).encode('utf-8'))
+            count += 1
+
+        write(b']}')
+    except BaseException:
+        discard_sinks(sinks)
+        raise
+
+    for _, _, sink in sinks:
+        sink.close()
+
+    for path, temp_path, _ in sinks:
+        os.replace(temp_path, path)
+
+    return count
+
+def export_feature_class(input_path, output_path, precision=DEFAULT_COORDINATE_PRECISION, compress=None, log=print):
+    """Projects a feature class to WGS84 and writes it to output_path as GeoJSON in a single streaming pass"""
+
+    return write_feature_collection(read_features(input_path), output_path, precision, compress, log)
+
+def remove_precompressed_siblings(output_path):
+    """Deletes any pre-compressed siblings of output_path left over from a previous export"""
+
+    for extension in COMPRESSION_EXTENSIONS.values():
+        if os.path.isfile(output_path + extension):
+            os.remove(output_path + extension)
@@ -0,0 +1,201 @@
+"""
+Script Name: Scratch Retention
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Retention policy for the intermediate data Contouring.py leaves in a county folder. The WIP geodatabases
+(Contour_Lines_WIP.gdb with the mosaic dataset, Contour_Lines_WIP_SP.gdb) are only needed while a county is being
+processed, but they are never removed and fill the data drive over a state-scale batch. Once the final outputs of a
+county have been verified, every artifact listed in RETENTION_POLICY is measured, and then deleted, compacted or kept
+according to the policy. The size of every artifact before and after (and the action taken) is appended to the
+shared scratch usage history, so the disk usage of each step's output can be tracked per county.
+
+A county's outputs are verified when its progress file reports the last step as completed and no step in progress,
+the tile folders contain files, and the index GeoJSON is complete (parses as a FeatureCollection).
+
+Contouring_Batch.py applies the policy in a background thread to every county as soon as it completes, and uses the
+free space reported by that thread to decide whether another county can be started.
+
+Dependencies:
+- Compacting the output geodatabase requires ArcGIS Pro (arcpy). Without it, compaction is skipped.
+
+Usage:
+    Apply the policy to every completed county of a state (e.g. counties processed before the batch scheduler did it):
+        python Scratch_Retention.py Z:\\ALABAMA
+    Report artifact sizes and verification results without deleting or compacting anything:
+        python Scratch_Retention.py Z:\\ALABAMA --dry-run
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import datetime
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+PROGRESS_FILE = 'contouring_progress.json'
+# Last step of Contouring.py, a county is complete once it has been completed
+FINAL_STEP = 'index_export_geojson'
+SHAPEFILE_OUTPUT_FOLDER = 'Shapefiles'
+DWG_OUTPUT_FOLDER = 'Dwg_Files'
+CONTOURS_INDEX_JSON = 'Contours_Index.geojson'
+CONTOURS_FOLDER_PATTERN = re.compile(r'^(.+)_Contours$')
+
+# Action taken on each artifact of a verified county: 'delete', 'compact' (file geodatabases only) or 'keep'
+# {locality} is replaced with the county's locality name
+RETENTION_POLICY = {
+    'Contour_Lines_WIP.gdb': 'delete',
+    'Contour_Lines_WIP_SP.gdb': 'delete',
+    '{locality}_Contours.gdb': 'compact',
+    SHAPEFILE_OUTPUT_FOLDER: 'keep',
+    DWG_OUTPUT_FOLDER: 'keep',
+    '{locality}_' + CONTOURS_INDEX_JSON: 'keep',
+}
+
+# Past tense of the retention actions, for the log
+ACTION_LOG_NAMES = {'delete': 'Deleted', 'compact': 'Compacted'}
+
+def path_size(path):
+    """Returns the total size in bytes of a file or folder (0 if it does not exist)"""
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                continue
+
+    return size
+
+def read_progress(county_dir):
+    try:
+        with open(os.path.join(county_dir, PROGRESS_FILE)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def verify_outputs(county_dir, locality):
+    """
+    Checks that a county has completed and its final outputs are in place
+    Returns (True, None) or (False, reason)
+    """
+
+    progress = read_progress(county_dir)
+    if not progress or progress.get('last_completed_step') != FINAL_STEP or progress.get('current_step'):
+        return False, 'county has not completed'
+
+    for folder in [SHAPEFILE_OUTPUT_FOLDER, DWG_OUTPUT_FOLDER]:
+        path = os.path.join(county_dir, folder)
+        if not os.path.isdir(path) or not any(os.scandir(path)):
+            return False, f'{folder} is missing or empty'
+
+    index_geojson = os.path.join(county_dir, f'{locality}_{CONTOURS_INDEX_JSON}')
+    try:
+        with open(index_geojson) as file:
+            if json.load(file).get('type') != 'FeatureCollection':
+                return False, f'{index_geojson} is not a FeatureCollection'
+    except (OSError, ValueError) as e:
+        return False, f'{index_geojson} is missing or incomplete ({e})'
+
+    return True, None
+
+def apply_policy(county_dir, locality, dry_run=False, log=print):
+    """
+    Measures every artifact of a county and, once its outputs are verified, deletes or compacts it as configured
+    Returns a list of {artifact, action, bytes, bytes_after} records (empty if the outputs could not be verified)
+    """
+
+    verified, reason = verify_outputs(county_dir, locality)
+    if not verified:
+        log(f'Keeping scratch data of {county_dir}: {reason}')
+        return []
+
+    records = []
+
+    for artifact, action in RETENTION_POLICY.items():
+        path = os.path.join(county_dir, artifact.format(locality=locality))
+        if not os.path.exists(path):
+            continue
+
+        size = path_size(path)
+
+        if action == 'compact' and arcpy is None:
+            action = 'keep'
+
+        if dry_run:
+            if action != 'keep':
+                log(f'Would {action} {path} ({size / 1024 ** 3:.2f} GB)')
+            records.append({'artifact': os.path.basename(path), 'action': action, 'bytes': size, 'bytes_after': size})
+            continue
+
+        if action == 'delete':
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        elif action == 'compact':
+            arcpy.management.Compact(path)
+
+        size_after = path_size(path)
+        records.append({'artifact': os.path.basename(path), 'action': action, 'bytes': size, 'bytes_after': size_after})
+
+        if action != 'keep':
+            log(f'{ACTION_LOG_NAMES[action]} {path}: {size / 1024 ** 3:.2f} GB -> {size_after / 1024 ** 3:.2f} GB')
+
+    return records
+
+def record_usage(usage_file, state, locality, records):
+    """Appends the artifact sizes of a county to the shared scratch usage history"""
+
+    os.makedirs(os.path.dirname(usage_file), exist_ok=True)
+    timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+
+    with open(usage_file, 'a') as file:
+        for record in records:
+            file.write(json.dumps({'time': timestamp, 'state': state, 'locality': locality, **record}) + '\n')
+
+def sweep(state_dir, usage_file=None, dry_run=False, log=print):
+    """Applies the retention policy to every county folder of a state, returning the number of bytes freed"""
+
+    state = os.path.basename(os.path.normpath(state_dir))
+    freed = 0
+
+    for entry in sorted(os.scandir(state_dir), key=lambda entry: entry.name):
+        match = CONTOURS_FOLDER_PATTERN.match(entry.name)
+        if not entry.is_dir() or not match:
+            continue
+
+        records = apply_policy(entry.path, match.group(1), dry_run, log)
+        freed += sum(record['bytes'] - record['bytes_after'] for record in records)
+
+        if records and usage_file and not dry_run:
+            record_usage(usage_file, state, match.group(1), records)
+
+    return freed
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('state_dir', help="State folder containing the {COUNTY}_Contours folders (e.g. Z:\\ALABAMA)")
+    parser.add_argument('--usage-file', help="Scratch usage history to append artifact sizes to")
+    parser.add_argument('--dry-run', action='store_true', help="Report artifact sizes without deleting or compacting anything")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.state_dir):
+        print(f"Error: Folder '{args.state_dir}' does not exist. Exiting.")
+        sys.exit(1)
+
+    freed = sweep(args.state_dir, args.usage_file, args.dry_run)
+    print(f"{'Would free' if args.dry_run else 'Freed'} {freed / 1024 ** 3:.2f} GB in {args.state_dir}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+"""
+Script Name: State Tile Index
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Merges the `{LOCALITY}_Contours_Index.geojson` files of every county under one or more state folders into a single
+tile index file, and answers "which county and tile covers this point or bounding box" against it. Tiles are sorted
+along a Hilbert curve and packed into a static R-tree (each node holds up to NODE_SIZE children), so lookups only
+visit a handful of nodes even for 100k+ tiles.
+
+Rebuilds are incremental: the size and modification time of every county index file is stored in the merged file,
+and only counties whose index changed since the last build are re-read. Sorting and packing the tree is done in
+memory, so an incremental rebuild costs little more than reading and writing the merged file.
+
+Usage:
+1. Build (or incrementally rebuild) the merged index for a state:
+    python Z:\\Clearinghouse_Support\\python\\State_Tile_Index.py build Z:\\SOUTH_CAROLINA
+
+    Several state folders may be given to build a multi-state index, in which case --output is required.
+
+2. Find the tiles that intersect a bounding box (WGS84 longitude/latitude):
+    python Z:\\Clearinghouse_Support\\python\\State_Tile_Index.py bbox Z:\\SOUTH_CAROLINA\\SOUTH_CAROLINA_Tile_Index.json -82.5 34.1 -82.3 34.3
+
+3. Find the tile that covers a point (WGS84 longitude/latitude):
+    python Z:\\Clearinghouse_Support\\python\\State_Tile_Index.py point Z:\\SOUTH_CAROLINA\\SOUTH_CAROLINA_Tile_Index.json -82.41 34.22
+
+From Python:
+    import State_Tile_Index
+    index = State_Tile_Index.load_index('Z:\\SOUTH_CAROLINA\\SOUTH_CAROLINA_Tile_Index.json')
+    State_Tile_Index.tiles_for_bbox(index, -82.5, 34.1, -82.3, 34.3)
+    State_Tile_Index.tile_for_point(index, -82.41, 34.22)
+"""
+
+import os
+import sys
+import json
+import argparse
+
+INDEX_FILE_VERSION = 1
+INDEX_FILE_SUFFIX = '_Tile_Index.json'
+COUNTY_FOLDER_SUFFIX = '_Contours'
+COUNTY_INDEX_SUFFIX = '_Contours_Index.geojson'
+TILE_NAME_FIELD = 'TILE_NUM'
+NODE_SIZE = 16
+HILBERT_BITS = 16
+
+_LOADED_INDEXES = {}
+
+#region Geometry Helpers
+def geometry_bbox(geometry):
+    """Returns the [minx, miny, maxx, maxy] bounding box of a GeoJSON Polygon or MultiPolygon"""
+
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    xs = [p[0] for polygon in polygons for ring in polygon for p in ring]
+    ys = [p[1] for polygon in polygons for ring in polygon for p in ring]
+
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+def ring_contains(ring, x, y):
+    """Ray casting test for a single linear ring"""
+
+    inside = False
+    j = len(ring) - 1
+
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+
+        j = i
+
+    return inside
+
+def geometry_contains(geometry, x, y):
+    """Tests whether a GeoJSON Polygon or MultiPolygon contains the given point (holes are respected)"""
+
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+
+    for polygon in polygons:
+        if ring_contains(polygon[0], x, y) and not any(ring_contains(hole, x, y) for hole in polygon[1:]):
+            return True
+
+    return False
+
+def hilbert_value(x, y, bits=HILBERT_BITS):
+    """Returns the distance along a Hilbert curve of order `bits` for the integer grid cell (x, y)"""
+
+    d = 0
+    s = 1 << (bits - 1)
+
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+
+        s >>= 1
+
+    return d
+#endregion
+
+#region Packed R-Tree
+def pack_tree(boxes, node_size=NODE_SIZE):
+    """
+    Packs a list of (already Hilbert sorted) item boxes into a static R-tree
+    Returns the flat list of node boxes (leaves first, root last) and the end offset of each level
+    """
+
+    nodes = list(boxes)
+    level_bounds = [len(nodes)]
+    start = 0
+
+    while level_bounds[-1] - start > 1:
+        end = level_bounds[-1]
+
+        for i in range(start, end, node_size):
+            children = nodes[i:min(i + node_size, end)]
+            nodes.append([
+                min(b[0] for b in children),
+                min(b[1] for b in children),
+                max(b[2] for b in children),
+                max(b[3] for b in children),
+            ])
+
+        start = end
+        level_bounds.append(len(nodes))
+
+    return nodes, level_bounds
+
+def search_tree(index, minx, miny, maxx, maxy):
+    """Yields the positions of all tiles whose bounding boxes intersect the given bounding box"""
+
+    nodes = index['tree']['nodes']
+    level_bounds = index['tree']['level_bounds']
+    node_size = index['tree']['node_size']
+
+    if not nodes:
+        return
+
+    # Each stack entry is (first node, level) of a group of sibling nodes
+    stack = [(len(nodes) - 1, len(level_bounds) - 1)]
+
+    while stack:
+        first, level = stack.pop()
+        level_start = level_bounds[level - 1] if level > 0 else 0
+        end = min(first + node_size, level_bounds[level]) if level < len(level_bounds) - 1 else first + 1
+
+        for i in range(first, end):
+            box = nodes[i]
+
+            if box[0] > maxx or box[1] > maxy or box[2] < minx or box[3] < miny:
+                continue
+
+            if level == 0:
+                yield i
+            else:
+                child_level_start = level_bounds[level - 2] if level > 1 else 0
+                stack.append((child_level_start + (i - level_start) * node_size, level - 1))
+#endregion
+
+#region Build
+def find_county_indexes(state_dirs):
+    """Finds the county index GeoJSON files in the given state folders, keyed by STATE/LOCALITY"""
+
+    county_indexes = {}
+
+    for state_dir in state_dirs:
+        state = os.path.basename(os.path.normpath(state_dir))
+
+        for entry in os.scandir(state_dir):
+            if not entry.is_dir() or not entry.name.endswith(COUNTY_FOLDER_SUFFIX) or 'Empty' in entry.name:
+                continue
+
+            locality = entry.name[:-len(COUNTY_FOLDER_SUFFIX)]
+            path = os.path.join(entry.path, f'{locality}{COUNTY_INDEX_SUFFIX}')
+
+            if os.path.isfile(path):
+                county_indexes[f'{state}/{locality}'] = path
+
+    return county_indexes
+
+def read_county_tiles(county, path):
+    """Reads the tiles of a single county index file"""
+
+    with open(path) as file:
+        features = json.load(file)['features']
+
+    tiles = []
+
+    for feature in features:
+        if not feature.get('geometry'):
+            continue
+
+        tiles.append({
+            'county': county,
+            'tile': feature['properties'].get(TILE_NAME_FIELD),
+            'bbox': geometry_bbox(feature['geometry']),
+            'geometry': feature['geometry'],
+            'properties': feature['properties'],
+        })
+
+    return tiles
+
+def build_index(state_dirs, output_path, rebuild=False):
+    """
+    Builds the merged tile index for the given state folders and writes it to output_path
+    Unless `rebuild` is set, counties whose index file is unchanged since the previous build are not re-read
+    """
+
+    previous = {'counties': {}, 'tiles': []}
+
+    if not rebuild and os.path.isfile(output_path):
+        with open(output_path) as file:
+            previous = json.load(file)
+
+        if previous.get('version') != INDEX_FILE_VERSION:
+            previous = {'counties': {}, 'tiles': []}
+
+    previous_tiles = {}
+    for tile in previous['tiles']:
+        previous_tiles.setdefault(tile['county'], []).append(tile)
+
+    counties = {}
+    tiles = []
+    reread = 0
+
+    for county, path in sorted(find_county_indexes(state_dirs).items()):
+        stat = os.stat(path)
+        source = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        cached = previous['counties'].get(county)
+
+        if cached and cached['size'] == source['size'] and cached['mtime'] == source['mtime']:
+            county_tiles = previous_tiles.get(county, [])
+        else:
+            print(f'Reading {path}')
+            county_tiles = read_county_tiles(county, path)
+            reread += 1
+
+        source['tiles'] = len(county_tiles)
+        counties[county] = source
+        tiles.extend(county_tiles)
+
+    removed = len(set(previous['counties']) - set(counties))
+
+    # Sort tiles along a Hilbert curve over the full extent so that neighbouring tiles share tree nodes
+    if tiles:
+        minx = min(t['bbox'][0] for t in tiles)
+        miny = min(t['bbox'][1] for t in tiles)
+        width = (max(t['bbox'][2] for t in tiles) - minx) or 1
+        height = (max(t['bbox'][3] for t in tiles) - miny) or 1
+        scale = (1 << HILBERT_BITS) - 1
+
+        def sort_key(tile):
+            x = int(scale * ((tile['bbox'][0] + tile['bbox'][2]) / 2 - minx) / width)
+            y = int(scale * ((tile['bbox'][1] + tile['bbox'][3]) / 2 - miny) / height)
+            return hilbert_value(x, y)
+
+        tiles.sort(key=sort_key)
+
+    nodes, level_bounds = pack_tree([t['bbox'] for t in tiles])
+
+    index = {
+        'version': INDEX_FILE_VERSION,
+        'counties': counties,
+        'tiles': tiles,
+        'tree': {'node_size': NODE_SIZE, 'level_bounds': level_bounds, 'nodes': nodes},
+    }
+
+    # json.dumps uses the C encoder, json.dump to a file does not
+    with open(f'{output_path}.tmp', 'w') as file:
+        file.write(json.dumps(index, separators=(',', ':')))
+    os.replace(f'{output_path}.tmp', output_path)
+
+    print(f'Wrote {len(tiles)} tiles from {len(counties)} counties to {output_path} ({reread} re-read, {removed} removed)')
+
+    return index
+#endregion
+
+#region Query API
+def load_index(path):
+    """Loads a merged tile index, reusing the already loaded copy if the file has not changed"""
+
+    mtime = os.stat(path).st_mtime
+    cached = _LOADED_INDEXES.get(path)
+
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path) as file:
+        index = json.load(file)
+
+    _LOADED_INDEXES[path] = (mtime, index)
+
+    return index
+
+def tiles_for_bbox(index, minx, miny, maxx, maxy):
+    """Returns every tile (county, tile name, properties, ...) whose bounding box intersects the given bounding box"""
+
+    return [index['tiles'][i] for i in search_tree(index, minx, miny, maxx, maxy)]
+
+def tile_for_point(index, x, y):
+    """Returns the tile that covers the given point, or None if no tile covers it"""
+
+    for i in search_tree(index, x, y, x, y):
+        tile = index['tiles'][i]
+
+        if geometry_contains(tile['geometry'], x, y):
+            return tile
+
+    return None
+#endregion
+
+#region Main
+def default_output_path(state_dir):
+    state = os.path.basename(os.path.normpath(state_dir))
+    return os.path.join(state_dir, f'{state}{INDEX_FILE_SUFFIX}')
+
+def print_tile(tile):
+    print(f"{tile['county']} {tile['tile']} {json.dumps(tile['properties'], default=str)}")
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build or incrementally update a merged tile index')
+    build_parser.add_argument('state_dirs', nargs='+', help='State folder(s) containing *_Contours county folders (e.g. Z:\\SOUTH_CAROLINA)')
+    build_parser.add_argument('-o', '--output', default=None, help=f'Output index file (default: <state folder>\\<STATE>{INDEX_FILE_SUFFIX})')
+    build_parser.add_argument('--rebuild', action='store_true', help='Re-read every county index file instead of only changed ones')
+
+    bbox_parser = subparsers.add_parser('bbox', help='List the tiles intersecting a bounding box')
+    bbox_parser.add_argument('index', help='Merged tile index file')
+    for name in ['minx', 'miny', 'maxx', 'maxy']:
+        bbox_parser.add_argument(name, type=float)
+
+    point_parser = subparsers.add_parser('point', help='Find the tile covering a point')
+    point_parser.add_argument('index', help='Merged tile index file')
+    point_parser.add_argument('x', type=float, help='Longitude')
+    point_parser.add_argument('y', type=float, help='Latitude')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if not args.output and len(args.state_dirs) > 1:
+            parser.error('--output is required when building an index for more than one state folder')
+
+        build_index(args.state_dirs, args.output or default_output_path(args.state_dirs[0]), rebuild=args.rebuild)
+
+    elif args.command == 'bbox':
+        tiles = tiles_for_bbox(load_index(args.index), args.minx, args.miny, args.maxx, args.maxy)
+        for tile in tiles:
+            print_tile(tile)
+        print(f'{len(tiles)} tiles found')
+
+    elif args.command == 'point':
+        tile = tile_for_point(load_index(args.index), args.x, args.y)
+        if tile:
+            print_tile(tile)
+        else:
+            print('No tile covers the given point')
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+#endregion
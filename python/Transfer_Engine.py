@@ -0,0 +1,690 @@
+"""
+Script Name: Transfer Engine
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Shared transfer engine of the scripts that copy the contour outputs of a state somewhere else
+(Transfer_State_Contours_To_AWS.py, Transfer_State_Contours_To_External_HD.py). It provides:
+- A file walker that finds the {COUNTY}_County_Contours folders of a state and lists the files of their artifacts
+  (e.g. Shapefiles, Dwg_Files, the index GeoJSON) with the stat information collected while scanning. os.scandir
+  returns the size and modification time of every file with the directory listing on Windows (and caches the stat
+  result elsewhere), so no file is stat'ed twice. scan_counties() scans SCAN_WORKERS county folders in parallel, which
+  hides the latency of network shares.
+- A bounded worker pool: files are only queued once a worker is free to take them, so a state with millions of files
+  does not queue millions of tasks.
+- An adaptive concurrency controller per destination, which sets how many files are in flight (AIMD, see below).
+- A byte-rate limiter (token bucket) shared by all workers of a destination, which also measures the throughput.
+- Per-file checksums, computed while the data is transferred.
+- A verified copy primitive (copy_file_verified) for disk destinations: the source is read once with large buffers,
+  hashed with the fastest available hash (FAST_HASH_ALGORITHM) while the data is written to a .partial file, which is
+  renamed into place once complete. On Linux, the data is copied by the kernel (os.copy_file_range) from the pages
+  that were just read for hashing. The hash is recorded in the journal, so a copy can later be verified by re-hashing
+  only the copy and comparing with the recorded hash, without reading the source again.
+- A resumable journal (JSON lines, one record per transferred file with its key, local path, size, modification
+  time and checksum). Files whose journal record matches their size and modification time are skipped without
+  being read, so an interrupted run resumes where it stopped.
+
+Adaptive concurrency:
+One thread per county (as the copy scripts used to do) thrashes a single USB disk, and too few uploads leave the
+uplink idle. Instead, transfers start with INITIAL_CONCURRENCY files in flight, and every CONTROL_INTERVAL seconds
+the controller compares the goodput (bytes sent through the rate limiter and files completed per second) and the
+latency (seconds per MB of the transfers that completed, per file size class, as small files always take longer per MB
+than large ones) with the recent past:
+- Additive increase: while all slots are in use and there is no sign of congestion, one more file is let in flight,
+  up to the maximum concurrency. Going back to the concurrency at which congestion was last seen is only tried again
+  after PROBE_INTERVALS intervals without congestion, so the concurrency does not keep oscillating around that point.
+- Multiplicative decrease: when transfers fail, the concurrency is multiplied by DECREASE_FACTOR. So it is when, for
+  CONGESTION_INTERVALS consecutive intervals, the latency rises LATENCY_FACTOR above the best latency of the last
+  LATENCY_WINDOW intervals (more files in flight only make each one slower, as on a spinning disk or a saturated
+  uplink), or both the bytes and the files per second drop by more than THROUGHPUT_LOSS (a change in the mix of file
+  sizes moves them in opposite directions). A single noisy interval therefore does not cut the concurrency.
+The concurrency therefore settles just below the point where adding transfers stops adding throughput, and follows
+it when the conditions change (e.g. other traffic on the uplink). It can also be fixed (adaptive=False).
+
+Destinations are pluggable. A destination is a dict with a 'name' and a 'transfer' function
+    transfer(task, entry, limiter) -> (new journal entry, whether data was transferred)
+that is given a task (a dict with at least 'key' and 'path'), the task's previous journal entry (or None) and the
+rate limiter, which it calls with the size of every chunk it sends. disk_destination() copies files below a root
+folder, which may be a local or removable disk (E:\\) or a network share (\\\\server\\share). The S3 destination
+(which needs boto3) is defined in Transfer_State_Contours_To_AWS.py.
+
+Dependencies:
+- Optional: xxhash (pip install xxhash) or blake3 (pip install blake3) for faster checksums of disk copies. Without
+  them, BLAKE2b (hashlib) is used.
+
+Usage:
+    import Transfer_Engine as engine
+
+    journal = engine.open_journal('E:\\SOUTH_CAROLINA\\.transfer_journal.jsonl')
+    tasks = [engine.file_task(path, f"{county_name}/{relative_path}", stat, county)
+             for path, relative_path, stat in engine.county_files(county_folder, ['Shapefiles', 'Dwg_Files'])]
+    results = engine.run_transfers([(county, journal, tasks)], engine.disk_destination('E:\\SOUTH_CAROLINA'))
+    engine.close_journal(journal)
+"""
+
+import os
+import json
+import errno
+import time
+import bisect
+import collections
+import shutil
+import hashlib
+import datetime
+import threading
+import concurrent.futures
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+#region Config Vars
+COUNTY_FOLDER_PATTERN = '_County_Contours'
+DEFAULT_CONCURRENCY = 8
+# Number of county folders scanned at the same time
+SCAN_WORKERS = 16
+# Seconds between overall throughput reports
+PROGRESS_INTERVAL = 10
+
+# Adaptive concurrency (AIMD): number of files in flight at the start, and seconds between adjustments
+INITIAL_CONCURRENCY = 2
+CONTROL_INTERVAL = 5
+# Congestion: seconds per MB this factor above the best of the last LATENCY_WINDOW intervals (in the same file size
+# class), or a drop of both bytes and files per second of more than THROUGHPUT_LOSS (relative to the previous interval)
+LATENCY_FACTOR = 1.25
+LATENCY_WINDOW = 12
+THROUGHPUT_LOSS = 0.15
+# Upper bounds in bytes of the file size classes whose latencies are compared
+LATENCY_SIZE_CLASSES = [1024 ** 2, 16 * 1024 ** 2, 256 * 1024 ** 2]
+# Consecutive intervals with a sign of congestion before the concurrency is decreased (failures decrease it at once)
+CONGESTION_INTERVALS = 2
+# Factor applied to the concurrency on congestion
+DECREASE_FACTOR = 0.75
+# Intervals without congestion before the concurrency at which congestion was last seen is tried again
+PROBE_INTERVALS = 6
+HASH_ALGORITHM = 'md5'
+# Hash of copies to disk destinations: XXH3 (128 bit) or BLAKE3 if installed, else BLAKE2b
+FAST_HASH_ALGORITHM = 'xxh3_128' if xxhash else 'blake3' if blake3 else 'blake2b'
+CHUNK_SIZE = 8 * 1024 * 1024
+# Journal records written between forced writes to disk (records are always flushed to the OS right away)
+JOURNAL_SYNC_INTERVAL = 100
+# Suffix of files being copied by disk_destination(), renamed into place once complete
+PARTIAL_SUFFIX = '.partial'
+#endregion
+
+#region File Walker
+def find_county_folders(state_dir):
+    """Returns the paths of the county folders of a state, skipping folders of counties without data ('Empty')"""
+
+    return sorted(
+        f.path for f in os.scandir(state_dir)
+        if f.is_dir()
+        and COUNTY_FOLDER_PATTERN in f.name
+        and 'Empty' not in f.name
+    )
+
+def walk_files(folder):
+    """Yields (path, stat) for every file below a folder, reusing the stat information gathered by scandir"""
+
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return
+
+    for entry in sorted(entries, key=lambda entry: entry.name):
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_files(entry.path)
+        elif entry.is_file():
+            yield entry.path, entry.stat()
+
+def county_files(county_folder, artifacts):
+    """
+    Lists the files of the given artifacts of a county folder as (path, relative path, stat) tuples
+    Artifacts are file or folder names relative to the county folder, in which {county} is replaced with the name of
+    the county folder. Relative paths use '/' as separator. Missing artifacts are skipped
+    """
+
+    county = os.path.basename(county_folder)
+    files = []
+
+    for artifact in artifacts:
+        path = os.path.join(county_folder, artifact.format(county=county))
+
+        if os.path.isfile(path):
+            files.append((path, os.path.relpath(path, county_folder).replace(os.sep, '/'), os.stat(path)))
+        elif os.path.isdir(path):
+            for file_path, stat in walk_files(path):
+                files.append((file_path, os.path.relpath(file_path, county_folder).replace(os.sep, '/'), stat))
+
+    return files
+
+def scan_counties(county_folders, artifacts, workers=SCAN_WORKERS):
+    """Lists the files of the given artifacts of several county folders in parallel, returning {county folder: files}"""
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(county_folders, executor.map(lambda folder: county_files(folder, artifacts), county_folders)))
+
+def file_task(path, key, stat, group, **details):
+    """Creates the task of transferring a file to the given destination key"""
+
+    return {'key': key, 'path': path, 'size': stat.st_size, 'mtime': int(stat.st_mtime), 'group': group, **details}
+#endregion
+
+#region Checksums
+# Cleared when the kernel refuses copy_file_range (e.g. between file systems on older kernels)
+KERNEL_COPY = hasattr(os, 'copy_file_range')
+
+def new_hash(algorithm=HASH_ALGORITHM):
+    if algorithm == 'xxh3_128':
+        return xxhash.xxh3_128()
+    if algorithm == 'blake3':
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+def file_hash(path, algorithm=HASH_ALGORITHM):
+    data_hash = new_hash(algorithm)
+    buffer = bytearray(CHUNK_SIZE)
+
+    with open(path, 'rb', buffering=0) as file:
+        while size := file.readinto(buffer):
+            data_hash.update(memoryview(buffer)[:size])
+
+    return data_hash.hexdigest()
+
+def stream_copy(source, output, data_hash, limiter):
+    """Copies an open file into another through one reusable buffer, hashing the data. Returns the bytes copied"""
+
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    total = 0
+
+    while size := source.readinto(buffer):
+        if limiter:
+            throttle(limiter, size)
+        data_hash.update(view[:size])
+        output.write(view[:size])
+        total += size
+
+    return total
+
+def kernel_copy(source, output, data_hash, limiter):
+    """
+    Copies an open file into another with os.copy_file_range, hashing each chunk as it is read
+    The chunk is read (and hashed) first, so the kernel copies it from the page cache without reading the disk again.
+    Returns the bytes copied
+    """
+
+    offset = 0
+
+    while chunk := os.pread(source.fileno(), CHUNK_SIZE, offset):
+        if limiter:
+            throttle(limiter, len(chunk))
+        data_hash.update(chunk)
+
+        copied = 0
+        while copied < len(chunk):
+            count = os.copy_file_range(source.fileno(), output.fileno(), len(chunk) - copied, offset + copied, offset + copied)
+            if count == 0:
+                raise OSError(f'copy_file_range copied nothing at offset {offset + copied}')
+            copied += count
+
+        offset += len(chunk)
+
+    return offset
+
+def copy_file_verified(source, destination, algorithm=FAST_HASH_ALGORITHM, limiter=None, verify=False):
+    """
+    Copies a file through a .partial file, hashing the data as it is read, and renames the copy into place
+    With verify, the copy is read back and its hash compared with the source's before it is renamed
+    Returns the size and hash of the data copied
+    """
+
+    global KERNEL_COPY
+
+    temp_path = destination + PARTIAL_SUFFIX
+
+    try:
+        while True:
+            data_hash = new_hash(algorithm)
+
+            with open(source, 'rb', buffering=0) as input_file, open(temp_path, 'wb') as output_file:
+                try:
+                    size = (kernel_copy if KERNEL_COPY else stream_copy)(input_file, output_file, data_hash, limiter)
+                    break
+                except OSError as e:
+                    if not KERNEL_COPY or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+
+            # Copy again without the kernel (the bytes already sent through the limiter are accounted twice)
+            KERNEL_COPY = False
+
+        digest = data_hash.hexdigest()
+
+        if verify and file_hash(temp_path, algorithm) != digest:
+            raise Exception(f'Checksum mismatch copying {source} to {destination}')
+
+        shutil.copystat(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        # Leave no .partial file behind for a failed (or interrupted) copy
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return size, digest
+#endregion
+
+#region Journal
+def open_journal(path):
+    """
+    Opens a transfer journal for appending, loading the latest record of every key
+    A record cut short by an interrupted run (the last line) is ignored
+    """
+
+    entries = {}
+    records = 0
+
+    if os.path.isfile(path):
+        with open(path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                key = record.pop('key')
+                if record.get('removed'):
+                    entries.pop(key, None)
+                else:
+                    entries[key] = record
+                records += 1
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    return {'path': path, 'entries': entries, 'records': records, 'unsynced': 0, 'file': open(path, 'a'), 'lock': threading.Lock()}
+
+def write_journal_record(journal, record):
+    journal['file'].write(json.dumps(record) + '\n')
+    journal['file'].flush()
+    journal['records'] += 1
+    journal['unsynced'] += 1
+
+    if journal['unsynced'] >= JOURNAL_SYNC_INTERVAL:
+        os.fsync(journal['file'].fileno())
+        journal['unsynced'] = 0
+
+def journal_record(journal, key, entry):
+    with journal['lock']:
+        journal['entries'][key] = entry
+        write_journal_record(journal, {'key': key, **entry})
+
+def journal_remove(journal, key):
+    with journal['lock']:
+        if journal['entries'].pop(key, None) is not None:
+            write_journal_record(journal, {'key': key, 'removed': True})
+
+def compact_journal(journal):
+    """Rewrites a journal with a single record per key"""
+
+    with journal['lock']:
+        journal['file'].close()
+
+        with open(f"{journal['path']}.tmp", 'w') as file:
+            for key, entry in journal['entries'].items():
+                file.write(json.dumps({'key': key, **entry}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(f"{journal['path']}.tmp", journal['path'])
+        journal['file'] = open(journal['path'], 'a')
+        journal['records'] = len(journal['entries'])
+        journal['unsynced'] = 0
+
+def close_journal(journal):
+    """Closes a journal, compacting it first if most of its records have been superseded"""
+
+    if journal['records'] > 2 * len(journal['entries']) + JOURNAL_SYNC_INTERVAL:
+        compact_journal(journal)
+
+    with journal['lock']:
+        journal['file'].flush()
+        os.fsync(journal['file'].fileno())
+        journal['file'].close()
+
+def is_current(entry, task):
+    """
+    Whether a journal entry is up to date with a task: for generated content (e.g. a zip bundle) its signature must
+    match, for a file its local path, size and modification time
+    """
+
+    if entry is None:
+        return False
+
+    if 'signature' in task:
+        return entry.get('signature') == task['signature']
+
+    return entry.get('path') == task['path'] and entry['size'] == task['size'] and entry.get('mtime') == task['mtime']
+
+def journal_entry(task, data_hash, **details):
+    """Creates the journal entry of a file that has been transferred"""
+
+    entry = {
+        'path': task['path'],
+        'size': task['size'],
+        'mtime': task['mtime'],
+        'hash': data_hash,
+        'transferred': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+
+    return {**entry, **details}
+#endregion
+
+#region Rate Limiting
+def rate_limiter(bytes_per_second=None):
+    """
+    Creates the token bucket shared by the workers of a destination (unlimited if bytes_per_second is not set)
+    It also counts the bytes sent through it, which is the throughput reported by run_transfers()
+    """
+
+    return {'rate': bytes_per_second, 'allowance': 0.0, 'last': time.monotonic(), 'bytes': 0, 'lock': threading.Lock()}
+
+def throttle(limiter, size):
+    """Accounts for `size` bytes about to be sent, waiting as long as needed to stay within the rate limit"""
+
+    with limiter['lock']:
+        limiter['bytes'] += size
+
+        if not limiter['rate']:
+            return
+
+        now = time.monotonic()
+        # Unused allowance accumulates for up to a second, so short pauses do not cause bursts
+        limiter['allowance'] = min(limiter['allowance'] + (now - limiter['last']) * limiter['rate'], limiter['rate'])
+        limiter['last'] = now
+        limiter['allowance'] -= size
+        wait = -limiter['allowance'] / limiter['rate']
+
+    if wait > 0:
+        time.sleep(wait)
+#endregion
+
+#region Destinations
+def disk_destination(root, verify=False):
+    """
+    Destination copying files below a root folder on a local or removable disk, or a network share
+    Keys are paths relative to the root using '/' as separator. Files are copied with copy_file_verified(), so an
+    interrupted copy never leaves a truncated file behind. The journal records the hash and its algorithm
+    """
+
+    def transfer(task, entry, limiter):
+        dest = os.path.join(root, *task['key'].split('/'))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        size, digest = copy_file_verified(task['path'], dest, FAST_HASH_ALGORITHM, limiter, verify)
+
+        return journal_entry(task, digest, algorithm=FAST_HASH_ALGORITHM), True
+
+    return {'name': root, 'transfer': transfer}
+#endregion
+
+#region Concurrency Control
+def concurrency_controller(limiter, maximum, adaptive=True):
+    """Creates the concurrency controller of a destination, measuring throughput through the destination's rate limiter"""
+
+    return {
+        'limit': min(INITIAL_CONCURRENCY, maximum) if adaptive else maximum,
+        'maximum': maximum,
+        'adaptive': adaptive,
+        'limiter': limiter,
+        'condition': threading.Condition(),
+        'in_flight': 0,
+        # Measurements of the current interval
+        'start': time.monotonic(),
+        'start_bytes': limiter['bytes'],
+        'peak': 0,
+        'files': 0,
+        'sizes': {},
+        'errors': 0,
+        # Results of previous intervals
+        'throughput': None,
+        'file_rate': None,
+        'latencies': collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW)),
+        'signals': 0,
+        'decreased': False,
+        'congested_limit': None,
+        'stable_intervals': 0,
+    }
+
+def acquire_slot(controller):
+    """Waits until fewer files than the current limit are in flight, and takes a slot"""
+
+    with controller['condition']:
+        while controller['in_flight'] >= controller['limit']:
+            controller['condition'].wait()
+
+        controller['in_flight'] += 1
+        controller['peak'] = max(controller['peak'], controller['in_flight'])
+
+def release_slot(controller, size, seconds, failed):
+    """Frees a slot, recording the bytes transferred and the time taken (size 0 if nothing was transferred)"""
+
+    with controller['condition']:
+        controller['in_flight'] -= 1
+
+        if failed:
+            controller['errors'] += 1
+        elif size:
+            # Bytes and seconds of the interval's transfers, by file size class
+            totals = controller['sizes'].setdefault(bisect.bisect_left(LATENCY_SIZE_CLASSES, size), [0, 0.0])
+            totals[0] += size
+            totals[1] += seconds
+            controller['files'] += 1
+
+        controller['condition'].notify_all()
+
+def latency_slowdown(controller):
+    """
+    Returns how many times slower than the best recent latency of their size class the transfers of the current
+    interval were (weighted by their bytes), or None if no transfer of a size class with a history completed
+    """
+
+    weighted = 0.0
+    total = 0
+
+    for size_class, (size, seconds) in controller['sizes'].items():
+        best = min(controller['latencies'][size_class], default=None)
+        if best:
+            weighted += seconds / (size / 1024 ** 2) / best * size
+            total += size
+
+    return weighted / total if total else None
+
+def adjust_concurrency(controller):
+    """
+    Ends a measurement interval, applying an AIMD step to the concurrency limit
+    Returns the throughput (bytes per second) and latency (seconds per MB, None if no transfer completed) measured
+    """
+
+    with controller['condition']:
+        now = time.monotonic()
+        elapsed = max(now - controller['start'], 0.001)
+        limiter_bytes = controller['limiter']['bytes']
+        throughput = (limiter_bytes - controller['start_bytes']) / elapsed
+        file_rate = controller['files'] / elapsed
+        size = sum(size for size, seconds in controller['sizes'].values())
+        latency = sum(seconds for size, seconds in controller['sizes'].values()) / (size / 1024 ** 2) if size else None
+        slowdown = latency_slowdown(controller)
+
+        # Transfers completing right after a decrease still started at the higher concurrency, and less throughput is
+        # expected, so there is no sign of congestion in that interval
+        signal = not controller['decreased'] and (
+            (slowdown is not None and slowdown > LATENCY_FACTOR)
+            or (controller['throughput'] and controller['file_rate']
+                and throughput < controller['throughput'] * (1 - THROUGHPUT_LOSS)
+                and file_rate < controller['file_rate'] * (1 - THROUGHPUT_LOSS))
+        )
+        controller['signals'] = controller['signals'] + 1 if signal else 0
+        congested = controller['errors'] > 0 or controller['signals'] >= CONGESTION_INTERVALS
+
+        if controller['adaptive']:
+            if congested:
+                controller['congested_limit'] = controller['limit']
+                controller['stable_intervals'] = 0
+                controller['signals'] = 0
+                controller['limit'] = max(1, int(controller['limit'] * DECREASE_FACTOR))
+            elif not signal:
+                controller['stable_intervals'] += 1
+                below_congestion = controller['congested_limit'] is None or controller['limit'] + 1 < controller['congested_limit']
+
+                if controller['peak'] >= controller['limit'] and (below_congestion or controller['stable_intervals'] >= PROBE_INTERVALS):
+                    controller['limit'] = min(controller['limit'] + 1, controller['maximum'])
+
+        for size_class, (size, seconds) in controller['sizes'].items():
+            controller['latencies'][size_class].append(seconds / (size / 1024 ** 2))
+
+        controller['decreased'] = controller['adaptive'] and congested
+        controller['throughput'] = throughput
+        controller['file_rate'] = file_rate
+        controller['start'] = now
+        controller['start_bytes'] = limiter_bytes
+        controller['peak'] = controller['in_flight']
+        controller['files'] = 0
+        controller['sizes'] = {}
+        controller['errors'] = 0
+        controller['condition'].notify_all()
+
+        return throughput, latency
+#endregion
+
+#region Transfers
+def new_stats(start=None):
+    return {'files': 0, 'bytes': 0, 'skipped': 0, 'errors': [], 'start': start}
+
+def format_rate(stats):
+    seconds = max(time.time() - (stats['start'] or time.time()), 0.001)
+    return f"{stats['files']} files, {stats['bytes'] / 1024 ** 2:.1f} MB in {seconds:.0f}s ({stats['bytes'] / 1024 ** 2 / seconds:.1f} MB/s)"
+
+def monitor(name, controller, start, done, log):
+    """Adjusts the concurrency every CONTROL_INTERVAL seconds, and reports progress every PROGRESS_INTERVAL seconds"""
+
+    last_report = time.time()
+
+    while not done.wait(CONTROL_INTERVAL):
+        throughput, latency = adjust_concurrency(controller)
+
+        if time.time() - last_report >= PROGRESS_INTERVAL:
+            last_report = time.time()
+            transferred = controller['limiter']['bytes'] / 1024 ** 2
+            seconds = max(last_report - start, 0.001)
+            latency_text = f", {latency:.2f} s/MB" if latency is not None else ''
+            log(f"{name}: {transferred:.1f} MB transferred in {seconds:.0f}s ({transferred / seconds:.1f} MB/s), "
+                f"{controller['limit']} files in flight ({throughput / 1024 ** 2:.1f} MB/s{latency_text})")
+
+def run_transfers(groups, destination, concurrency=DEFAULT_CONCURRENCY, limiter=None, on_group_done=None, log=print, adaptive=True):
+    """
+    Transfers the tasks of every group (e.g. county) to a destination, skipping tasks whose journal entry is current
+    groups is a list of (name, journal, tasks) tuples. Once every task of a group has finished, on_group_done(name,
+    journal, stats) is called (from a worker thread) and the group's statistics are logged. Errors of a transfer or
+    of on_group_done are recorded in the group's statistics instead of stopping the other transfers.
+    With adaptive concurrency, `concurrency` is the maximum number of files in flight, otherwise the fixed number.
+    Returns the statistics of every group by name, and the overall statistics under None
+    """
+
+    limiter = limiter or rate_limiter()
+    controller = concurrency_controller(limiter, concurrency, adaptive)
+    total = new_stats(time.time())
+    results = {None: total}
+    lock = threading.Lock()
+    # Unfinished tasks of each group, plus one while the group is being queued
+    remaining = {}
+
+    def finish_group(name, journal):
+        stats = results[name]
+
+        if on_group_done:
+            try:
+                on_group_done(name, journal, stats)
+            except Exception as e:
+                stats['errors'].append(f"{name}: {e}")
+
+        if stats['errors']:
+            log(f"Error in {os.path.basename(name)}: {len(stats['errors'])} files failed, first error: {stats['errors'][0]}")
+        elif stats['files'] == 0:
+            log(f"Completed: {os.path.basename(name)} - up to date")
+        else:
+            log(f"Completed: {os.path.basename(name)} - {format_rate(stats)}, {stats['skipped']} unchanged files skipped")
+
+    def release(name, journal):
+        with lock:
+            remaining[name] -= 1
+            finished = remaining[name] == 0
+
+        if finished:
+            finish_group(name, journal)
+
+    def run_task(name, journal, task):
+        stats = results[name]
+        start = time.monotonic()
+        size = 0
+        failed = False
+
+        try:
+            with lock:
+                if stats['start'] is None:
+                    stats['start'] = time.time()
+
+            entry, transferred = destination['transfer'](task, journal['entries'].get(task['key']), limiter)
+            journal_record(journal, task['key'], entry)
+
+            with lock:
+                if transferred:
+                    size = entry['size']
+                    for group_stats in (stats, total):
+                        group_stats['files'] += 1
+                        group_stats['bytes'] += entry['size']
+                else:
+                    stats['skipped'] += 1
+        except Exception as e:
+            failed = True
+            with lock:
+                stats['errors'].append(f"{task['path'] or task['key']}: {e}")
+                total['errors'].append(f"{task['path'] or task['key']}: {e}")
+        finally:
+            release_slot(controller, size, time.monotonic() - start, failed)
+            release(name, journal)
+
+    done = threading.Event()
+    threading.Thread(target=monitor, args=(destination['name'], controller, total['start'], done, log), daemon=True).start()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for name, journal, tasks in groups:
+            stats = results[name] = new_stats()
+            remaining[name] = 1
+            queued = 0
+
+            for task in tasks:
+                # Unchanged since the last transfer, no need to read the file
+                if is_current(journal['entries'].get(task['key']), task):
+                    stats['skipped'] += 1
+                    continue
+
+                acquire_slot(controller)
+                with lock:
+                    remaining[name] += 1
+                executor.submit(run_task, name, journal, task)
+                queued += 1
+
+            log(f"Queued {queued} files of {os.path.basename(name)} ({stats['skipped']} unchanged files skipped)")
+            release(name, journal)
+
+    done.set()
+    total['skipped'] = sum(stats['skipped'] for name, stats in results.items() if name is not None)
+    log(f"Finished {destination['name']}: {format_rate(total)}, {len(total['errors'])} errors")
+
+    return results
+#endregion
@@ -1,65 +1,628 @@
+"""
+Script Name: Transfer State Contours To AWS
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Uploads the contour outputs of every county of a state to s3://storage.data.gis1.net/data/Contour_Lines/{state}/{county}/GIS1:
+the tile index (as index.json, using the gzip pre-compressed sibling written by Contouring.py if present) and the
+contents of the Dwg_Files and Shapefiles folders.
+
+Files are found, queued, throttled and journaled by the shared transfer engine (Transfer_Engine.py), this script
+provides its S3 destination. All uploads go through a single boto3 S3 client whose connection pool is sized for the
+upload concurrency, so credentials are resolved once and connections are reused across files and counties. The files
+of all counties are uploaded by one pool of up to MAX_CONCURRENCY threads, optionally limited to --max-rate MB/s. The
+number of uploads in flight is adapted to the observed throughput and latency by the engine, so the uplink is kept
+busy without being oversubscribed (use --fixed-concurrency to always upload --concurrency files at a time). The overall
+throughput (MB/s) is reported every PROGRESS_INTERVAL seconds, and per county once it completes. Every upload carries
+the MD5 of its data, so S3 rejects corrupted data.
+
+Resumable multipart uploads:
+Files of MULTIPART_THRESHOLD or more are uploaded in parts. The upload ID and the size, MD5 and ETag of every
+acknowledged part are saved in the county's .s3_uploads folder after each part, so an upload interrupted by a dropped
+connection (or a stopped script) resumes from the last acknowledged part on the next run instead of starting over.
+Parts are checked against S3's own list of received parts before resuming; if the file changed in the meantime, the
+old upload is aborted and the file is uploaded from the start. The first part is MULTIPART_CHUNK_SIZE (or larger for
+files that would need more than MAX_PARTS parts), and every following part is sized so that it takes about
+TARGET_PART_SECONDS at the throughput observed so far, between MIN_PART_SIZE and MAX_PART_SIZE.
+
+Incremental sync:
+Instead of listing the remote prefix of every county on every run (as `aws s3 sync` does), each county folder keeps a
+transfer journal of what has been uploaded to a bucket (.s3_journal.{bucket}.jsonl: S3 key, local path, size,
+modification time, ETag-compatible MD5 hash, upload time), with a record appended as soon as each upload completes.
+Files whose size and modification time match the journal are skipped without being read. Changed files are hashed,
+and only uploaded if their hash differs from the journal.
+Use --verify-remote to reconcile the journals with a (paginated) listing of each county's remote prefix first:
+entries whose object is missing or has a different size or ETag are dropped, so those files are uploaded again.
+
+Dependencies:
+- Requires boto3 (pip install boto3). Credentials are resolved the same way as by the aws cli (environment variables,
+  ~/.aws/credentials, AWS_PROFILE).
+
+Bundles:
+With --bundles, the tiles of every county are also packaged into deflate compressed zip bundles, one per tile and
+contour interval (e.g. bundles/{TILE}_1Ft.zip with the tile's shapefile set and DWG), so that a tile can be
+downloaded with a single request. With --county-bundle, all tiles of a county are also packaged into one zip bundle
+(bundles/{county}_All.zip). Bundles are built in parallel by the upload threads and written straight into the upload
+(tile bundles in memory, the county bundle as a multipart upload that sends each part as soon as it is filled), so no
+archive is ever written to disk. A bundle is rebuilt only when one of its files changed. Once a county's bundles are
+uploaded, bundles.json lists every bundle with its key, size and contents, for the clearinghouse front end:
+    {"state": ..., "county": ..., "updated": ..., "tiles": {"{TILE}": {"1Ft": {"key": ..., "size": ..., "files": [...]}}},
+     "county_bundle": {"key": ..., "size": ...}}
+
+Usage:
+    python Transfer_State_Contours_To_AWS.py SOUTH_CAROLINA
+    python Transfer_State_Contours_To_AWS.py SOUTH_CAROLINA --source-dir W:\\SOUTH_CAROLINA --concurrency 32
+
+    Without arguments, the script prompts for the state folder name.
+
+    Also upload per tile and per county zip bundles:
+    python Transfer_State_Contours_To_AWS.py SOUTH_CAROLINA --bundles --county-bundle
+
+    Archive the uploads in a colder storage class, at no more than 50 MB/s:
+    python Transfer_State_Contours_To_AWS.py SOUTH_CAROLINA --storage-class GLACIER_IR --max-rate 50
+
+    Reconcile the journals with the bucket contents (e.g. after objects were deleted remotely):
+    python Transfer_State_Contours_To_AWS.py SOUTH_CAROLINA --verify-remote
+
+    Testing against a local S3 stand-in (e.g. MinIO, or `moto_server`):
+    python Transfer_State_Contours_To_AWS.py SOUTH_CAROLINA --endpoint-url http://localhost:9000 --bucket test-bucket
+"""
+
+import io
 import os
-import concurrent.futures
-import subprocess
+import sys
+import json
+import time
+import base64
+import hashlib
+import zipfile
+import argparse
+import datetime
+import mimetypes
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import Transfer_Engine
+
+#region Config Vars
+SOURCE_DRIVE = 'W'
+BUCKET = 'storage.data.gis1.net'
+DEST_PREFIX = 'data/Contour_Lines'
+UPLOAD_FOLDERS = ['Dwg_Files', 'Shapefiles']
+# Storage class of the uploaded objects (None uses the bucket default, STANDARD)
+STORAGE_CLASS = None
+
+# Maximum number of files uploaded at the same time, over all counties
+MAX_CONCURRENCY = 32
+# Files of this size or more are uploaded in parts, starting with parts of MULTIPART_CHUNK_SIZE
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+# Later parts are sized to take about TARGET_PART_SECONDS at the observed throughput (S3 requires at least 5 MB per
+# part except the last one, and at most 10000 parts)
+TARGET_PART_SECONDS = 20
+MIN_PART_SIZE = 8 * 1024 * 1024
+MAX_PART_SIZE = 512 * 1024 * 1024
+MAX_PARTS = 10000
+# Per county folder holding the state of unfinished multipart uploads
+UPLOADS_DIR = '.s3_uploads'
+
+# Zip bundles (--bundles, --county-bundle), stored under {county prefix}/{BUNDLES_PREFIX}
+BUNDLES_PREFIX = 'bundles'
+BUNDLES_INDEX = 'bundles.json'
+BUNDLE_COMPRESSION_LEVEL = 6
+
+# Per county journal of uploaded files ({bucket} is replaced with the destination bucket)
+JOURNAL_FILE = '.s3_journal.{bucket}.jsonl'
+#endregion
+
+#region Utility Functions
+def county_name(source_folder):
+    return os.path.basename(source_folder).lower().replace('_county_contours', '')
+
+def county_prefix(source_folder, state):
+    return f"{DEST_PREFIX}/{state.lower()}/{county_name(source_folder)}/GIS1"
+#endregion
+
+#region Journals
+def open_county_journal(source_folder, bucket):
+    """Opens the upload journal of a county"""
+
+    return Transfer_Engine.open_journal(os.path.join(source_folder, JOURNAL_FILE.format(bucket=bucket)))
+
+def etag_hash(path, part_sizes=None):
+    """
+    Computes the MD5 hash S3 reports as the ETag of an object: the MD5 of the file, or for a multipart upload (with
+    the given part sizes) the MD5 of the concatenated part MD5s followed by the number of parts
+    """
+
+    if not part_sizes:
+        return Transfer_Engine.file_hash(path, 'md5')
+
+    part_hashes = []
+    with open(path, 'rb') as file:
+        for part_size in part_sizes:
+            part_hashes.append(hashlib.md5(file.read(part_size)).digest())
+
+    return f"{hashlib.md5(b''.join(part_hashes)).hexdigest()}-{len(part_hashes)}"
+
+def verify_remote(client, bucket, prefix, journal):
+    """
+    Reconciles a county's journal with a paginated listing of its remote prefix
+    Entries whose object is missing, or differs in size or ETag, are removed. Returns the number of removed entries
+    """
+
+    remote = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=f'{prefix}/'):
+        for item in page.get('Contents', []):
+            remote[item['Key']] = item
+
+    removed = 0
+    for key, entry in list(journal['entries'].items()):
+        item = remote.get(key)
+        if item is None or item['Size'] != entry['size'] or item['ETag'].strip('"') != entry['hash']:
+            Transfer_Engine.journal_remove(journal, key)
+            removed += 1
+
+    return removed
+#endregion
+
+#region S3 Uploads
+def create_client(endpoint_url=None, concurrency=MAX_CONCURRENCY):
+    """Creates the S3 client shared by all upload threads, with a connection pool large enough for all of them"""
+
+    config = Config(
+        max_pool_connections=concurrency,
+        retries={'max_attempts': 10, 'mode': 'adaptive'},
+        tcp_keepalive=True,
+    )
+
+    return boto3.session.Session().client('s3', endpoint_url=endpoint_url, config=config)
+
+def upload_args(**extra_args):
+    if STORAGE_CLASS:
+        extra_args['StorageClass'] = STORAGE_CLASS
+    return extra_args
+
+def county_uploads(source_folder, state):
+    """Lists the uploads of a county as transfer tasks, with the extra arguments of each upload"""
 
-def upload_county_data(source_folder, state):
-    """Handle all upload tasks for a single county"""
     folder_name = os.path.basename(source_folder)
-    county_name = folder_name.lower().replace('_county_contours', '')
-    dest_base = f"data/Contour_Lines/{state.lower()}/{county_name}/GIS1"
-    
+    dest_base = county_prefix(source_folder, state)
+    uploads = []
+
+    # Upload index file (prefer the gzip pre-compressed sibling written by Contouring.py, if present)
+    index_src = os.path.join(source_folder, f"{folder_name}_Index.geojson")
+    if os.path.isfile(f"{index_src}.gz"):
+        extra_args = upload_args(ContentEncoding='gzip', ContentType='application/json')
+        uploads.append(Transfer_Engine.file_task(f"{index_src}.gz", f"{dest_base}/index.json", os.stat(f"{index_src}.gz"), source_folder, extra_args=extra_args))
+    elif os.path.isfile(index_src):
+        extra_args = upload_args(ContentType='application/json')
+        uploads.append(Transfer_Engine.file_task(index_src, f"{dest_base}/index.json", os.stat(index_src), source_folder, extra_args=extra_args))
+
+    # Upload Dwg_Files and Shapefiles (their contents are merged into the same prefix, as with `aws s3 sync`)
+    for path, relative_path, stat in Transfer_Engine.county_files(source_folder, UPLOAD_FOLDERS):
+        key = f"{dest_base}/{relative_path.split('/', 1)[1]}"
+        extra_args = upload_args(ContentType=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        uploads.append(Transfer_Engine.file_task(path, key, stat, source_folder, extra_args=extra_args))
+
+    return uploads
+
+def content_md5(data_hash):
+    return base64.b64encode(data_hash.digest()).decode()
+
+def upload_state_path(source_folder, bucket, key):
+    return os.path.join(source_folder, UPLOADS_DIR, f"{hashlib.md5(f'{bucket}/{key}'.encode()).hexdigest()}.json")
+
+def load_upload_state(path):
     try:
-        # Upload index file
-        index_src = os.path.join(source_folder, f"{folder_name}_Index.geojson")
-        subprocess.run([
-            'aws', 's3', 'cp', 
-            index_src,
-            f's3://storage.data.gis1.net/{dest_base}/index.json'
-        ], check=True)
-        
-        # Upload Dwg_Files
-        dwg_src = os.path.join(source_folder, 'Dwg_Files')
-        subprocess.run([
-            'aws', 's3', 'sync',
-            dwg_src,
-            f's3://storage.data.gis1.net/{dest_base}'
-        ], check=True)
-        
-        # Upload Shapefiles
-        shp_src = os.path.join(source_folder, 'Shapefiles')
-        subprocess.run([
-            'aws', 's3', 'sync',
-            shp_src,
-            f's3://storage.data.gis1.net/{dest_base}'
-        ], check=True)
-        
-        return f"Success: {folder_name}"
-    except subprocess.CalledProcessError as e:
-        return f"Error in {folder_name}: {str(e)}"
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def save_upload_state(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(f'{path}.tmp', path)
+
+def next_part_size(size, offset, part_count, rate):
+    """Sizes the next part of a multipart upload from the throughput observed so far (bytes per second)"""
+
+    remaining = size - offset
+    part_size = rate * TARGET_PART_SECONDS if rate else MULTIPART_CHUNK_SIZE
+    part_size = min(max(part_size, MIN_PART_SIZE), MAX_PART_SIZE)
+    # The remaining data has to fit in the remaining number of parts
+    part_size = max(part_size, -(-remaining // max(MAX_PARTS - part_count, 1)))
+
+    return int(min(part_size, remaining))
+
+def acknowledged_parts(client, bucket, key, upload_id):
+    """Returns the ETags of the parts S3 has received for a multipart upload, by part number"""
+
+    parts = {}
+    for page in client.get_paginator('list_parts').paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts[part['PartNumber']] = part['ETag']
+
+    return parts
+
+def resume_multipart_upload(client, bucket, key, path, size, mtime, state_path):
+    """Returns the saved state of an unfinished upload of the file, keeping only the parts S3 has acknowledged"""
+
+    state = load_upload_state(state_path)
+    if not state:
+        return None
+
+    if state['path'] != path or state['size'] != size or state['mtime'] != mtime:
+        print(f"{path} changed since its upload was interrupted, starting over")
+        try:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=state['upload_id'])
+        except ClientError:
+            pass
+        return None
+
+    try:
+        acknowledged = acknowledged_parts(client, bucket, key, state['upload_id'])
+    except ClientError as e:
+        # The upload was aborted or expired (e.g. by a bucket lifecycle rule)
+        print(f"Could not resume upload of {key} ({e}), starting over")
+        return None
+
+    parts = []
+    for part in state['parts']:
+        if acknowledged.get(part['PartNumber']) != part['ETag']:
+            break
+        parts.append(part)
+
+    state['parts'] = parts
+    print(f"Resuming upload of {key} at part {len(parts) + 1} ({sum(p['size'] for p in parts) / 1024 ** 2:.0f} of {size / 1024 ** 2:.0f} MB already uploaded)")
+
+    return state
+
+def upload_multipart(client, bucket, task, state_path, limiter):
+    """
+    Uploads a large file in parts, saving the upload state after every part so that it can be resumed
+    Returns the ETag of the object and the sizes of its parts
+    """
+
+    key, path, size = task['key'], task['path'], task['size']
+    state = resume_multipart_upload(client, bucket, key, path, size, task['mtime'], state_path)
+
+    if not state:
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, **task['extra_args'])['UploadId']
+        state = {'key': key, 'path': path, 'size': size, 'mtime': task['mtime'], 'upload_id': upload_id, 'parts': []}
+        save_upload_state(state_path, state)
+
+    parts = state['parts']
+    offset = sum(part['size'] for part in parts)
+    rate = None
+
+    with open(path, 'rb') as file:
+        file.seek(offset)
+
+        while offset < size:
+            data = file.read(next_part_size(size, offset, len(parts), rate))
+            data_hash = hashlib.md5(data)
+            Transfer_Engine.throttle(limiter, len(data))
+            start = time.time()
+
+            response = client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=state['upload_id'],
+                PartNumber=len(parts) + 1,
+                Body=data,
+                ContentMD5=content_md5(data_hash),
+            )
+
+            part_rate = len(data) / max(time.time() - start, 0.001)
+            rate = part_rate if rate is None else (rate + part_rate) / 2
+
+            parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag'], 'size': len(data), 'md5': data_hash.hexdigest()})
+            save_upload_state(state_path, state)
 
+            offset += len(data)
+
+    client.complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=state['upload_id'],
+        MultipartUpload={'Parts': [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in parts]},
+    )
+    os.remove(state_path)
+
+    etag = f"{hashlib.md5(b''.join(bytes.fromhex(part['md5']) for part in parts)).hexdigest()}-{len(parts)}"
+    return etag, [part['size'] for part in parts]
+
+def upload_file(client, bucket, task, entry, limiter):
+    """
+    Uploads a single file (as a resumable multipart upload if it is large) unless its hash matches its journal entry
+    Returns the file's new journal entry, and whether it was uploaded
+    """
+
+    path, key = task['path'], task['key']
+
+    # Modified (e.g. re-exported) but identical to what was uploaded
+    if entry is not None and entry['size'] == task['size'] and etag_hash(path, entry.get('part_sizes')) == entry['hash']:
+        return {**entry, 'path': path, 'mtime': task['mtime']}, False
+
+    if task['size'] >= MULTIPART_THRESHOLD:
+        etag, part_sizes = upload_multipart(client, bucket, task, upload_state_path(task['group'], bucket, key), limiter)
+        return Transfer_Engine.journal_entry(task, etag, part_sizes=part_sizes), True
+
+    with open(path, 'rb') as file:
+        data = file.read()
+    data_hash = hashlib.md5(data)
+    Transfer_Engine.throttle(limiter, len(data))
+    client.put_object(Bucket=bucket, Key=key, Body=data, ContentMD5=content_md5(data_hash), **task['extra_args'])
+
+    return Transfer_Engine.journal_entry(task, data_hash.hexdigest()), True
+
+def s3_destination(client, bucket):
+    """Transfer engine destination uploading files and zip bundles to a bucket"""
+
+    def transfer(task, entry, limiter):
+        if 'members' in task:
+            return upload_bundle(client, bucket, task, limiter)
+        return upload_file(client, bucket, task, entry, limiter)
+
+    return {'name': f's3://{bucket}', 'transfer': transfer}
+#endregion
+
+#region Bundles
+def tile_bundles(source_folder):
+    """
+    Groups the exported files of a county by tile and contour interval (e.g. 12345_1Ft.shp/.shx/.dbf/.prj and
+    12345_1Ft.dwg), returning {bundle name: [(path, name in the zip file)]}
+    """
+
+    bundles = {}
+
+    for folder in UPLOAD_FOLDERS:
+        folder_path = os.path.join(source_folder, folder)
+        if not os.path.isdir(folder_path):
+            continue
+
+        for entry in os.scandir(folder_path):
+            if entry.is_file():
+                bundles.setdefault(entry.name.split('.')[0], []).append((entry.path, entry.name))
+
+    return {name: sorted(members, key=lambda member: member[1]) for name, members in sorted(bundles.items())}
+
+def bundle_signature(members):
+    """Hash of the names, sizes and modification times of a bundle's files, used to detect changed bundles"""
+
+    stats = []
+    for path, name in members:
+        stat = os.stat(path)
+        stats.append([name, stat.st_size, int(stat.st_mtime)])
+
+    return hashlib.md5(json.dumps(stats).encode()).hexdigest()
+
+def write_bundle(members, output):
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED, compresslevel=BUNDLE_COMPRESSION_LEVEL) as bundle:
+        for path, name in members:
+            bundle.write(path, name)
+
+class MultipartStreamWriter:
+    """Minimal write-only file-like object that streams its data into a multipart upload, one part at a time"""
+
+    def __init__(self, client, bucket, key, extra_args, limiter):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.limiter = limiter
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, **extra_args)['UploadId']
+        self.buffer = bytearray()
+        self.parts = []
+        self.part_hashes = []
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+
+        if len(self.buffer) >= MULTIPART_CHUNK_SIZE:
+            self.upload_part()
+
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def upload_part(self):
+        data_hash = hashlib.md5(self.buffer)
+        Transfer_Engine.throttle(self.limiter, len(self.buffer))
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=len(self.parts) + 1,
+            Body=bytes(self.buffer),
+            ContentMD5=content_md5(data_hash),
+        )
+
+        self.parts.append({'PartNumber': len(self.parts) + 1, 'ETag': response['ETag']})
+        self.part_hashes.append(data_hash.digest())
+        self.buffer = bytearray()
+
+    def close(self):
+        """Uploads the last part and completes the upload, returning the ETag of the object"""
+
+        if self.buffer or not self.parts:
+            self.upload_part()
+
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+
+        return f"{hashlib.md5(b''.join(self.part_hashes)).hexdigest()}-{len(self.parts)}"
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+def upload_bundle(client, bucket, task, limiter):
+    """
+    Builds a zip bundle and uploads it as it is written: in memory for tile bundles, or streamed into a multipart
+    upload for the (large) county bundle. Returns the bundle's journal entry
+    """
+
+    key, members = task['key'], task['members']
+    extra_args = upload_args(ContentType='application/zip')
+
+    if task['stream']:
+        writer = MultipartStreamWriter(client, bucket, key, extra_args, limiter)
+        try:
+            write_bundle(members, writer)
+            etag = writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        size = writer.position
+    else:
+        output = io.BytesIO()
+        write_bundle(members, output)
+        size = output.tell()
+        data_hash = hashlib.md5(output.getbuffer())
+        Transfer_Engine.throttle(limiter, size)
+        output.seek(0)
+        client.put_object(Bucket=bucket, Key=key, Body=output, ContentMD5=content_md5(data_hash), **extra_args)
+        etag = data_hash.hexdigest()
+
+    entry = {
+        'path': None,
+        'size': size,
+        'hash': etag,
+        'transferred': datetime.datetime.now().isoformat(timespec='seconds'),
+        'signature': task['signature'],
+        'files': [name for path, name in members],
+    }
+
+    return entry, True
+
+def bundle_task(key, members, stream, source_folder):
+    return {'key': key, 'path': None, 'members': members, 'signature': bundle_signature(members), 'stream': stream, 'group': source_folder}
+
+def county_bundles(source_folder, state, county_bundle):
+    """Lists the bundles of a county as transfer tasks"""
+
+    prefix = f"{county_prefix(source_folder, state)}/{BUNDLES_PREFIX}"
+    tiles = tile_bundles(source_folder)
+    bundles = [bundle_task(f"{prefix}/{name}.zip", members, False, source_folder) for name, members in tiles.items()]
+
+    if county_bundle and tiles:
+        members = [member for tile_members in tiles.values() for member in tile_members]
+        bundles.append(bundle_task(f"{prefix}/{county_name(source_folder)}_All.zip", members, True, source_folder))
+
+    return bundles
+
+def upload_bundles_index(client, bucket, source_folder, state, entries):
+    """Uploads bundles.json, listing the bundles of a county recorded in its journal, and returns its journal entry"""
+
+    prefix = f"{county_prefix(source_folder, state)}/{BUNDLES_PREFIX}/"
+    index = {
+        'state': state,
+        'county': county_name(source_folder),
+        'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+        'tiles': {},
+        'county_bundle': None,
+    }
+
+    for key, entry in sorted(entries.items()):
+        if not key.startswith(prefix):
+            continue
+
+        bundle = {'key': key, 'size': entry['size'], 'files': entry['files']}
+        name = key[len(prefix):-len('.zip')]
+
+        if name == f"{county_name(source_folder)}_All":
+            index['county_bundle'] = {'key': key, 'size': entry['size']}
+        else:
+            tile, _, interval = name.rpartition('_')
+            index['tiles'].setdefault(tile, {})[interval] = bundle
+
+    data = json.dumps(index, separators=(',', ':')).encode('utf-8')
+    data_hash = hashlib.md5(data)
+    key = f"{county_prefix(source_folder, state)}/{BUNDLES_INDEX}"
+    client.put_object(Bucket=bucket, Key=key, Body=data, ContentMD5=content_md5(data_hash), **upload_args(ContentType='application/json'))
+
+    return key, {'path': None, 'size': len(data), 'hash': data_hash.hexdigest(), 'transferred': index['updated']}
+#endregion
+
+#region Main
 def main():
-    state = input("Enter the name of the state folder (e.g. SOUTH_CAROLINA): ")
-    concurrency = int(input("Enter number of concurrent uploads (10-20 recommended): "))
-    
-    base_dir = f"W:\\{state}"
-    counties = [
-        f.path for f in os.scandir(base_dir) 
-        if f.is_dir()
-        and '_County_Contours' in f.name
-        and 'Empty' not in f.name
-    ]
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
-        futures = {executor.submit(upload_county_data, county, state): county for county in counties}
-        
-        for future in concurrent.futures.as_completed(futures):
-            county_path = futures[future]
-            county_name = os.path.basename(county_path)
-            try:
-                result = future.result()
-                print(f"Completed: {county_name} - {result}")
-            except Exception as e:
-                print(f"Exception in {county_name}: {str(e)}")
+    global STORAGE_CLASS
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('state', nargs='?', help="The name of the state folder (e.g. SOUTH_CAROLINA)")
+    parser.add_argument('--source-dir', help=f"State folder containing the county folders (default: {SOURCE_DRIVE}:\\STATE)")
+    parser.add_argument('--bucket', default=BUCKET, help=f"Destination bucket (default: {BUCKET})")
+    parser.add_argument('--endpoint-url', help="S3 endpoint, e.g. a local MinIO or moto server for testing")
+    parser.add_argument('--storage-class', default=STORAGE_CLASS, help="Storage class of the uploaded objects (e.g. GLACIER_IR)")
+    parser.add_argument('--verify-remote', action='store_true', help="Reconcile the upload journals with a listing of each county's remote files first")
+    parser.add_argument('--bundles', action='store_true', help="Also upload a zip bundle per tile and contour interval, and bundles.json")
+    parser.add_argument('--county-bundle', action='store_true', help="Also upload a zip bundle of all tiles of each county (implies --bundles)")
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENCY, help=f"Maximum number of files uploaded at the same time (default: {MAX_CONCURRENCY})")
+    parser.add_argument('--fixed-concurrency', action='store_true', help="Always upload --concurrency files at the same time instead of adapting to the throughput")
+    parser.add_argument('--max-rate', type=float, help="Upper limit of the upload rate in MB/s (default: unlimited)")
+    args = parser.parse_args()
+
+    STORAGE_CLASS = args.storage_class
+    state = args.state or input("Enter the name of the state folder (e.g. SOUTH_CAROLINA): ").strip()
+    base_dir = args.source_dir or f"{SOURCE_DRIVE}:\\{state}"
+    counties = Transfer_Engine.find_county_folders(base_dir)
+
+    # Parallelism comes from uploading many files at once, so the parts of a multipart upload are sent one after the
+    # other by the thread uploading the file
+    client = create_client(args.endpoint_url, args.concurrency)
+    destination = s3_destination(client, args.bucket)
+    limiter = Transfer_Engine.rate_limiter(args.max_rate * 1024 ** 2 if args.max_rate else None)
+
+    journals = {county: open_county_journal(county, args.bucket) for county in counties}
+    bundles = args.bundles or args.county_bundle
+    bundles_changed = set()
+
+    if args.verify_remote:
+        for county in counties:
+            removed = verify_remote(client, args.bucket, county_prefix(county, state), journals[county])
+            if removed:
+                print(f"{removed} files of {os.path.basename(county)} are missing or differ remotely, they will be uploaded again")
+
+    def county_tasks(county):
+        """Lists the uploads of a county when it is queued, so files are listed just before they are uploaded"""
+
+        tasks = county_uploads(county, state)
+
+        if bundles:
+            bundle_tasks = county_bundles(county, state, args.county_bundle)
+            if any(not Transfer_Engine.is_current(journals[county]['entries'].get(task['key']), task) for task in bundle_tasks):
+                bundles_changed.add(county)
+            tasks += bundle_tasks
+
+        return tasks
+
+    def finish_county(county, journal, stats):
+        """Uploads bundles.json once all bundles of a county are uploaded, if any of them changed"""
+
+        index_key = f"{county_prefix(county, state)}/{BUNDLES_INDEX}"
+
+        if bundles and not stats['errors'] and (county in bundles_changed or index_key not in journal['entries']):
+            key, entry = upload_bundles_index(client, args.bucket, county, state, journal['entries'])
+            Transfer_Engine.journal_record(journal, key, entry)
+
+    groups = ((county, journals[county], county_tasks(county)) for county in counties)
+    results = Transfer_Engine.run_transfers(groups, destination, args.concurrency, limiter, finish_county, adaptive=not args.fixed_concurrency)
+
+    for journal in journals.values():
+        Transfer_Engine.close_journal(journal)
+
+    sys.exit(1 if results[None]['errors'] else 0)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
+#endregion
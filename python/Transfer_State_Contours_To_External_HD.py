@@ -1,81 +1,438 @@
+"""
+Script Name: Transfer State Contours To External HD
+Created by: Nick Rupert, Chad Rupert, and Juan Machado - GIS1.net
+
+Description:
+Copies the contour outputs of every county of a state (Shapefiles, Dwg_Files, the index GeoJSON and the output
+geodatabase) to one or more external hard drives, keeping the folder structure of the source drive (e.g.
+W:\\SOUTH_CAROLINA\\Abbeville_County_Contours -> E:\\SOUTH_CAROLINA\\Abbeville_County_Contours). A destination can
+also be a folder, e.g. on a network share, in which case the state folder is created inside it.
+
+Copy plan:
+Before anything is copied, the county folders are scanned in parallel (os.scandir, see Transfer_Engine.py) and the
+space each county still needs on each destination is computed from the sizes of its files, rounded up to the cluster
+size of the destination file system, less the files already copied there. Counties are kept whole on one drive.
+Counties partially copied to a drive by an interrupted run stay on that drive, the others are placed largest first on
+the drive with the least free space they fit in (best-fit decreasing), keeping FREE_SPACE_RESERVE free on every
+drive. The plan (counties and space per drive, and counties that fit nowhere) is printed first; use --plan-only to
+stop there.
+
+Files are copied by the shared transfer engine (Transfer_Engine.py), all destination drives at the same time, each
+with up to MAX_CONCURRENCY copies in flight, optionally limited to --max-rate MB/s per drive. The number of copies in
+flight is adapted to the throughput and latency of each drive, so a single spinning USB disk is not thrashed by
+parallel copies.
+
+Resuming:
+Every file is copied to a .partial file that is renamed into place once complete, and then recorded (with its size,
+modification time and checksum) in the journal of the destination, .copy_journal.jsonl in the state folder on the
+drive, so the journal travels with the drive whatever letter it gets. Re-running the script is idempotent: the
+destination is scanned (os.scandir, in parallel), .partial files left by an interrupted copy are removed, journal
+entries whose copy is missing or has the wrong size are dropped, and every file whose journal entry matches the
+source's size and modification time is skipped without being read. Only new, changed and partially copied files are
+copied, so resuming a large state takes seconds rather than a full copy.
+
+copy_BUP.log, the list of completed counties written by earlier versions of this script, is no longer written. The
+copies of the counties it lists are adopted into the journal when their size and modification time match the source
+(they have no checksum until they are copied again).
+
+Checksums:
+Files are copied with the verified copy of the transfer engine, which hashes the data (XXH3 or BLAKE3 if installed,
+else BLAKE2b) while it is copied, without reading anything twice. With --verify-copies, every copy is also read back
+and compared before it is renamed into place. Once a county is copied, its files and their hashes are written to
+copy_manifest.json in the county folder on the destination, so the drive carries its own checksums. --verify
+re-hashes the copies on the destinations and compares them with their manifests and with the journal (the source is
+not read): missing or corrupted copies are removed from the journal, so the next run copies them again.
+
+Usage:
+    python Transfer_State_Contours_To_External_HD.py W:\\SOUTH_CAROLINA E
+    python Transfer_State_Contours_To_External_HD.py W:\\SOUTH_CAROLINA \\\\backup-server\\contours --max-rate 100
+
+    Spread a state over several drives, showing the plan without copying:
+    python Transfer_State_Contours_To_External_HD.py W:\\TEXAS E F G --plan-only
+
+    Check the copies on a drive against their checksums:
+    python Transfer_State_Contours_To_External_HD.py W:\\SOUTH_CAROLINA E --verify
+
+    Without arguments, the script prompts for the state folder and the destination drive letters.
+"""
+
 import os
+import sys
+import json
+import ctypes
 import shutil
-import time
-from multiprocessing.dummy import Pool as ThreadPool
+import argparse
+import concurrent.futures
+
+import Transfer_Engine
 
+#region Config Vars
 STATE_FOLDER = ''
-DEST_DRIVE = ''
+DEST_DRIVES = []
 
-def log(message):
-    global STATE_FOLDER
-    
-    with open(f"{STATE_FOLDER}\\copy_BUP.log", "a") as f:
-        f.write(f"{message}\n")
+# Completed counties written by earlier versions of this script, one source folder per line (only read)
+COPY_LOG = 'copy_BUP.log'
+# Per file journal of the copies on a destination, in the state folder on the destination
+JOURNAL_FILE = '.copy_journal.jsonl'
+# Largest difference in seconds between the modification times of a file and its copy (FAT and exFAT round to 2s)
+MTIME_TOLERANCE = 2
+# Files and folders of each county that are copied ({county} is replaced with the county folder name)
+COPY_ARTIFACTS = ['Shapefiles', 'Dwg_Files', '{county}_Index.geojson', '{county}.gdb']
+# Maximum number of files copied at the same time, over all counties
+MAX_CONCURRENCY = 16
+# Checksums of the files of a county, written to the county folder on the destination once it is copied
+COPY_MANIFEST = 'copy_manifest.json'
+# Number of files re-hashed at the same time on each destination by --verify
+VERIFY_WORKERS = 2
+# Space left free on every destination drive
+FREE_SPACE_RESERVE = 1024 ** 3
+# Allocation unit assumed when the cluster size of a destination cannot be determined
+DEFAULT_CLUSTER_SIZE = 4096
+#endregion
 
+def read_log():
+    path = os.path.join(STATE_FOLDER, COPY_LOG)
 
-def copyFolder(sourceFolder):
-    folder = sourceFolder.split(':')[-1]
-    destFolder = f"{DEST_DRIVE}:{folder}"
+    if not os.path.exists(path):
+        return set()
 
-    folderName = sourceFolder.split('\\')[-1]
-    print(f"COPYING {sourceFolder}\\Shapefiles -> {destFolder}\\Shapefiles")
-    shutil.copytree(f"{sourceFolder}\\Shapefiles", f"{destFolder}\\Shapefiles")
-    print(f"FINISHED COPYING {sourceFolder}\\Shapefiles -> {destFolder}\\Shapefiles")
+    with open(path, "r") as f:
+        return {line.strip() for line in f if line.strip()}
 
-    print(f"COPYING {sourceFolder}\\Dwg_Files -> {destFolder}\\Dwg_Files")
-    shutil.copytree(f"{sourceFolder}\\Dwg_Files", f"{destFolder}\\Dwg_Files")
-    print(f"FINISHED COPYING {sourceFolder}\\Dwg_Files -> {destFolder}\\Dwg_Files")
+def dest_root(dest):
+    """The destination state folder: the same path on another drive for a drive letter, else a folder inside dest"""
 
-    if os.path.isfile(f"{sourceFolder}\\{folderName}_Index.geojson"):
-        print(f"COPYING {sourceFolder}\\{folderName}_Index.geojson -> {destFolder}\\{folderName}_Index.geojson")
-        shutil.copy(f"{sourceFolder}\\{folderName}_Index.geojson", f"{destFolder}\\{folderName}_Index.geojson")
-        print(f"FINISHED COPYING {sourceFolder}\\{folderName}_Index.geojson -> {destFolder}\\{folderName}_Index.geojson")
+    state_path = STATE_FOLDER.split(':')[-1]
 
-    print(f"COPYING {sourceFolder}\\{folderName}.gdb -> {destFolder}\\{folderName}.gdb")
-    shutil.copy(f"{sourceFolder}\\{folderName}.gdb", f"{destFolder}\\{folderName}.gdb")
-    print(f"FINISHED COPYING {sourceFolder}\\{folderName}.gdb -> {destFolder}\\{folderName}.gdb")
+    if len(dest) == 1:
+        return f"{dest}:{state_path}"
 
-    log(sourceFolder)
+    return os.path.join(dest, os.path.basename(os.path.normpath(STATE_FOLDER)))
 
+def open_dest_journal(root):
+    """Opens the journal of a destination"""
 
-def main():
-    global STATE_FOLDER
-    global DEST_DRIVE
+    return Transfer_Engine.open_journal(os.path.join(root, JOURNAL_FILE))
+
+def scan_destination(root):
+    """
+    Lists the files copied to a destination as {key: stat}, scanning its county folders in parallel
+    .partial files left by an interrupted copy are removed
+    """
+
+    county_dirs = [entry.path for entry in os.scandir(root) if entry.is_dir()]
+    copies = {}
+    partials = 0
+
+    def scan(county_dir):
+        files = {}
+
+        for path, stat in Transfer_Engine.walk_files(county_dir):
+            if path.endswith(Transfer_Engine.PARTIAL_SUFFIX):
+                os.remove(path)
+                files[None] = files.get(None, 0) + 1
+            else:
+                files[os.path.relpath(path, root).replace(os.sep, '/')] = stat
+
+        return files
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=Transfer_Engine.SCAN_WORKERS) as executor:
+        for files in executor.map(scan, county_dirs):
+            partials += files.pop(None, 0)
+            copies.update(files)
+
+    if partials:
+        print(f"Removed {partials} partial copies from {root}")
+
+    return copies
+
+def reconcile_journal(root, journal, county_tasks, completed):
+    """
+    Brings the journal of a destination in line with the files actually there: entries whose copy is missing or has
+    the wrong size are dropped, and copies of the counties listed in copy_BUP.log that match their source are adopted
+    """
+
+    copies = scan_destination(root)
+    dropped = 0
+    adopted = 0
+
+    for key, entry in list(journal['entries'].items()):
+        if key not in copies or copies[key].st_size != entry['size']:
+            Transfer_Engine.journal_remove(journal, key)
+            dropped += 1
+
+    for folder, tasks in county_tasks.items():
+        if folder not in completed:
+            continue
+
+        for task in tasks:
+            copy = copies.get(task['key'])
+
+            if task['key'] in journal['entries'] or copy is None:
+                continue
+
+            if copy.st_size == task['size'] and abs(copy.st_mtime - task['mtime']) <= MTIME_TOLERANCE:
+                Transfer_Engine.journal_record(journal, task['key'], Transfer_Engine.journal_entry(task, None, adopted=True))
+                adopted += 1
+
+    if dropped or adopted:
+        print(f"{root}: {dropped} missing or incomplete copies will be copied again, {adopted} copies adopted from {COPY_LOG}")
+
+def cluster_size(path):
+    """Returns the allocation unit of the file system holding path (every file takes up a whole number of clusters)"""
+
+    if os.name == 'nt':
+        sectors_per_cluster, bytes_per_sector, free_clusters, total_clusters = (ctypes.c_ulong() for _ in range(4))
+        drive, _ = os.path.splitdrive(os.path.abspath(path))
+
+        if ctypes.windll.kernel32.GetDiskFreeSpaceW(
+            f"{drive}\\",
+            ctypes.byref(sectors_per_cluster),
+            ctypes.byref(bytes_per_sector),
+            ctypes.byref(free_clusters),
+            ctypes.byref(total_clusters),
+        ):
+            return sectors_per_cluster.value * bytes_per_sector.value
+
+        return DEFAULT_CLUSTER_SIZE
+
+    return os.statvfs(path).f_frsize or DEFAULT_CLUSTER_SIZE
+
+def county_copies(county_folder, files):
+    """Lists the files of a county as transfer tasks, keyed by their path relative to the state folder"""
+
+    county = os.path.basename(county_folder)
+
+    return [Transfer_Engine.file_task(path, f"{county}/{relative_path}", stat, county_folder) for path, relative_path, stat in files]
+
+def write_county_manifest(root, county_folder, journal):
+    """Writes the size and hash of every copied file of a county to its manifest on the destination"""
+
+    county = os.path.basename(county_folder)
+    files = {}
+
+    for key, entry in journal['entries'].items():
+        if key.startswith(f"{county}/"):
+            files[key[len(county) + 1:]] = {
+                'size': entry['size'],
+                'hash': entry['hash'],
+                'algorithm': entry.get('algorithm', Transfer_Engine.HASH_ALGORITHM),
+            }
+
+    path = os.path.join(root, county, COPY_MANIFEST)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({'county': county, 'files': dict(sorted(files.items()))}, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+def check_copy(path, item, entry):
+    """Returns why a copy does not match its manifest item and journal entry, or None if it does"""
+
+    if entry is not None and entry['hash'] != item['hash']:
+        return 'manifest and journal differ'
 
-    STATE_FOLDER = input("Enter the path to the state folder, including drive letter (e.g. W:\\SOUTH_CAROLINA): ")
-    DEST_DRIVE = input("Enter the drive letter to copy to (e.g. E): ")
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 'missing'
 
-    freeSpace = shutil.disk_usage(DEST_DRIVE).free
+    if size != item['size']:
+        return f"size {size} instead of {item['size']}"
 
-    completed = []
+    # Adopted copies have no checksum
+    if item['hash'] is not None and Transfer_Engine.file_hash(path, item['algorithm']) != item['hash']:
+        return 'checksum mismatch'
 
-    if os.path.exists(f"{STATE_FOLDER}\\copy_BUP.log"):
-        with open(f"{STATE_FOLDER}\\copy_BUP.log", "r") as f:
-            for line in f.readlines():
-                completed.append(line.strip())
+    return None
 
-    state = STATE_FOLDER.split('\\')[-1]
-    countyFolders = [ f.path for f in os.scandir(STATE_FOLDER) if (f.is_dir() and 'County_Contours' in f.path and not 'Empty' in f.path) ]
+def verify_destination(root, journal):
+    """
+    Re-hashes the copies listed in the county manifests of a destination and compares them with the manifests and the
+    journal, without reading the source. Journal entries of bad copies are removed. Returns the counties with bad copies
+    """
 
-    copyFolders = []
-    copySpace = 0
-    
-    for folder in countyFolders:
-        if folder in completed:
-            print(f"Skipping {folder} (already copied)")
+    checks = []
+
+    for county_dir in sorted(os.scandir(root), key=lambda entry: entry.name):
+        manifest_path = os.path.join(county_dir.path, COPY_MANIFEST)
+        if not county_dir.is_dir() or not os.path.isfile(manifest_path):
             continue
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        for relative_path, item in manifest['files'].items():
+            key = f"{county_dir.name}/{relative_path}"
+            checks.append((county_dir.name, key, os.path.join(county_dir.path, *relative_path.split('/')), item))
+
+    print(f"Verifying {len(checks)} files in {root}")
+    bad_counties = set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        results = executor.map(lambda check: check_copy(check[2], check[3], journal['entries'].get(check[1])), checks)
+
+        for (county, key, path, item), problem in zip(checks, results):
+            if problem:
+                print(f"Bad copy {path}: {problem}")
+                Transfer_Engine.journal_remove(journal, key)
+                bad_counties.add(county)
+
+    print(f"Verified {root}: {len(checks)} files, {len(bad_counties)} counties with bad copies")
+
+    return bad_counties
+
+def needed_space(tasks, journal, cluster):
+    """
+    Returns the space (in whole clusters) the files of a county still need on a destination, and the number of bytes
+    already copied there
+    """
+
+    needed = 0
+    copied = 0
+
+    for task in tasks:
+        if Transfer_Engine.is_current(journal['entries'].get(task['key']), task):
+            copied += task['size']
         else:
-            folderSize = shutil.disk_usage(folder).used
-            if (folderSize + copySpace) < freeSpace:
-                copySpace += folderSize
-                copyFolders.append(folder)
-            else:
-                print(f"Will skip {folder} (not enough space)")
+            needed += -(-task['size'] // cluster) * cluster
+
+    return needed, copied
+
+def plan_copies(county_space, free_space):
+    """
+    Assigns every county to a destination drive, keeping counties whole
+    county_space is {county: {dest: (space needed, bytes already copied)}}, free_space is {dest: usable free bytes}.
+    Counties partially copied to a drive stay on it, the others are placed largest first on the drive with the least
+    remaining space they fit in (best-fit decreasing). Returns {dest: [counties]} and the counties that fit nowhere
+    """
+
+    remaining = dict(free_space)
+    plan = {dest: [] for dest in free_space}
+    unplaced = []
+    new_counties = []
+
+    for county, space in county_space.items():
+        dest = max(space, key=lambda dest: space[dest][1])
+
+        if space[dest][1] and space[dest][0] <= remaining[dest]:
+            plan[dest].append(county)
+            remaining[dest] -= space[dest][0]
+        else:
+            new_counties.append(county)
+
+    for county in sorted(new_counties, key=lambda county: -max(needed for needed, copied in county_space[county].values())):
+        space = county_space[county]
+        fits = [dest for dest in remaining if space[dest][0] <= remaining[dest]]
+
+        if not fits:
+            unplaced.append(county)
+            continue
+
+        dest = min(fits, key=lambda dest: remaining[dest] - space[dest][0])
+        plan[dest].append(county)
+        remaining[dest] -= space[dest][0]
+
+    return plan, unplaced
+
+def print_plan(plan, unplaced, county_space, free_space, roots):
+    print("Copy plan:")
+
+    for dest, counties in plan.items():
+        planned = sum(county_space[county][dest][0] for county in counties)
+        print(f"  {roots[dest]}: {len(counties)} counties, {planned / 1024 ** 3:.2f} GB of {free_space[dest] / 1024 ** 3:.2f} GB usable free space")
+
+        for county in sorted(counties):
+            needed, copied = county_space[county][dest]
+            if copied and not needed:
+                print(f"    {os.path.basename(county)}: already copied")
+                continue
+
+            resume = f" ({copied / 1024 ** 3:.2f} GB already copied)" if copied else ''
+            print(f"    {os.path.basename(county)}: {needed / 1024 ** 3:.2f} GB{resume}")
+
+    for county in unplaced:
+        smallest = min(needed for needed, copied in county_space[county].values())
+        print(f"  Will skip {county} (not enough space, needs {smallest / 1024 ** 3:.2f} GB)")
+
+def main():
+    global STATE_FOLDER
+    global DEST_DRIVES
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('state_folder', nargs='?', help="Path to the state folder, including drive letter (e.g. W:\\SOUTH_CAROLINA)")
+    parser.add_argument('dest', nargs='*', help="Drive letters (e.g. E F) or folders to copy to")
+    parser.add_argument('--plan-only', action='store_true', help="Print the copy plan without copying anything")
+    parser.add_argument('--verify', action='store_true', help="Verify the copies on the destinations against their checksums instead of copying")
+    parser.add_argument('--verify-copies', action='store_true', help="Read back every copy and compare its checksum before renaming it into place")
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENCY, help=f"Maximum number of files copied at the same time (default: {MAX_CONCURRENCY})")
+    parser.add_argument('--fixed-concurrency', action='store_true', help="Always copy --concurrency files at the same time instead of adapting to the throughput")
+    parser.add_argument('--max-rate', type=float, help="Upper limit of the copy rate to each drive in MB/s (default: unlimited)")
+    args = parser.parse_args()
+
+    STATE_FOLDER = args.state_folder or input("Enter the path to the state folder, including drive letter (e.g. W:\\SOUTH_CAROLINA): ")
+    DEST_DRIVES = args.dest or input("Enter the drive letters to copy to (e.g. E, or E F G): ").split()
+    DEST_DRIVES = [dest.strip().rstrip(':') for dest in DEST_DRIVES]
+
+    roots = {dest: dest_root(dest) for dest in DEST_DRIVES}
+    free_space = {}
+    clusters = {}
+    journals = {}
+
+    for dest, root in roots.items():
+        os.makedirs(root, exist_ok=True)
+        free_space[dest] = max(shutil.disk_usage(root).free - FREE_SPACE_RESERVE, 0)
+        clusters[dest] = cluster_size(root)
+        journals[dest] = open_dest_journal(root)
+
+    if args.verify:
+        bad_counties = set()
+
+        for dest, root in roots.items():
+            bad_counties |= verify_destination(root, journals[dest])
+            Transfer_Engine.close_journal(journals[dest])
+
+        if bad_counties:
+            print(f"Run again without --verify to copy the bad files of {len(bad_counties)} counties again")
+
+        sys.exit(1 if bad_counties else 0)
+
+    folders = Transfer_Engine.find_county_folders(STATE_FOLDER)
+    county_tasks = {folder: county_copies(folder, files) for folder, files in Transfer_Engine.scan_counties(folders, COPY_ARTIFACTS).items()}
+    completed = read_log()
+
+    for dest, root in roots.items():
+        reconcile_journal(root, journals[dest], county_tasks, completed)
+
+    county_space = {
+        folder: {dest: needed_space(tasks, journals[dest], clusters[dest]) for dest in DEST_DRIVES}
+        for folder, tasks in county_tasks.items()
+    }
+
+    plan, unplaced = plan_copies(county_space, free_space)
+    print_plan(plan, unplaced, county_space, free_space, roots)
+
+    if args.plan_only:
+        for journal in journals.values():
+            Transfer_Engine.close_journal(journal)
+        return
+
+    def copy_to(dest):
+        def finish_county(county, journal, stats):
+            manifest = os.path.join(roots[dest], os.path.basename(county), COPY_MANIFEST)
+            if not stats['errors'] and (stats['files'] or not os.path.exists(manifest)):
+                write_county_manifest(roots[dest], county, journal)
+
+        groups = [(folder, journals[dest], county_tasks[folder]) for folder in plan[dest]]
+        limiter = Transfer_Engine.rate_limiter(args.max_rate * 1024 ** 2 if args.max_rate else None)
+        destination = Transfer_Engine.disk_destination(roots[dest], args.verify_copies)
+        results = Transfer_Engine.run_transfers(groups, destination, args.concurrency, limiter, finish_county, adaptive=not args.fixed_concurrency)
+        Transfer_Engine.close_journal(journals[dest])
+        return results[None]['errors']
+
+    # Every drive is a separate destination with its own concurrency controller
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(DEST_DRIVES)) as executor:
+        errors = [error for dest_errors in executor.map(copy_to, DEST_DRIVES) for error in dest_errors]
 
-    pool = ThreadPool(len(copyFolders))
-    pool.map(copyFolder, copyFolders)
-    pool.close()
-    pool.join()
+    sys.exit(1 if errors else 0)
 
 if __name__ == '__main__':
 	main()